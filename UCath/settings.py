@@ -2,6 +2,8 @@
 from pathlib import Path
 import os
 
+from ucath_songs.sqlite import sqlite_options
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -31,7 +33,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'ucath_songs.metrics.ServerTimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'ucath_songs.staticfiles.StaticFilesMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -45,12 +49,17 @@ MIDDLEWARE = [
 X_FRAME_OPTIONS = 'SAMEORIGIN'
 SESSION_SAVE_EVERY_REQUEST = True
 SESSION_EXPIRE_AT_BROWSER_CLOSE = True
+# Sessions live in the cache and reach the database only when their data
+# changes; an unchanged session's expiry is written at most this often
+# (seconds). See ucath_songs/sessions.py.
+SESSION_ENGINE = 'ucath_songs.sessions'
+SESSION_REFRESH_INTERVAL = 300
 
 ROOT_URLCONF = 'UCath.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'BACKEND': 'ucath_songs.metrics.TimedDjangoTemplates',
         'DIRS': [BASE_DIR/ 'templates'],
         'APP_DIRS': 
         True,
@@ -70,10 +79,49 @@ WSGI_APPLICATION = 'UCath.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
+# Connection pragmas come from a profile in ucath_songs/sqlite.py:
+# 'concurrent' (WAL, busy timeout, immediate transactions) or 'stock'.
+# Reads go to a read-only connection to the same file, writes to default.
+
+SQLITE_PROFILE = os.environ.get('UCATH_SQLITE_PROFILE', 'concurrent')
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': sqlite_options(SQLITE_PROFILE),
+    },
+    'read': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': sqlite_options(SQLITE_PROFILE, read_only=True),
+        'TEST': {'MIRROR': 'default'},
+    },
+}
+
+DATABASE_ROUTERS = ['ucath_songs.sqlite.ReadConnectionRouter']
+
+
+# Cache
+# File-based so every gunicorn worker and the thumbnail worker see the same
+# entries and invalidations; LocMemCache only suits a single process.
+# One directory holds file ETags, sessions, library pages and fragments
+# (per query, cursor and generation), facets and song details. Django's
+# default of 300 entries would cull that at once, losing the hits it was
+# meant to give. 50,000 entries keeps the working set of a 100k-song
+# catalog: the files and songs actually requested, not every one. The
+# cap is not higher, as every write lists the directory to count entries.
+# When full, a tenth is removed (not the default third), so one cull does
+# not empty the cache.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'cache',
+        'OPTIONS': {
+            'MAX_ENTRIES': 50000,
+            'CULL_FREQUENCY': 10,
+        },
     }
 }
 
@@ -118,10 +166,24 @@ STATICFILES_DIRS = [
     BASE_DIR / "static",
 ]
 
+# collectstatic writes hashed, pre-compressed copies here and
+# StaticFilesMiddleware serves them (see ucath_songs/staticfiles.py)
+STATIC_ROOT = BASE_DIR / 'staticfiles'
+
 # Media files
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# Uploads are stored once per distinct content (see ucath_songs/storage.py)
+STORAGES = {
+    'default': {
+        'BACKEND': 'ucath_songs.storage.ContentAddressedStorage',
+    },
+    'staticfiles': {
+        'BACKEND': 'ucath_songs.staticfiles.CompressedManifestStaticFilesStorage',
+    },
+}
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
@@ -0,0 +1,94 @@
+// Resumable chunked uploads (protocol in ucath_songs/uploads.py).
+// A form with data-chunked-upload="<upload_start url>" sends every file
+// input that has data-upload-kind in chunks before submitting, then posts
+// the upload ids (in the inputs named by data-upload-field) instead of the
+// files. A chunk that fails is retried; the server's offset says where to
+// carry on, so a dropped connection only costs the chunk in flight.
+(function () {
+    const MAX_RETRIES = 8;
+
+    function csrfToken(form) {
+        const input = form.querySelector('input[name="csrfmiddlewaretoken"]');
+        return input ? input.value : '';
+    }
+
+    async function send(form, method, url, options = {}) {
+        const response = await fetch(url, {
+            method,
+            credentials: 'same-origin',
+            body: options.body,
+            headers: {'X-CSRFToken': csrfToken(form), ...(options.headers || {})},
+        });
+        const state = await response.json();
+        // 409 carries the server's offset; the caller resumes from it
+        if (!response.ok && response.status !== 409) {
+            throw new Error(state.error || response.statusText);
+        }
+        return state;
+    }
+
+    async function uploadFile(form, file, kind, onProgress) {
+        const startUrl = form.dataset.chunkedUpload;
+        const body = new FormData();
+        body.append('kind', kind);
+        body.append('filename', file.name);
+        body.append('size', file.size);
+        let state = await send(form, 'POST', startUrl, {body});
+        const chunkSize = state.chunk_size;
+        const url = `${startUrl}${state.id}/`;
+
+        let failures = 0;
+        while (state.offset < state.size) {
+            const end = Math.min(state.offset + chunkSize, file.size);
+            try {
+                state = await send(form, 'PUT', url, {
+                    body: file.slice(state.offset, end),
+                    headers: {'Content-Range': `bytes ${state.offset}-${end - 1}/${file.size}`},
+                });
+                failures = 0;
+                onProgress(state.offset / state.size);
+            } catch (error) {
+                if (++failures > MAX_RETRIES) throw error;
+                await new Promise((resolve) => setTimeout(resolve, 1000 * 2 ** Math.min(failures, 5)));
+            }
+        }
+        await send(form, 'POST', `${url}complete/`);
+        return state.id;
+    }
+
+    document.addEventListener('submit', async (event) => {
+        const form = event.target;
+        if (!form.matches('form[data-chunked-upload]')) return;
+        const inputs = [...form.querySelectorAll('input[type="file"][data-upload-kind]')]
+            .filter((input) => !input.disabled && input.files.length);
+        if (!inputs.length) return;
+
+        event.preventDefault();
+        const button = form.querySelector('[type="submit"]');
+        const label = button ? button.textContent : '';
+        if (button) button.disabled = true;
+        try {
+            for (const input of inputs) {
+                const file = input.files[0];
+                const id = await uploadFile(form, file, input.dataset.uploadKind, (done) => {
+                    if (button) button.textContent = `${file.name}: ${Math.floor(done * 100)}%`;
+                });
+                let field = form.querySelector(`input[name="${input.dataset.uploadField}"]`);
+                if (!field) {
+                    field = Object.assign(document.createElement('input'), {type: 'hidden', name: input.dataset.uploadField});
+                    form.appendChild(field);
+                }
+                field.value = id;
+                // The file is on the server now; do not post it again
+                input.disabled = true;
+            }
+            form.submit();
+        } catch (error) {
+            if (button) {
+                button.disabled = false;
+                button.textContent = label;
+            }
+            alert(`Upload failed: ${error.message}`);
+        }
+    });
+})();
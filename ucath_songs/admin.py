@@ -2,6 +2,8 @@ from django.contrib import admin
 from django.apps import apps
 
 for model in apps.get_app_config("ucath_songs").get_models():
+    if not model._meta.managed:
+        continue
     try:
         admin.site.register(model)
     except admin.sites.AlreadyRegistered:
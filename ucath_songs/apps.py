@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class UcathSongsConfig(AppConfig):
     name = 'ucath_songs'
+
+    def ready(self):
+        from . import signals  # noqa: F401
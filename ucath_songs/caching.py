@@ -0,0 +1,51 @@
+"""
+Cache keys for the public pages and their invalidation.
+
+The landing list and each song's detail data live under fixed keys that
+are deleted when a song or one of its assets changes. Library grid
+fragments and facet counts are keyed by their query string plus a
+library generation; a change bumps the generation, so every stale page
+misses without the cache having to enumerate filter combinations.
+"""
+import hashlib
+import time
+
+from django.core.cache import cache
+from django.http import QueryDict
+from django.utils.http import urlencode
+
+CACHE_TIMEOUT = 60 * 10
+LANDING_KEY = 'ucath:landing:recent'
+LIBRARY_GENERATION_KEY = 'ucath:library:generation'
+
+
+def song_detail_key(slug):
+    return f'ucath:song:{slug}'
+
+
+def library_generation():
+    generation = cache.get(LIBRARY_GENERATION_KEY)
+    if generation is None:
+        generation = time.time_ns()
+        cache.set(LIBRARY_GENERATION_KEY, generation, None)
+    return generation
+
+
+def library_key(params):
+    """Fragment key for a library grid; ``params`` is the request's QueryDict."""
+    signature = urlencode(sorted((key, value) for key in params for value in params.getlist(key)))
+    return f'{library_generation()}:{hashlib.md5(signature.encode()).hexdigest()}'
+
+
+def facets_key(params):
+    """Key for the library's facet counts, which only depend on search and filters."""
+    filters = QueryDict(mutable=True)
+    for name in ('q', 'season', 'part'):
+        filters.setlist(name, params.getlist(name))
+    return f'ucath:facets:{library_key(filters)}'
+
+
+def invalidate_songs(slugs):
+    """Drop every cached entry that shows any of the given songs."""
+    cache.delete_many([LANDING_KEY, *(song_detail_key(slug) for slug in slugs)])
+    cache.set(LIBRARY_GENERATION_KEY, time.time_ns(), None)
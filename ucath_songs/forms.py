@@ -2,6 +2,10 @@ from pickle import TRUE
 from django import forms
 from .models import Song, MusicSheet, MidiFile, Mp3File
 from django.forms import inlineformset_factory
+from .uploads import user_uploads
+
+# file field -> chunked upload kind
+UPLOAD_FIELDS = {'music_sheet': 'sheet', 'midi_file': 'midi', 'mp3_file': 'audio'}
 
 
 class SongUploadForm(forms.ModelForm):
@@ -85,7 +89,7 @@ class SongUploadForm(forms.ModelForm):
             'class': 'form-control',
             'accept': '.pdf'
         }),
-        required=True,
+        required=False,
         help_text='Upload music sheet (PDF)'
     )
     
@@ -144,12 +148,24 @@ class SongUploadForm(forms.ModelForm):
         required=False
     )
     
+    # Ids of finished chunked uploads (see uploads.py), sent instead of the files
+    music_sheet_upload = forms.UUIDField(required=False, widget=forms.HiddenInput)
+    midi_file_upload = forms.UUIDField(required=False, widget=forms.HiddenInput)
+    mp3_file_upload = forms.UUIDField(required=False, widget=forms.HiddenInput)
+
     class Meta:
         model = Song
         fields = [
             'title', 'composer', 'arranged_by', 'part_of_mass', 
             'season', 'mto', 'mto_number', 'youtube_link'
         ]
+
+    def __init__(self, *args, user=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.user = user
+        # Let the chunked uploader in upload_songs.html take over these inputs
+        for field, kind in UPLOAD_FIELDS.items():
+            self.fields[field].widget.attrs.update({'data-upload-kind': kind, 'data-upload-field': f'{field}_upload'})
     
     def clean(self):
         cleaned_data = super().clean()
@@ -166,8 +182,19 @@ class SongUploadForm(forms.ModelForm):
         if not mto:
             cleaned_data['mto_number'] = ''
         
+        # A finished chunked upload can stand in for each file
+        for field, kind in UPLOAD_FIELDS.items():
+            upload_id = cleaned_data.get(f'{field}_upload')
+            if upload_id and self.user is not None and not user_uploads(self.user).filter(
+                pk=upload_id, kind=kind, status='complete'
+            ).exists():
+                self.add_error(field, 'The uploaded file was not found or did not finish uploading.')
+
+        if not cleaned_data.get('music_sheet') and not cleaned_data.get('music_sheet_upload'):
+            raise forms.ValidationError({'music_sheet': 'A music sheet (PDF) is required.'})
+
         # If music_sheet is provided, ms_version should be provided
-        music_sheet = cleaned_data.get('music_sheet')
+        music_sheet = cleaned_data.get('music_sheet') or cleaned_data.get('music_sheet_upload')
         ms_version = cleaned_data.get('ms_version', '').strip()
         if music_sheet and not ms_version:
             raise forms.ValidationError({
@@ -175,7 +202,7 @@ class SongUploadForm(forms.ModelForm):
             })
         
         # If midi_file is provided, midi_version should be provided
-        midi_file = cleaned_data.get('midi_file')
+        midi_file = cleaned_data.get('midi_file') or cleaned_data.get('midi_file_upload')
         midi_version = cleaned_data.get('midi_version', '').strip()
         if midi_file and not midi_version:
             raise forms.ValidationError({
@@ -183,7 +210,7 @@ class SongUploadForm(forms.ModelForm):
             })
         
         # If mp3_file is provided, mp3_version should be provided
-        mp3_file = cleaned_data.get('mp3_file')
+        mp3_file = cleaned_data.get('mp3_file') or cleaned_data.get('mp3_file_upload')
         mp3_version = cleaned_data.get('mp3_version', '').strip()
         if mp3_file and not mp3_version:
             raise forms.ValidationError({
@@ -199,6 +226,27 @@ class SongUploadForm(forms.ModelForm):
         return cleaned_data
 
 
+class BulkActionForm(forms.Form):
+    """An action for the songs ticked in the arrivals queue"""
+
+    bulk_actions = [
+        ('publish', 'Publish'),
+        ('unpublish', 'Unpublish'),
+        ('season', 'Change season'),
+        ('delete', 'Delete'),
+    ]
+
+    action = forms.ChoiceField(choices=bulk_actions)
+    songs = forms.ModelMultipleChoiceField(queryset=Song.objects.all())
+    season = forms.ChoiceField(choices=[('', 'Season...')] + Song.season_choices, required=False)
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if cleaned_data.get('action') == 'season' and not cleaned_data.get('season'):
+            self.add_error('season', 'Choose the season to move the songs to.')
+        return cleaned_data
+
+
 class SongForm(forms.ModelForm):
     class Meta:
         model = Song
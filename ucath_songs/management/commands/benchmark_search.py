@@ -0,0 +1,93 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+
+from ucath_songs.models import Song
+from ucath_songs.search import fuzzy_search_songs, index_songs, match_songs
+from ucath_songs.synthetic import analyze, build_song
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare full-text search, and trigram search for misspelled terms, against the '
+        'legacy icontains search on a synthetic catalog.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--songs', type=int, default=50000, help='Synthetic songs to add for the run.')
+        parser.add_argument('--runs', type=int, default=20, help='Timed runs per query.')
+        parser.add_argument('--query', action='append', dest='queries',
+                            help='Search term to benchmark (repeatable).')
+        parser.add_argument('--typo', action='append', dest='typos',
+                            help='Misspelled term to benchmark fuzzy search with (repeatable).')
+
+    def handle(self, *args, **options):
+        queries = options['queries'] or ['gloria', 'kiz', 'ave maria', 'mwana kondoo', 'lent']
+        typos = options['typos'] or ['glroia', 'kizto', 'palestrna', 'magnifcat', 'tumsfu', 'ekitibwa']
+        # Everything happens in one transaction that is rolled back, so the
+        # synthetic catalog never reaches the real database.
+        try:
+            with transaction.atomic():
+                self.seed(options['songs'])
+                for q in queries:
+                    self.compare(q, options['runs'])
+                for q in typos:
+                    self.compare_fuzzy(q, options['runs'])
+                raise Rollback
+        except Rollback:
+            pass
+
+    def seed(self, count):
+        rng = random.Random(count)
+        batch = []
+        for _ in range(count):
+            batch.append(build_song(rng))
+            if len(batch) == 2000:
+                index_songs(Song.objects.bulk_create(batch))
+                batch = []
+        index_songs(Song.objects.bulk_create(batch))
+        analyze()
+        self.stdout.write(f'Seeded {count} songs ({Song.objects.count()} in catalog).')
+
+    def compare(self, q, runs):
+        base = Song.objects.filter(status='published').order_by('-created_at')
+        legacy = base.filter(
+            Q(title__icontains=q) | Q(composer__icontains=q) | Q(part_of_mass__icontains=q) | Q(season__icontains=q)
+        )
+        fts = match_songs(base, q)
+        legacy_ms, legacy_hits = self.time_page(legacy, runs)
+        fts_ms, fts_hits = self.time_page(fts, runs)
+        self.stdout.write(
+            f'{q!r:>16}  icontains {legacy_ms:8.2f} ms ({legacy_hits} hits)   '
+            f'fts5 {fts_ms:8.2f} ms ({fts_hits} hits)   x{legacy_ms / max(fts_ms, 0.001):.1f}'
+        )
+
+    def compare_fuzzy(self, q, runs):
+        base = Song.objects.filter(status='published').order_by('-created_at')
+        legacy = base.filter(Q(title__icontains=q) | Q(composer__icontains=q))
+        fuzzy = fuzzy_search_songs(base, q)
+        legacy_ms, legacy_hits = self.time_page(legacy, runs)
+        fuzzy_ms, fuzzy_hits = self.time_page(fuzzy, runs)
+        self.stdout.write(
+            f'{q!r:>16}  icontains {legacy_ms:8.2f} ms ({legacy_hits} hits)   '
+            f'trigram {fuzzy_ms:8.2f} ms ({fuzzy_hits} hits)   x{legacy_ms / max(fuzzy_ms, 0.001):.1f}'
+        )
+
+    def time_page(self, queryset, runs):
+        # A COUNT of the hits (for the report) plus the first 12 rows. The
+        # keyset-paginated library runs no COUNT, so this is an upper bound.
+        timings = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            hits = queryset.count()
+            list(queryset[:12])
+            timings.append((time.perf_counter() - start) * 1000)
+        timings.sort()
+        return timings[len(timings) // 2], hits
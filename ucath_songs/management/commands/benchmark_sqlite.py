@@ -0,0 +1,148 @@
+import json
+import random
+import shutil
+import tempfile
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connections
+from django.db.utils import load_backend
+from django.utils import timezone
+
+from ucath_songs.sqlite import PROFILES, WRITE_DB, sqlite_options
+
+SESSION_ROWS = 1000
+
+
+class Command(BaseCommand):
+    help = (
+        'Run reader and writer threads against a scratch SQLite file under each connection '
+        'profile and report throughput and "database is locked" failures.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--profiles', nargs='+', default=list(PROFILES), choices=list(PROFILES),
+                            help='Profiles to compare.')
+        parser.add_argument('--readers', type=int, default=4, help='Reader threads.')
+        parser.add_argument('--writers', type=int, default=4, help='Writer threads.')
+        parser.add_argument('--seconds', type=float, default=5.0, help='How long each profile runs.')
+        parser.add_argument('--output', help='Also write the results as JSON here.')
+
+    def handle(self, *args, **options):
+        directory = tempfile.mkdtemp()
+        results = {}
+        try:
+            for profile in options['profiles']:
+                results[profile] = self.run_profile(profile, directory, options)
+                self.stdout.write(
+                    f'{profile:<12} {results[profile]["reads_per_second"]:10.0f} reads/s  '
+                    f'{results[profile]["writes_per_second"]:8.0f} writes/s  '
+                    f'{results[profile]["locked"]:5d} locked  journal {results[profile]["journal_mode"]}'
+                )
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(results, output, indent=2, sort_keys=True)
+
+    def connect(self, path, profile, read_only=False):
+        """
+        A scratch connection, set up like settings.DATABASES sets up ours.
+        It is not registered in django.db.connections, so each thread opens
+        its own, as Django does per alias.
+        """
+        settings_dict = {
+            **connections[WRITE_DB].settings_dict, 'NAME': path, 'OPTIONS': sqlite_options(profile, read_only),
+        }
+        alias = f'benchmark_{profile}_read' if read_only else f'benchmark_{profile}'
+        return load_backend(settings_dict['ENGINE']).DatabaseWrapper(settings_dict, alias)
+
+    def run_profile(self, profile, directory, options):
+        path = f'{directory}/{profile}.sqlite3'
+        setup = self.connect(path, profile)
+        try:
+            with setup.cursor() as cursor:
+                # Shaped like django_session, the table every page view writes to
+                cursor.execute(
+                    'CREATE TABLE session (session_key varchar(40) PRIMARY KEY, '
+                    'session_data text NOT NULL, expire_date datetime NOT NULL)'
+                )
+                cursor.executemany(
+                    'INSERT INTO session VALUES (%s, %s, %s)',
+                    [(f'key{index}', 'x' * 200, timezone.now()) for index in range(SESSION_ROWS)],
+                )
+                cursor.execute('PRAGMA journal_mode')
+                journal_mode = cursor.fetchone()[0]
+
+            counts = {'reads': 0, 'writes': 0, 'locked': 0}
+            lock = threading.Lock()
+            deadline = time.perf_counter() + options['seconds']
+            threads = [
+                threading.Thread(target=self.worker, args=(self.read, path, profile, True, deadline, counts, lock, seed))
+                for seed in range(options['readers'])
+            ] + [
+                threading.Thread(target=self.worker, args=(self.write, path, profile, False, deadline, counts, lock, seed))
+                for seed in range(options['writers'])
+            ]
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+        finally:
+            setup.close()
+
+        return {
+            'journal_mode': journal_mode,
+            'readers': options['readers'],
+            'writers': options['writers'],
+            'seconds': round(elapsed, 3),
+            'reads': counts['reads'],
+            'writes': counts['writes'],
+            'locked': counts['locked'],
+            'reads_per_second': round(counts['reads'] / elapsed, 1),
+            'writes_per_second': round(counts['writes'] / elapsed, 1),
+        }
+
+    def worker(self, operation, path, profile, read_only, deadline, counts, lock, seed):
+        rng = random.Random(seed)
+        connection = self.connect(path, profile, read_only)
+        done = locked = 0
+        try:
+            while time.perf_counter() < deadline:
+                try:
+                    operation(connection, f'key{rng.randrange(SESSION_ROWS)}')
+                    done += 1
+                except OperationalError:
+                    locked += 1
+        finally:
+            connection.close()
+        with lock:
+            counts['reads' if operation == self.read else 'writes'] += done
+            counts['locked'] += locked
+
+    def read(self, connection, key):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT session_data FROM session WHERE session_key = %s', [key])
+            cursor.fetchone()
+
+    def write(self, connection, key):
+        # Read then write in one transaction, as get_or_create and friends do;
+        # a deferred transaction cannot wait for the lock it needs to upgrade.
+        # BEGIN is issued the way atomic() issues it under transaction_mode.
+        with connection.cursor() as cursor:
+            cursor.execute(f'BEGIN {connection.transaction_mode or ""}'.strip())
+            try:
+                cursor.execute('SELECT session_data FROM session WHERE session_key = %s', [key])
+                cursor.fetchone()
+                cursor.execute(
+                    'UPDATE session SET session_data = %s, expire_date = %s WHERE session_key = %s',
+                    ['y' * 200, timezone.now(), key],
+                )
+                cursor.execute('COMMIT')
+            except OperationalError:
+                if connection.connection.in_transaction:
+                    cursor.execute('ROLLBACK')
+                raise
@@ -0,0 +1,168 @@
+import json
+import math
+import shutil
+import subprocess
+import tempfile
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from ucath_songs import urls
+from ucath_songs.models import Song, MusicSheet
+from ucath_songs.synthetic import seed_songs
+
+# Views that change data on GET or only log the user out, and the export,
+# which streams the whole catalog and would dominate every run
+SKIPPED_VIEWS = {'delete_asset', 'logout', 'export_library'}
+# Extra library requests worth tracking on their own: (name, url name, query)
+LIBRARY_CASES = [
+    ('song_library:season', 'song_library', {'season': ['lent', 'easter']}),
+    ('song_library:search', 'song_library', {'q': 'gloria'}),
+]
+
+
+class Rollback(Exception):
+    pass
+
+
+def percentile(timings, fraction):
+    """Nearest-rank percentile of a sorted list."""
+    return timings[max(math.ceil(fraction * len(timings)) - 1, 0)]
+
+
+class Command(BaseCommand):
+    help = (
+        'Time every page of the app on synthetic catalogs of growing size and write '
+        'p50/p95 latency, query count and response size per view as JSON.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                            help='Catalog sizes (songs) to measure at.')
+        parser.add_argument('--runs', type=int, default=20, help='Timed requests per view and size.')
+        parser.add_argument('--warm', action='store_true',
+                            help='Keep the page cache between requests instead of clearing it before each one.')
+        parser.add_argument('--output', default='benchmark_views.json', help='Where to write the JSON report.')
+
+    def handle(self, *args, **options):
+        report = {
+            'commit': self.commit(),
+            'created_at': timezone.now().isoformat(),
+            'runs': options['runs'],
+            'cache': 'warm' if options['warm'] else 'cold',
+            'sizes': {},
+        }
+        media_root = tempfile.mkdtemp()
+        # The synthetic catalog lives in one rolled-back transaction, its
+        # media in a temporary MEDIA_ROOT, and the page cache in memory.
+        try:
+            with override_settings(
+                MEDIA_ROOT=media_root,
+                CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+            ), transaction.atomic():
+                staff = User.objects.create_user('benchmark-staff', is_staff=True)
+                for size in sorted(options['sizes']):
+                    seed_songs(size - Song.objects.count(), seed=size)
+                    self.stdout.write(f'Catalog at {Song.objects.count()} songs')
+                    report['sizes'][str(size)] = self.measure(staff, options['runs'], options['warm'])
+                raise Rollback
+        except Rollback:
+            pass
+        finally:
+            shutil.rmtree(media_root, ignore_errors=True)
+
+        with open(options['output'], 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+        self.stdout.write(self.style.SUCCESS(f'Wrote {options["output"]}'))
+
+    def commit(self):
+        try:
+            return subprocess.run(
+                ['git', 'rev-parse', 'HEAD'], cwd=settings.BASE_DIR, capture_output=True, text=True, check=True
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    def cases(self):
+        """Yield (name, url, query) for every named route plus the library variants."""
+        published = Song.objects.filter(status='published').order_by('pk')
+        song = published[published.count() // 2]
+        sheet = MusicSheet.objects.filter(song=song).first()
+        kwargs = {
+            'slug': {'slug': song.slug},
+            'download_sheet': {'slug': sheet.slug},
+            'serve_asset': {
+                'asset_type': sheet.asset_type, 'asset_id': sheet.pk,
+                'filename': sheet.serve_url.rsplit('/', 1)[1],
+            },
+        }
+        for pattern in urls.urlpatterns:
+            if not pattern.name or pattern.name in SKIPPED_VIEWS:
+                continue
+            if pattern.name in kwargs:
+                yield pattern.name, reverse(pattern.name, kwargs=kwargs[pattern.name]), {}
+            elif set(pattern.pattern.converters) == {'slug'}:
+                yield pattern.name, reverse(pattern.name, kwargs=kwargs['slug']), {}
+            elif not pattern.pattern.converters:
+                yield pattern.name, reverse(pattern.name), {}
+            # Other parameterised routes (e.g. upload ids) have no sample object
+        for name, url_name, query in LIBRARY_CASES:
+            yield name, reverse(url_name), query
+
+    def fetch(self, client, url, query):
+        # Streamed bodies count too; reading them to the end also lets the
+        # test client close file responses without closing the connection
+        response = client.get(url, query)
+        body = b''.join(response.streaming_content) if response.streaming else response.content
+        return response, body
+
+    def measure(self, staff, runs, warm):
+        anonymous = Client(raise_request_exception=False)
+        staff_client = Client(raise_request_exception=False)
+        staff_client.force_login(staff)
+        results = {}
+        for name, url, query in self.cases():
+            client, user = anonymous, 'anonymous'
+            response, _ = self.fetch(client, url, query)
+            if response.status_code in (302, 403) and 'login' in response.get('Location', 'login'):
+                client, user = staff_client, 'staff'
+                response, _ = self.fetch(client, url, query)
+            if response.status_code == 405:
+                continue
+            if response.status_code >= 500:
+                results[name] = {'url': url, 'user': user, 'status': response.status_code}
+                self.stderr.write(f'  {name:<24} {response.status_code}  not timed')
+                continue
+
+            timings = []
+            for _ in range(runs):
+                if not warm:
+                    cache.clear()
+                with CaptureQueriesContext(connection) as ctx:
+                    start = time.perf_counter()
+                    response, body = self.fetch(client, url, query)
+                    timings.append((time.perf_counter() - start) * 1000)
+            timings.sort()
+            results[name] = {
+                'url': url,
+                'user': user,
+                'status': response.status_code,
+                'p50_ms': round(percentile(timings, 0.50), 3),
+                'p95_ms': round(percentile(timings, 0.95), 3),
+                'queries': len(ctx.captured_queries),
+                'bytes': len(body),
+            }
+            self.stdout.write(
+                f'  {name:<24} {response.status_code}  p50 {results[name]["p50_ms"]:9.2f} ms  '
+                f'p95 {results[name]["p95_ms"]:9.2f} ms  {results[name]["queries"]:4d} queries  '
+                f'{len(body):9d} bytes'
+            )
+        return results
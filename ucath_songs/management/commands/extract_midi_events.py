@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from ucath_songs.models import MidiFile
+
+
+class Command(BaseCommand):
+    help = (
+        'Parse the note events of MIDI files uploaded before parsing existed. '
+        'New uploads are parsed when they are saved.'
+    )
+
+    def handle(self, *args, **options):
+        done = failed = 0
+        for midi in MidiFile.objects.filter(duration__isnull=True).exclude(midi_file='').defer('note_events'):
+            try:
+                midi.read_events()
+            except Exception as error:
+                failed += 1
+                self.stderr.write(f'MIDI file {midi.pk} failed: {error}')
+            else:
+                done += 1
+        self.stdout.write(self.style.SUCCESS(f'Parsed {done} MIDI file(s), {failed} failed.'))
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from ucath_songs.models import MusicSheet
+from ucath_songs.thumbnails import extract_details
+
+
+class Command(BaseCommand):
+    help = (
+        'Read the page details and text of sheets rendered before extraction existed. '
+        'New sheets get theirs from the thumbnail worker.'
+    )
+
+    def handle(self, *args, **options):
+        done = failed = 0
+        for sheet in MusicSheet.objects.filter(page_count__isnull=True).exclude(music_sheet='').select_related('song'):
+            try:
+                sheet.save_details(extract_details(sheet.music_sheet.path))
+            except Exception as error:
+                failed += 1
+                self.stderr.write(f'Sheet {sheet.pk} failed: {error}')
+            else:
+                done += 1
+        self.stdout.write(self.style.SUCCESS(f'Extracted {done} sheet(s), {failed} failed.'))
@@ -0,0 +1,201 @@
+import csv
+import json
+import os
+
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from ucath_songs.caching import invalidate_songs
+from ucath_songs.midi import MidiError
+from ucath_songs.models import Song, MusicSheet, MidiFile, Mp3File, StoredBlob, ThumbnailJob
+from ucath_songs.search import index_songs
+from ucath_songs.utils import generate_bs64_slug
+
+SONG_FIELDS = ['title', 'composer', 'arranged_by', 'part_of_mass', 'season', 'status', 'mto', 'mto_number', 'youtube_link']
+# manifest key -> (model, file field, version field, version default)
+ASSET_KINDS = {
+    'sheet': (MusicSheet, 'music_sheet', 'ms_version', 'Standard Folio'),
+    'mp3': (Mp3File, 'mp3_file', 'mp3_version', 'Master Recording'),
+    'midi': (MidiFile, 'midi_file', 'midi_version', 'Synthesized Logic'),
+}
+TRUE_VALUES = {'1', 'true', 'yes', 'y'}
+
+
+class Command(BaseCommand):
+    help = (
+        'Import songs and their PDF/MP3/MIDI files from a CSV or JSON manifest. '
+        'Rows are matched on archive_id, so re-running after a crash resumes where it stopped.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('manifest', help='CSV or JSON file with one song per row.')
+        parser.add_argument('--media-dir', help="Directory asset paths are relative to (default: the manifest's).")
+        parser.add_argument('--batch-size', type=int, default=500, help='Songs committed per transaction.')
+        parser.add_argument('--status', default='published', choices=[value for value, _ in Song.song_status],
+                            help='Status for rows that do not set one.')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Thumbnail render processes.')
+        parser.add_argument('--no-render', action='store_true',
+                            help='Only queue thumbnail jobs; leave rendering to thumbnail_worker.')
+
+    def handle(self, *args, **options):
+        manifest = options['manifest']
+        self.media_dir = options['media_dir'] or os.path.dirname(os.path.abspath(manifest))
+        self.default_status = options['status']
+        self.seasons = self.choice_lookup(Song.season_choices)
+        self.mass_parts = self.choice_lookup(Song.mass_parts)
+
+        imported = skipped = 0
+        batch = []
+        for line, row in enumerate(self.read_manifest(manifest), start=1):
+            batch.append((line, row))
+            if len(batch) == options['batch_size']:
+                added, passed = self.import_batch(batch)
+                imported, skipped = imported + added, skipped + passed
+                batch = []
+        if batch:
+            added, passed = self.import_batch(batch)
+            imported, skipped = imported + added, skipped + passed
+
+        self.stdout.write(self.style.SUCCESS(f'Imported {imported} song(s), skipped {skipped}.'))
+
+        if imported and not options['no_render']:
+            call_command('thumbnail_worker', once=True, workers=options['workers'], stdout=self.stdout, stderr=self.stderr)
+
+    def read_manifest(self, path):
+        if not os.path.exists(path):
+            raise CommandError(f'Manifest "{path}" does not exist.')
+        with open(path, newline='', encoding='utf-8') as manifest:
+            if path.lower().endswith('.json'):
+                rows = json.load(manifest)
+                if isinstance(rows, dict):
+                    rows = rows.get('songs', [])
+                yield from rows
+            else:
+                yield from csv.DictReader(manifest)
+
+    def choice_lookup(self, choices):
+        # Manifests may use either the stored value or the display label
+        lookup = {}
+        for value, label in choices:
+            lookup[value.lower()] = value
+            lookup[label.lower()] = value
+        return lookup
+
+    def import_batch(self, batch):
+        archive_ids = [str(row.get('archive_id') or '').strip() for _, row in batch]
+        existing = set(Song.objects.filter(archive_id__in=archive_ids).values_list('archive_id', flat=True))
+
+        songs, assets, skipped = [], [], 0
+        for (line, row), archive_id in zip(batch, archive_ids):
+            if not archive_id:
+                self.stderr.write(f'Row {line}: missing archive_id, skipped.')
+                skipped += 1
+                continue
+            if archive_id in existing:
+                skipped += 1
+                continue
+            try:
+                song = self.build_song(row, archive_id)
+                song_assets = list(self.build_assets(row))
+            except ValueError as error:
+                self.stderr.write(f'Row {line}: {error}, skipped.')
+                skipped += 1
+                continue
+            existing.add(archive_id)
+            songs.append(song)
+            assets.append(song_assets)
+
+        stored = []
+        try:
+            with transaction.atomic():
+                Song.objects.bulk_create(songs)
+                index_songs(songs)
+                self.create_assets(songs, assets, stored)
+        except BaseException:
+            # The batch rolled back, blob references included; remove the
+            # files it copied unless they are still referenced elsewhere
+            for name in stored:
+                if not StoredBlob.objects.filter(name=name).exists():
+                    default_storage.delete(name)
+            raise
+        if songs:
+            # bulk_create sends no signals; pages listing songs must miss
+            invalidate_songs([])
+        return len(songs), skipped
+
+    def build_song(self, row, archive_id):
+        values = {field: str(row.get(field) or '').strip() for field in SONG_FIELDS}
+        if not values['title']:
+            raise ValueError('missing title')
+        part = self.mass_parts.get(values['part_of_mass'].lower())
+        if not part:
+            raise ValueError(f'unknown part_of_mass "{values["part_of_mass"]}"')
+        season = self.seasons.get(values['season'].lower() or 'ordinary')
+        if not season:
+            raise ValueError(f'unknown season "{values["season"]}"')
+        status = values['status'] or self.default_status
+        if status not in dict(Song.song_status):
+            raise ValueError(f'unknown status "{status}"')
+        return Song(
+            title=values['title'],
+            composer=values['composer'],
+            arranged_by=values['arranged_by'],
+            part_of_mass=part,
+            season=season,
+            status=status,
+            mto=values['mto'].lower() in TRUE_VALUES,
+            mto_number=values['mto_number'] or None,
+            youtube_link=values['youtube_link'] or None,
+            archive_id=archive_id,
+            slug=generate_bs64_slug(),
+        )
+
+    def build_assets(self, row):
+        """Yield (kind, source path, version) for every asset listed on the row."""
+        for kind, (_, _, version_field, default_version) in ASSET_KINDS.items():
+            # JSON rows may list several files: "sheets": [{"file": ..., "version": ...}]
+            entries = row.get(f'{kind}s') or []
+            if row.get(kind):
+                entries = [{'file': row[kind], 'version': row.get(version_field)}, *entries]
+            for entry in entries:
+                if isinstance(entry, str):
+                    entry = {'file': entry}
+                path = os.path.join(self.media_dir, entry['file'])
+                if not os.path.isfile(path):
+                    raise ValueError(f'{kind} file "{entry["file"]}" not found')
+                yield kind, path, entry.get('version') or default_version
+
+        midi_link = str(row.get('midi_link') or '').strip()
+        if midi_link:
+            yield 'midi_link', midi_link, row.get('midi_version') or ASSET_KINDS['midi'][3]
+
+    def create_assets(self, songs, assets, stored):
+        rows = {kind: [] for kind in ASSET_KINDS}
+        for song, song_assets in zip(songs, assets):
+            for kind, source, version in song_assets:
+                if kind == 'midi_link':
+                    rows['midi'].append(MidiFile(song=song, midi_link=source, midi_version=version))
+                    continue
+                model, file_field, version_field, _ = ASSET_KINDS[kind]
+                upload_to = model._meta.get_field(file_field).upload_to
+                with open(source, 'rb') as handle:
+                    name = default_storage.save(upload_to + os.path.basename(source), File(handle))
+                stored.append(name)
+                instance = model(song=song, **{file_field: name, version_field: version})
+                if kind == 'sheet':
+                    instance.slug = generate_bs64_slug()
+                elif kind == 'midi':
+                    # bulk_create skips MidiFile.save, which would parse it
+                    try:
+                        instance.parse_events()
+                    except (MidiError, OSError) as error:
+                        self.stderr.write(f'{source}: not playable in the browser ({error}).')
+                rows[kind].append(instance)
+
+        sheets = MusicSheet.objects.bulk_create(rows['sheet'])
+        ThumbnailJob.objects.bulk_create(ThumbnailJob(sheet=sheet) for sheet in sheets)
+        Mp3File.objects.bulk_create(rows['mp3'])
+        MidiFile.objects.bulk_create(rows['midi'])
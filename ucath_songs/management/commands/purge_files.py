@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from ucath_songs.moderation import PURGE_BATCH_SIZE, purge_queued_files
+
+
+class Command(BaseCommand):
+    help = 'Release the media files queued for deletion by bulk moderation actions.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=PURGE_BATCH_SIZE,
+                            help='Files released per round.')
+
+    def handle(self, *args, **options):
+        purged = 0
+        while True:
+            released = purge_queued_files(max(options['batch_size'], 1))
+            if not released:
+                break
+            purged += released
+        self.stdout.write(self.style.SUCCESS(f'Released {purged} queued file(s).'))
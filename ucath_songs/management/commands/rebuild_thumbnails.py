@@ -0,0 +1,131 @@
+import os
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from ucath_songs.models import MusicSheet, ThumbnailJob
+from ucath_songs.thumbnails import process_pdf, render_settings
+
+# Sheets fetched per query while scanning the catalog
+CHUNK_SIZE = 2000
+
+
+class Command(BaseCommand):
+    help = (
+        'Render the thumbnails of sheets that have none or were rendered with other render settings, '
+        'in a pool of worker processes. That check is one query; --verify also looks for rendition '
+        'files missing on disk and PDFs changed since they were rendered (e.g. after a restore).'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Render processes.')
+        parser.add_argument('--batch', type=int, default=20, help='Rendered files saved per transaction.')
+        parser.add_argument('--verify', action='store_true',
+                            help='Also check every current sheet\'s files on disk.')
+        parser.add_argument('--all', action='store_true', help='Render every sheet, current or not.')
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would be rendered.')
+
+    def handle(self, *args, **options):
+        settings = render_settings()
+        # Sheets sharing a file (same content hash) sort together and are rendered once
+        sheets = MusicSheet.objects.exclude(music_sheet='').select_related('song').order_by('music_sheet', 'pk')
+        if options['verify'] and not options['all']:
+            sheets = sheets.prefetch_related('renditions')
+        elif not options['all']:
+            # Sheets with current settings and a render time never touch the disk
+            sheets = sheets.filter(
+                Q(thumbnail='') | Q(thumbnail__isnull=True) | Q(thumbnail_rendered_at__isnull=True) |
+                ~Q(thumbnail_settings=settings)
+            )
+
+        self.options = options
+        self.pool = None
+        self.reasons, self.done, self.failed, self.missing_sources = Counter(), 0, 0, 0
+        batch = {}
+        try:
+            for sheet in sheets.iterator(chunk_size=CHUNK_SIZE):
+                reason = self.outdated(sheet, settings)
+                if not reason:
+                    continue
+                if not sheet.music_sheet.storage.exists(sheet.music_sheet.name):
+                    self.missing_sources += 1
+                    self.stderr.write(f'Sheet {sheet.pk}: the PDF {sheet.music_sheet.name} is missing.')
+                    continue
+                self.reasons[reason] += 1
+                if options['dry_run']:
+                    continue
+                path = sheet.music_sheet.path
+                if path not in batch and len(batch) >= options['batch']:
+                    self.run_batch(batch)
+                    batch = {}
+                batch.setdefault(path, []).append(sheet)
+            if batch:
+                self.run_batch(batch)
+        finally:
+            if self.pool is not None:
+                self.pool.shutdown(cancel_futures=True)
+
+        total = sum(self.reasons.values())
+        summary = ', '.join(f'{count} {reason}' for reason, count in sorted(self.reasons.items()))
+        self.stdout.write(f'{total} sheet(s) to render' + (f' ({summary})' if summary else '') + '.')
+        if total and not options['dry_run']:
+            style = self.style.SUCCESS if not self.failed else self.style.WARNING
+            self.stdout.write(style(
+                f'Rendered {self.done} sheet(s), {self.failed} failed, {self.missing_sources} missing their PDF.'
+            ))
+
+    def outdated(self, sheet, settings):
+        if self.options['all']:
+            return 'forced'
+        if self.options['verify']:
+            return sheet.outdated_thumbnail(settings)
+        # The query only returned sheets that need rendering
+        return 'missing' if not sheet.thumbnail else 'settings'
+
+    def run_batch(self, batch):
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(max_workers=max(self.options['workers'], 1))
+        try:
+            self.render(batch)
+        except BrokenProcessPool:
+            # A render process died (e.g. a PDF crashed MuPDF); carry on with a fresh pool
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+
+    def render(self, batch):
+        futures = {self.pool.submit(process_pdf, path): sheets for path, sheets in batch.items()}
+        results, broken = [], False
+        for future in as_completed(futures):
+            sheets = futures[future]
+            try:
+                results.append((sheets, future.result()))
+            except BrokenProcessPool as error:
+                broken = True
+                self.fail(sheets, error)
+            except Exception as error:
+                self.fail(sheets, error)
+
+        # One transaction per batch instead of one commit per row
+        with transaction.atomic():
+            for sheets, (renditions, details) in results:
+                for sheet in sheets:
+                    sheet.save_renditions(renditions)
+                    sheet.save_details(details)
+            # The queue would otherwise render these sheets again
+            ThumbnailJob.objects.filter(
+                sheet__in=[sheet for sheets, _ in results for sheet in sheets], status='pending'
+            ).update(status='done', last_error='', finished_at=timezone.now())
+        self.done += sum(len(sheets) for sheets, _ in results)
+        self.stdout.write(f'{self.done} sheet(s) rendered, {self.failed} failed so far.')
+        if broken:
+            raise BrokenProcessPool
+
+    def fail(self, sheets, error):
+        self.failed += len(sheets)
+        for sheet in sheets:
+            self.stderr.write(f'Sheet {sheet.pk} failed: {error}')
@@ -0,0 +1,32 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ucath_songs.models import Song
+from ucath_songs.synthetic import seed_songs
+
+
+class Command(BaseCommand):
+    help = (
+        'Add synthetic songs with sheets, recordings and MIDI files for load testing. '
+        'All assets share one small placeholder file per kind.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--songs', type=int, required=True, help='Number of songs to add.')
+        parser.add_argument('--seed', type=int, help='Random seed, for a reproducible catalog.')
+        parser.add_argument('--batch-size', type=int, default=2000, help='Songs committed per transaction.')
+        parser.add_argument('--status', default='published', choices=[value for value, _ in Song.song_status],
+                            help='Status of the generated songs.')
+
+    def handle(self, *args, **options):
+        if options['songs'] < 1:
+            raise CommandError('--songs must be at least 1.')
+        start = time.perf_counter()
+        created = seed_songs(
+            options['songs'], seed=options['seed'], batch_size=options['batch_size'], status=options['status']
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f'Seeded {created} song(s) in {time.perf_counter() - start:.1f}s '
+            f'({Song.objects.count()} in catalog).'
+        ))
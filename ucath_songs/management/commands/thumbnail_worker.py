@@ -0,0 +1,84 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from ucath_songs.models import ThumbnailJob
+from ucath_songs.thumbnails import process_pdf
+
+
+class Command(BaseCommand):
+    help = 'Render queued music sheet thumbnails and extract their text in a pool of worker processes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Render processes.')
+        parser.add_argument('--batch', type=int, default=0, help='Jobs claimed per round (default: 2 per worker).')
+        parser.add_argument('--poll', type=float, default=2.0, help='Seconds to sleep when the queue is empty.')
+        parser.add_argument('--stale-after', type=int, default=600,
+                            help='Seconds after which a running job is assumed abandoned and re-queued.')
+        parser.add_argument('--once', action='store_true', help='Exit once no jobs are due instead of polling.')
+
+    def handle(self, *args, **options):
+        workers = max(options['workers'], 1)
+        batch = options['batch'] or workers * 2
+        stale_after = timedelta(seconds=options['stale_after'])
+
+        requeued = ThumbnailJob.requeue_stale(stale_after)
+        if requeued:
+            self.stdout.write(f'Re-queued {requeued} abandoned job(s).')
+
+        pool = ProcessPoolExecutor(max_workers=workers)
+        try:
+            while True:
+                jobs = ThumbnailJob.claim_batch(batch)
+                if not jobs:
+                    if options['once']:
+                        break
+                    time.sleep(options['poll'])
+                    continue
+                try:
+                    self.run_batch(pool, jobs)
+                except BrokenProcessPool:
+                    # A render process died (e.g. a PDF crashed MuPDF); the
+                    # failed jobs were recorded, start over with a fresh pool.
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    pool = ProcessPoolExecutor(max_workers=workers)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            pool.shutdown(cancel_futures=True)
+
+    def run_batch(self, pool, jobs):
+        futures = {}
+        for job in jobs:
+            try:
+                futures[pool.submit(process_pdf, job.sheet.music_sheet.path)] = job
+            except BrokenProcessPool:
+                raise
+            except Exception as error:
+                self.fail(job, error)
+
+        broken = False
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                renditions, details = future.result()
+                job.sheet.save_renditions(renditions)
+                job.sheet.save_details(details)
+            except BrokenProcessPool as error:
+                broken = True
+                self.fail(job, error)
+            except Exception as error:
+                self.fail(job, error)
+            else:
+                job.mark_done()
+                self.stdout.write(f'Rendered thumbnail for sheet {job.sheet_id}.')
+        if broken:
+            raise BrokenProcessPool
+
+    def fail(self, job, error):
+        job.mark_failed(error)
+        self.stderr.write(f'Thumbnail for sheet {job.sheet_id} failed (attempt {job.attempts}): {error}')
@@ -0,0 +1,251 @@
+"""
+Per-request timing: Server-Timing headers and in-process histograms.
+
+ServerTimingMiddleware measures each request's total time, its database
+queries (record_query, installed on every connection by signals.py) and
+its template rendering (through TimedDjangoTemplates), plus any block
+wrapped in ``timed(name)``. The numbers go out in a Server-Timing header
+and into histograms per view, which the staff-only metrics view exposes
+in Prometheus text format. Histograms live in process memory, so each
+server process reports its own.
+"""
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+from django.template.backends.django import DjangoTemplates
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+_current = contextvars.ContextVar('ucath_request_metrics', default=None)
+
+
+class RequestMetrics:
+    """Time spent so far by one request, per Server-Timing metric name."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.durations = {'db': 0.0, 'template': 0.0}
+        self.queries = 0
+
+    def add(self, name, seconds):
+        self.durations[name] = self.durations.get(name, 0.0) + seconds
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def server_timing(self):
+        entries = [f'total;dur={self.elapsed() * 1000:.1f}']
+        for name, seconds in self.durations.items():
+            entry = f'{name};dur={seconds * 1000:.1f}'
+            if name == 'db':
+                entry += f';desc="{self.queries} queries"'
+            entries.append(entry)
+        return ', '.join(entries)
+
+
+@contextmanager
+def timed(name):
+    """Add the time spent in the block to the current request's ``name`` metric."""
+    metrics = _current.get()
+    if metrics is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.add(name, time.perf_counter() - start)
+
+
+def record_query(execute, sql, params, many, context):
+    metrics = _current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.queries += 1
+        metrics.add('db', time.perf_counter() - start)
+
+
+class TimedTemplate:
+
+    def __init__(self, template):
+        self.template = template
+
+    def __getattr__(self, name):
+        return getattr(self.template, name)
+
+    def render(self, context=None, request=None):
+        with timed('template'):
+            return self.template.render(context, request)
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    """The Django template backend, with rendering counted as 'template' time."""
+
+    def from_string(self, template_code):
+        return TimedTemplate(super().from_string(template_code))
+
+    def get_template(self, template_name):
+        return TimedTemplate(super().get_template(template_name))
+
+
+class Histogram:
+
+    def __init__(self, name, documentation, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = buckets
+        self.series = {}
+
+    def observe(self, labels, value):
+        counts, total = self.series.get(labels, ([0] * (len(self.buckets) + 1), 0.0))
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[index] += 1
+        counts[-1] += 1
+        self.series[labels] = (counts, total + value)
+
+    def exposition(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        for labels, (counts, total) in sorted(self.series.items()):
+            label_text = format_labels(labels)
+            for bound, count in zip([*map(str, self.buckets), '+Inf'], counts):
+                lines.append(f'{self.name}_bucket{{{label_text},le="{bound}"}} {count}')
+            lines.append(f'{self.name}_sum{{{label_text}}} {total:.6f}')
+            lines.append(f'{self.name}_count{{{label_text}}} {counts[-1]}')
+        return lines
+
+
+class Counter:
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self.series = {}
+
+    def inc(self, labels):
+        self.series[labels] = self.series.get(labels, 0) + 1
+
+    def exposition(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        for labels, value in sorted(self.series.items()):
+            lines.append(f'{self.name}{{{format_labels(labels)}}} {value}')
+        return lines
+
+
+def format_labels(labels):
+    return ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels
+    )
+
+
+class Registry:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = Counter('ucath_requests_total', 'Requests handled, by view, method and status.')
+        self.duration = Histogram(
+            'ucath_request_duration_seconds', 'Total time to produce the response.', DURATION_BUCKETS
+        )
+        self.db_duration = Histogram(
+            'ucath_request_db_seconds', 'Time spent in database queries per request.', DURATION_BUCKETS
+        )
+        self.db_queries = Histogram(
+            'ucath_request_db_queries', 'Database queries run per request.', QUERY_COUNT_BUCKETS
+        )
+        self.template_duration = Histogram(
+            'ucath_request_template_seconds', 'Time spent rendering templates per request.', DURATION_BUCKETS
+        )
+
+    def observe(self, view, method, status, metrics):
+        labels = (('view', view), ('method', method))
+        with self.lock:
+            self.requests.inc((*labels, ('status', status)))
+            self.duration.observe(labels, metrics.elapsed())
+            self.db_duration.observe(labels, metrics.durations['db'])
+            self.db_queries.observe(labels, metrics.queries)
+            self.template_duration.observe(labels, metrics.durations['template'])
+
+    def exposition(self):
+        with self.lock:
+            lines = []
+            for metric in [self.requests, self.duration, self.db_duration, self.db_queries, self.template_duration]:
+                lines += metric.exposition()
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+class ServerTimingMiddleware:
+    """Keep first in MIDDLEWARE so the total covers the other middleware too."""
+
+    sync_capable = async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, metrics)
+
+    async def __acall__(self, request):
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, metrics)
+
+    def finish(self, request, response, metrics):
+        response['Server-Timing'] = metrics.server_timing()
+        if response.streaming:
+            # The body is produced after this returns; observe once it is sent
+            if response.is_async:
+                response.streaming_content = self.stream_async(response.streaming_content, request, response, metrics)
+            else:
+                response.streaming_content = self.stream(response.streaming_content, request, response, metrics)
+        else:
+            self.observe(request, response, metrics)
+        return response
+
+    def stream(self, content, request, response, metrics):
+        _current.set(metrics)
+        try:
+            yield from content
+        finally:
+            _current.set(None)
+            self.observe(request, response, metrics)
+
+    async def stream_async(self, content, request, response, metrics):
+        _current.set(metrics)
+        try:
+            async for chunk in content:
+                yield chunk
+        finally:
+            _current.set(None)
+            self.observe(request, response, metrics)
+
+    def observe(self, request, response, metrics):
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match else 'unmatched'
+        registry.observe(view, request.method, response.status_code, metrics)
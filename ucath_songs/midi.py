@@ -0,0 +1,235 @@
+"""
+Reading of Standard MIDI Files for in-browser playback.
+
+parse_midi() reads a .mid file once, when it is uploaded, into the
+details stored on MidiFile: duration, opening tempo, track names, part
+names and the notes. Notes are grouped into parts, one per track and
+channel that plays, so a singer can solo or mute their line. Times are
+converted through the tempo map to whole milliseconds, and each part's
+notes are one flat list of ``[delay, length, pitch, velocity, ...]``,
+where ``delay`` counts from the previous note's start. That keeps the
+JSON small and lets a player schedule notes without knowing about ticks
+or tempo.
+"""
+import gzip
+import json
+import struct
+
+DEFAULT_TEMPO = 500000  # microseconds per beat, i.e. 120 BPM
+MAX_MIDI_SIZE = 16 * 1024 * 1024
+# Data bytes that follow each kind of channel message
+DATA_LENGTHS = {0x80: 2, 0x90: 2, 0xA0: 2, 0xB0: 2, 0xC0: 1, 0xD0: 1, 0xE0: 2}
+META_TEMPO = 0x51
+META_TRACK_NAME = 0x03
+META_INSTRUMENT_NAME = 0x04
+META_END_OF_TRACK = 0x2F
+
+
+class MidiError(ValueError):
+    pass
+
+
+class Reader:
+
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+
+    def read(self, length):
+        if self.position + length > len(self.data):
+            raise MidiError('The file ends in the middle of an event.')
+        chunk = self.data[self.position:self.position + length]
+        self.position += length
+        return chunk
+
+    def byte(self):
+        return self.read(1)[0]
+
+    def varlen(self):
+        value = 0
+        for _ in range(4):
+            byte = self.byte()
+            value = (value << 7) | (byte & 0x7F)
+            if not byte & 0x80:
+                return value
+        raise MidiError('A variable-length number is longer than four bytes.')
+
+    def at_end(self):
+        return self.position >= len(self.data)
+
+
+def decode_text(data):
+    # The format says ASCII; real files use UTF-8 or Latin-1
+    try:
+        return data.decode('utf-8').strip()
+    except UnicodeDecodeError:
+        return data.decode('latin-1').strip()
+
+
+def read_chunks(data):
+    """Return the header fields and the raw MTrk chunks of ``data``."""
+    reader = Reader(data)
+    if reader.read(4) != b'MThd':
+        raise MidiError('Not a Standard MIDI File.')
+    length = struct.unpack('>I', reader.read(4))[0]
+    if length < 6:
+        raise MidiError('The MIDI header is too short.')
+    midi_format, _, division = struct.unpack('>HHH', reader.read(6))
+    reader.read(length - 6)
+
+    tracks = []
+    while not reader.at_end():
+        if len(reader.data) - reader.position < 8:
+            break  # padding some writers leave after the last chunk
+        kind = reader.read(4)
+        length = struct.unpack('>I', reader.read(4))[0]
+        # A truncated last track is still worth reading up to the cut
+        chunk = reader.data[reader.position:reader.position + length]
+        reader.position += length
+        if kind == b'MTrk':
+            tracks.append(chunk)
+    return midi_format, division, tracks
+
+
+def read_track(chunk):
+    """Yield ``(tick, status, data)`` for every event of one track chunk."""
+    reader = Reader(chunk)
+    tick = 0
+    running_status = None
+    while not reader.at_end():
+        tick += reader.varlen()
+        status = reader.byte()
+        if status == 0xFF:
+            kind = reader.byte()
+            data = reader.read(reader.varlen())
+            yield tick, status, (kind, data)
+            if kind == META_END_OF_TRACK:
+                return
+        elif status in (0xF0, 0xF7):
+            reader.read(reader.varlen())
+            running_status = None
+        else:
+            if status < 0x80:
+                # Running status: this byte is the first data byte
+                if running_status is None:
+                    raise MidiError('A data byte appears before any status byte.')
+                reader.position -= 1
+                status = running_status
+            elif status < 0xF0:
+                running_status = status
+            else:
+                raise MidiError(f'Unexpected status byte 0x{status:02X}.')
+            yield tick, status, reader.read(DATA_LENGTHS[status & 0xF0])
+
+
+class TempoMap:
+    """Converts ticks to seconds through the file's tempo changes."""
+
+    def __init__(self, division, changes):
+        if division & 0x8000:
+            # SMPTE timing: frames per second times ticks per frame, no tempo
+            frames = 256 - (division >> 8)
+            self.segments = [(0, 0.0, 1 / (frames * (division & 0xFF)))]
+            return
+        if not division:
+            raise MidiError('The MIDI header has no time division.')
+        self.segments = []
+        tick, seconds, tempo = 0, 0.0, DEFAULT_TEMPO
+        for change_tick, change_tempo in sorted(changes):
+            seconds += (change_tick - tick) * tempo / 1e6 / division
+            tick, tempo = change_tick, change_tempo
+            self.segments.append((tick, seconds, tempo / 1e6 / division))
+        if not self.segments or self.segments[0][0]:
+            self.segments.insert(0, (0, 0.0, DEFAULT_TEMPO / 1e6 / division))
+
+    def seconds(self, tick):
+        for start, seconds, per_tick in reversed(self.segments):
+            if tick >= start:
+                return seconds + (tick - start) * per_tick
+        return 0.0
+
+
+def parse_midi(data):
+    """
+    Read a Standard MIDI File and return its playback details::
+
+        {'duration': seconds, 'tempo': opening BPM,
+         'track_names': [...], 'part_names': [...],
+         'events': {'duration': ms, 'tempo': BPM, 'parts': [
+             {'name': ..., 'channel': ..., 'notes': [delay, length, pitch, velocity, ...]},
+         ]}}
+
+    Raise MidiError when ``data`` is not a MIDI file that can be read.
+    """
+    if len(data) > MAX_MIDI_SIZE:
+        raise MidiError(f'MIDI files over {MAX_MIDI_SIZE} bytes are not read.')
+    _, division, chunks = read_chunks(data)
+    if not chunks:
+        raise MidiError('The file has no tracks.')
+
+    tempo_changes, track_names, parts = [], [], []
+    last_tick = 0
+    for chunk in chunks:
+        name = instrument = None
+        channels = {}  # channel -> [(start tick, end tick, pitch, velocity)]
+        sounding = {}  # (channel, pitch) -> [(start tick, velocity)], oldest first
+        tick = 0
+        for tick, status, data in read_track(chunk):
+            if status == 0xFF:
+                kind, payload = data
+                if kind == META_TEMPO and len(payload) == 3:
+                    tempo_changes.append((tick, int.from_bytes(payload, 'big') or DEFAULT_TEMPO))
+                elif kind == META_TRACK_NAME and name is None:
+                    name = decode_text(payload)
+                elif kind == META_INSTRUMENT_NAME and instrument is None:
+                    instrument = decode_text(payload)
+                continue
+            message, channel = status & 0xF0, status & 0x0F
+            if message == 0x90 and data[1]:
+                sounding.setdefault((channel, data[0]), []).append((tick, data[1]))
+            elif message in (0x80, 0x90) and sounding.get((channel, data[0])):
+                start, velocity = sounding[(channel, data[0])].pop(0)
+                channels.setdefault(channel, []).append((start, tick, data[0], velocity))
+        # Notes still held when the track ends stop there
+        for (channel, pitch), held in sounding.items():
+            for start, velocity in held:
+                channels.setdefault(channel, []).append((start, tick, pitch, velocity))
+        last_tick = max(last_tick, tick)
+
+        if name:
+            track_names.append(name)
+        for channel, notes in sorted(channels.items()):
+            if len(channels) == 1:
+                part_name = name or instrument or f'Channel {channel + 1}'
+            else:
+                part_name = f'{name or instrument or "Channel"} {channel + 1}'
+            parts.append((part_name, channel, notes))
+
+    tempo_map = TempoMap(division, tempo_changes)
+    duration = tempo_map.seconds(last_tick)
+    event_parts = []
+    for part_name, channel, notes in parts:
+        flat, previous = [], 0
+        for start, end, pitch, velocity in sorted(notes):
+            start_ms = round(tempo_map.seconds(start) * 1000)
+            end_ms = round(tempo_map.seconds(end) * 1000)
+            flat += [start_ms - previous, end_ms - start_ms, pitch, velocity]
+            previous = start_ms
+            duration = max(duration, end_ms / 1000)
+        event_parts.append({'name': part_name, 'channel': channel, 'notes': flat})
+
+    opening_tick, opening_tempo = min(tempo_changes, default=(0, DEFAULT_TEMPO))
+    tempo = round(60e6 / (opening_tempo if opening_tick == 0 else DEFAULT_TEMPO), 2)
+    duration = round(duration, 3)
+    return {
+        'duration': duration,
+        'tempo': tempo,
+        'track_names': track_names,
+        'part_names': [part['name'] for part in event_parts],
+        'events': {'duration': round(duration * 1000), 'tempo': tempo, 'parts': event_parts},
+    }
+
+
+def compress_events(events):
+    """The note events as gzip-compressed JSON, ready to be served as is."""
+    return gzip.compress(json.dumps(events, separators=(',', ':')).encode(), compresslevel=9, mtime=0)
@@ -0,0 +1,59 @@
+import django.db.models.deletion
+import ucath_songs.search
+from django.db import migrations, models
+
+# The index as first created; 0018 rebuilds it with the current columns
+FTS_TABLE = 'ucath_songs_song_fts'
+FTS_COLUMNS = ('title', 'composer', 'arranged_by', 'part_of_mass', 'season')
+FTS_RANK = 'bm25(10.0, 5.0, 3.0, 1.0, 1.0)'
+
+
+def create_fts_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute(
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+        f"{', '.join(FTS_COLUMNS)}, tokenize = 'unicode61 remove_diacritics 2')"
+    )
+    schema_editor.execute(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rank) VALUES ('rank', '{FTS_RANK}')")
+    rows = [
+        (
+            song.pk, song.title, song.composer, song.arranged_by,
+            f'{song.part_of_mass} {song.get_part_of_mass_display()}',
+            f'{song.season} {song.get_season_display()}',
+        )
+        for song in apps.get_model('ucath_songs', 'Song').objects.iterator()
+    ]
+    with schema_editor.connection.cursor() as cursor:
+        cursor.executemany(
+            f'INSERT INTO {FTS_TABLE} (rowid, {", ".join(FTS_COLUMNS)}) VALUES (%s, %s, %s, %s, %s, %s)', rows
+        )
+
+
+def drop_fts_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute(f'DROP TABLE IF EXISTS {FTS_TABLE}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ucath_songs', '0010_alter_song_mto_number'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_fts_index, drop_fts_index),
+        migrations.CreateModel(
+            name='SongSearchIndex',
+            fields=[
+                ('song', models.OneToOneField(db_column='rowid', on_delete=django.db.models.deletion.DO_NOTHING, primary_key=True, related_name='search_index', serialize=False, to='ucath_songs.song')),
+                ('document', ucath_songs.search.SearchDocumentField(db_column='ucath_songs_song_fts')),
+                ('rank', models.FloatField()),
+            ],
+            options={
+                'db_table': 'ucath_songs_song_fts',
+                'managed': False,
+            },
+        ),
+    ]
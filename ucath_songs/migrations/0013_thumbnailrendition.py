@@ -0,0 +1,30 @@
+# Generated by Django 6.0 on 2026-10-18 03:07
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ucath_songs', '0012_thumbnailjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ThumbnailRendition',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('size', models.CharField(choices=[('sm', 'Small'), ('md', 'Medium'), ('lg', 'Large')])),
+                ('format', models.CharField(choices=[('webp', 'WebP'), ('jpeg', 'JPEG')])),
+                ('image', models.FileField(upload_to='music_thumbnails/')),
+                ('width', models.PositiveIntegerField()),
+                ('height', models.PositiveIntegerField()),
+                ('sheet', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='renditions', to='ucath_songs.musicsheet')),
+            ],
+            options={
+                'ordering': ['width'],
+                'constraints': [models.UniqueConstraint(fields=('sheet', 'size', 'format'), name='unique_sheet_rendition')],
+            },
+        ),
+    ]
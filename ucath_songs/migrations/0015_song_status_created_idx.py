@@ -0,0 +1,17 @@
+# Generated by Django 6.0 on 2026-10-18 03:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ucath_songs', '0014_storedblob'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='song',
+            index=models.Index(fields=['status', '-created_at', '-id'], name='song_status_created_idx'),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 6.0 on 2026-10-18 03:32
+
+from django.db import migrations, models
+
+from ucath_songs.search import FTS_COLUMNS, FTS_RANK, FTS_TABLE, rebuild_index
+
+
+def recreate_fts_index(apps, schema_editor):
+    # FTS5 tables cannot gain columns, so the index is rebuilt with lyrics
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute(f'DROP TABLE IF EXISTS {FTS_TABLE}')
+    schema_editor.execute(
+        f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5("
+        f"{', '.join(FTS_COLUMNS)}, tokenize = 'unicode61 remove_diacritics 2')"
+    )
+    schema_editor.execute(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rank) VALUES ('rank', '{FTS_RANK}')")
+    rebuild_index(apps.get_model('ucath_songs', 'Song'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ucath_songs', '0017_filedeletion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='musicsheet',
+            name='page_count',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='musicsheet',
+            name='page_height',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='musicsheet',
+            name='page_width',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='musicsheet',
+            name='text_content',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.RunPython(recreate_fts_index, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 6.0 on 2026-10-18 03:35
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+from ucath_songs.search import rebuild_index
+
+
+def index_trigrams(apps, schema_editor):
+    rebuild_index(apps.get_model('ucath_songs', 'Song'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ucath_songs', '0018_musicsheet_details'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SongTrigram',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('trigram', models.CharField(max_length=3)),
+                ('song', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='trigrams', to='ucath_songs.song')),
+            ],
+            options={
+                'db_table': 'ucath_songs_songtrigram',
+                'indexes': [models.Index(fields=['trigram', 'song'], name='song_trigram_idx')],
+            },
+        ),
+        migrations.RunPython(index_trigrams, migrations.RunPython.noop),
+    ]
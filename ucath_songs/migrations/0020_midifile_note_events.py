@@ -0,0 +1,38 @@
+# Generated by Django 6.0 on 2026-10-18 04:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ucath_songs', '0019_songtrigram'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='midifile',
+            name='duration',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='midifile',
+            name='note_events',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='midifile',
+            name='part_names',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.AddField(
+            model_name='midifile',
+            name='tempo',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='midifile',
+            name='track_names',
+            field=models.JSONField(blank=True, default=list),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 6.0 on 2026-10-18 04:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ucath_songs', '0020_midifile_note_events'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='musicsheet',
+            name='thumbnail_rendered_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='musicsheet',
+            name='thumbnail_settings',
+            field=models.CharField(blank=True, default='', max_length=16),
+        ),
+    ]
@@ -4,15 +4,42 @@ from django.db import models
 from django.contrib.auth.models import User
 import secrets
 import string
-import fitz 
 import os
+import uuid
+from datetime import timedelta
 from django.core.files.base import ContentFile
-from io import BytesIO
-from PIL import Image
+from django.urls import reverse
+from django.utils import timezone
 from .utils import generate_bs64_slug, generate_archive_id
+from .search import FTS_TABLE, TRIGRAM_TABLE, SearchDocumentField, index_songs
+from .metrics import timed
+from .midi import MidiError, compress_events, parse_midi
+from .thumbnails import FALLBACK_RENDITION, RENDITION_FORMATS, RENDITION_WIDTHS, process_pdf, render_settings, rendition_name
 
 # Create your models here.
 
+class SongQuerySet(models.QuerySet):
+
+    def with_card_assets(self):
+        # Song grid cards need the first sheet (thumbnail) and first audio of
+        # every song; prefetch them so a page costs the same number of queries
+        # no matter how many cards it shows.
+        return self.prefetch_related(
+            models.Prefetch(
+                'musicsheet_set',
+                queryset=MusicSheet.objects.order_by('pk').prefetch_related('renditions'),
+                to_attr='card_sheets',
+            ),
+            models.Prefetch('mp3file_set', queryset=Mp3File.objects.order_by('pk'), to_attr='card_audios'),
+        ).annotate(
+            # Shown on the card; read from the first parsed MIDI file, not the file itself
+            midi_duration=models.Subquery(
+                MidiFile.objects.filter(song=models.OuterRef('pk'), duration__isnull=False)
+                .order_by('pk').values('duration')[:1]
+            ),
+        )
+
+
 class Song(models.Model):
 
     season_choices = [
@@ -63,8 +90,16 @@ class Song(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = SongQuerySet.as_manager()
+
     class Meta:
         ordering = ["created_at"]
+        indexes = [
+            # Published listings (landing, library, keyset pages) and the
+            # admin arrivals queue both walk this index in order, so neither
+            # needs a sort. Season and part filters are checked on the way.
+            models.Index(fields=['status', '-created_at', '-id'], name='song_status_created_idx'),
+        ]
 
     @property
     def prp_song_title(self):
@@ -80,6 +115,7 @@ class Song(models.Model):
             self.archive_id = generate_archive_id()
 
         super().save(*args, **kwargs)
+        index_songs([self])
 
 
 
@@ -88,75 +124,407 @@ class Song(models.Model):
     
 
 
-class MusicSheet(models.Model):
+class SongSearchIndex(models.Model):
+    """Read side of the FTS5 table maintained by search.py (SQLite only)."""
+    song = models.OneToOneField(Song, on_delete=models.DO_NOTHING, primary_key=True, db_column='rowid', related_name='search_index')
+    document = SearchDocumentField(db_column=FTS_TABLE)
+    rank = models.FloatField()
+
+    class Meta:
+        managed = False
+        db_table = FTS_TABLE
+
+
+class SongTrigram(models.Model):
+    """A trigram of a song's folded title or composer, written by search.index_songs."""
+    # No constraint: songs are deleted in bulk, and remove_songs clears these rows
+    song = models.ForeignKey(Song, on_delete=models.DO_NOTHING, db_constraint=False, related_name='trigrams')
+    trigram = models.CharField(max_length=3)
+
+    class Meta:
+        db_table = TRIGRAM_TABLE
+        indexes = [
+            # Fuzzy lookups read (trigram -> song) from this index alone
+            models.Index(fields=['trigram', 'song'], name='song_trigram_idx'),
+        ]
+
+
+class ServedAsset:
+    """Links an asset's file to the serve_asset view (range and 304 aware)."""
+    asset_type = None
+    file_field = None
+
+    @property
+    def asset_file(self):
+        return getattr(self, self.file_field)
+
+    @property
+    def serve_url(self):
+        return reverse('serve_asset', args=[self.asset_type, self.pk, os.path.basename(self.asset_file.name)])
+
+
+class MusicSheet(ServedAsset, models.Model):
+    asset_type = 'sheet'
+    file_field = 'music_sheet'
+
+
     song = models.ForeignKey(Song, on_delete=models.CASCADE)
     music_sheet = models.FileField(upload_to='music_sheets/')
     thumbnail = models.ImageField(upload_to='music_thumbnails/', null=True, blank=True)
     ms_version = models.CharField(max_length=256, null=True, blank=True)
     slug = models.SlugField(max_length=220, unique=True, null=True, blank=True)
+    # Read from the PDF along with the thumbnail; sizes are in points
+    page_count = models.PositiveIntegerField(null=True, blank=True)
+    page_width = models.FloatField(null=True, blank=True)
+    page_height = models.FloatField(null=True, blank=True)
+    text_content = models.TextField(blank=True, default='')
+    # The render_settings() the renditions were made with, and when
+    thumbnail_settings = models.CharField(max_length=16, blank=True, default='')
+    thumbnail_rendered_at = models.DateTimeField(null=True, blank=True)
+
+    details_fields = ['page_count', 'page_width', 'page_height', 'text_content']
+    rendering_fields = ['thumbnail', 'thumbnail_settings', 'thumbnail_rendered_at']
 
     def save(self, *args, **kwargs):
         if not self.slug:
             self.slug = generate_bs64_slug()
         super().save(*args, **kwargs)
         
-        # 2. Generate thumbnail if missing
-        if self.music_sheet and not self.thumbnail:
-            self.generate_thumbnail()
-        
+        # Thumbnails are rendered by the thumbnail_worker command, not here
+        if self.music_sheet and not self.thumbnail and not self.reuse_renditions():
+            self.enqueue_thumbnail()
+
+    def reuse_renditions(self):
+        """
+        Share the renditions of another sheet stored under the same file
+        name (i.e. the same content hash) instead of rendering again.
+        """
+        twin = MusicSheet.objects.filter(
+            music_sheet=self.music_sheet.name,
+            renditions__size=FALLBACK_RENDITION[0],
+            renditions__format=FALLBACK_RENDITION[1],
+        ).exclude(pk=self.pk).prefetch_related('renditions').first()
+        if twin is None:
+            return False
+
+        storage = self.thumbnail.storage
+        copies = []
+        for rendition in twin.renditions.all():
+            if hasattr(storage, 'add_reference'):
+                storage.add_reference(rendition.image.name)
+            copies.append(ThumbnailRendition(
+                sheet=self, size=rendition.size, format=rendition.format,
+                image=rendition.image.name, width=rendition.width, height=rendition.height,
+            ))
+        ThumbnailRendition.objects.bulk_create(copies)
+        # Same file, same renditions, pages and text
+        for field in [*self.rendering_fields, *self.details_fields]:
+            setattr(self, field, getattr(twin, field))
+        super().save(update_fields=[*self.rendering_fields, *self.details_fields])
+        if self.text_content:
+            index_songs([self.song])
+        return True
+
+    def enqueue_thumbnail(self):
+        if not self.thumbnail_jobs.filter(status__in=['pending', 'running']).exists():
+            ThumbnailJob.objects.create(sheet=self)
+
+    def save_renditions(self, renditions):
+        """Replace this sheet's thumbnail renditions with freshly rendered ones."""
+        old_names = {rendition.image.name for rendition in self.renditions.all()}
+        # Their files are released by the post_delete receiver (signals.py)
+        self.renditions.all().delete()
+        # A thumbnail from before renditions existed is its own file
+        if self.thumbnail and self.thumbnail.name not in old_names:
+            self.thumbnail.delete(save=False)
+
+        created = []
+        for item in renditions:
+            rendition = ThumbnailRendition(
+                sheet=self, size=item['size'], format=item['format'], width=item['width'], height=item['height']
+            )
+            name = rendition_name(self.music_sheet.name, item['size'], item['ext'])
+            rendition.image.save(name, ContentFile(item['data']), save=False)
+            created.append(rendition)
+        ThumbnailRendition.objects.bulk_create(created)
+
+        # thumbnail shares the medium JPEG file so plain <img> users keep working
+        fallback = next(r for r in created if (r.size, r.format) == FALLBACK_RENDITION)
+        self.thumbnail.name = fallback.image.name
+        self.thumbnail_settings = render_settings()
+        self.thumbnail_rendered_at = timezone.now()
+        super().save(update_fields=self.rendering_fields)
+
+    def outdated_thumbnail(self, settings=None):
+        """
+        Why the renditions need rendering again: 'missing', 'settings' (made
+        with other render settings) or 'stale' (the PDF changed since), or
+        None when they are current. Uses prefetched renditions if there are.
+        """
+        storage = self.music_sheet.storage
+        renditions = {(rendition.size, rendition.format): rendition for rendition in self.renditions.all()}
+        expected = {(size, fmt) for size in RENDITION_WIDTHS for fmt in RENDITION_FORMATS}
+        if (not self.thumbnail or set(renditions) != expected
+                or not all(storage.exists(rendition.image.name) for rendition in renditions.values())):
+            return 'missing'
+        if self.thumbnail_settings != (settings or render_settings()):
+            return 'settings'
+        if self.thumbnail_rendered_at is None or storage.get_modified_time(self.music_sheet.name) > self.thumbnail_rendered_at:
+            return 'stale'
+        return None
+
+    def save_details(self, details):
+        """Store the page count, size and text read from the PDF and reindex the song."""
+        for field in self.details_fields:
+            setattr(self, field, details[field])
+        super().save(update_fields=self.details_fields)
+        index_songs([self.song])
+
     def generate_thumbnail(self):
-        try:
-            # Open the PDF directly from the file path
-            doc = fitz.open(self.music_sheet.path)
-            
-            # Load the first page (0-indexed)
-            page = doc.load_page(0)
-            
-            # Create a 'pixmap' (image) of the page
-            # We use a matrix to increase resolution (2.0 = 2x zoom for clarity)
-            zoom = 2.0 
-            mat = fitz.Matrix(zoom, zoom)
-            pix = page.get_pixmap(matrix=mat)
-            
-            # Convert to PIL Image to handle the JPEG conversion easily
-            img_data = pix.tobytes("jpg")
-            img = Image.open(BytesIO(img_data))
-            
-            # Save to buffer
-            temp_thumb = BytesIO()
-            img.save(temp_thumb, format='JPEG', quality=85)
-            temp_thumb.seek(0)
-            
-            # Naming
-            thumb_name = os.path.basename(self.music_sheet.name).rsplit('.', 1)[0] + '_thumb.jpg'
-            
-            # Save to field
-            self.thumbnail.save(thumb_name, ContentFile(temp_thumb.read()), save=False)
-            super().save(update_fields=['thumbnail'])
-            
-            doc.close()
-        except Exception as e:
-            print(f"Thumbnail generation failed: {e}")
+        """Render and store the thumbnail renditions and details in-process (blocking)."""
+        with timed('render'):
+            renditions, details = process_pdf(self.music_sheet.path)
+        self.save_renditions(renditions)
+        self.save_details(details)
+
+    def srcset(self, fmt):
+        return ', '.join(
+            f'{rendition.image.url} {rendition.width}w'
+            for rendition in self.renditions.all() if rendition.format == fmt
+        )
+
+    @property
+    def webp_srcset(self):
+        return self.srcset('webp')
+
+    @property
+    def jpeg_srcset(self):
+        return self.srcset('jpeg')
 
 
     def __str__(self) -> str:  # pragma: no cover
         return f"Music sheet for {self.song} - {self.ms_version}"
     
     
-class MidiFile(models.Model):
+class ThumbnailRendition(models.Model):
+    """One size/format of a MusicSheet's first-page preview."""
+
+    rendition_sizes = [
+        ('sm', 'Small'),
+        ('md', 'Medium'),
+        ('lg', 'Large'),
+    ]
+
+    rendition_formats = [
+        ('webp', 'WebP'),
+        ('jpeg', 'JPEG'),
+    ]
+
+    sheet = models.ForeignKey(MusicSheet, on_delete=models.CASCADE, related_name='renditions')
+    size = models.CharField(choices=rendition_sizes)
+    format = models.CharField(choices=rendition_formats)
+    image = models.FileField(upload_to='music_thumbnails/')
+    width = models.PositiveIntegerField()
+    height = models.PositiveIntegerField()
+
+    class Meta:
+        ordering = ['width']
+        constraints = [
+            models.UniqueConstraint(fields=['sheet', 'size', 'format'], name='unique_sheet_rendition'),
+        ]
+
+    def __str__(self) -> str:  # pragma: no cover
+        return f"{self.get_size_display()} {self.get_format_display()} rendition of {self.sheet}"
+
+
+class MidiFile(ServedAsset, models.Model):
+    asset_type = 'midi'
+    file_field = 'midi_file'
+
+
     song = models.ForeignKey(Song, on_delete=models.CASCADE)
     midi_file = models.FileField(upload_to='midi_files/')
     midi_version = models.CharField(max_length=256, null=True, blank=True)
     midi_link = models.CharField(max_length=300, null=True, blank=True)
+    # Read from the file once, on upload (see midi.py); duration in seconds
+    duration = models.FloatField(null=True, blank=True)
+    tempo = models.FloatField(null=True, blank=True)
+    track_names = models.JSONField(default=list, blank=True)
+    part_names = models.JSONField(default=list, blank=True)
+    # Gzip-compressed note-event JSON, served as is by serve_note_events
+    note_events = models.BinaryField(null=True, blank=True, editable=False)
+
+    details_fields = ['duration', 'tempo', 'track_names', 'part_names', 'note_events']
+    # midi_file's name when loaded, to notice a replaced file
+    stored_file_name = None
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.stored_file_name = dict(zip(field_names, values)).get('midi_file')
+        return instance
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding and self.midi_file.name != self.stored_file_name:
+            # The details describe the old file, and events_url would serve
+            # them under the new file's name; read the new one instead
+            self.duration = self.tempo = self.note_events = None
+            self.track_names, self.part_names = [], []
+            if kwargs.get('update_fields') is not None:
+                kwargs['update_fields'] = {*kwargs['update_fields'], *self.details_fields}
+        super().save(*args, **kwargs)
+        self.stored_file_name = self.midi_file.name
+        if self.midi_file and self.duration is None:
+            try:
+                self.read_events()
+            except (MidiError, OSError):
+                # Still downloadable, just not playable in the browser
+                pass
+
+    def read_events(self):
+        """Parse the MIDI file and store its details and note events."""
+        self.parse_events()
+        super().save(update_fields=self.details_fields)
+
+    def parse_events(self):
+        """Set the details and note events from the MIDI file, without saving (e.g. before bulk_create)."""
+        with self.midi_file.open('rb') as handle:
+            details = parse_midi(handle.read())
+        for field in self.details_fields[:-1]:
+            setattr(self, field, details[field])
+        self.note_events = compress_events(details['events'])
+
+    @property
+    def events_url(self):
+        if self.duration is None:
+            return None
+        stem = os.path.splitext(os.path.basename(self.midi_file.name))[0]
+        return reverse('serve_note_events', args=[self.pk, f'{stem}.json'])
 
     def __str__(self) -> str:  # pragma: no cover
         return f"MIDI File for {self.song} - {self.midi_version}"
 
 
-class Mp3File(models.Model):
+class Mp3File(ServedAsset, models.Model):
+    asset_type = 'audio'
+    file_field = 'mp3_file'
+
+
     song = models.ForeignKey(Song, on_delete=models.CASCADE)
     mp3_file = models.FileField(upload_to='mp3_files/')
     mp3_version = models.CharField(max_length=256, null=True, blank=True)
 
     def __str__(self) -> str:  # pragma: no cover
         return f"Mp3 File for {self.song} - {self.mp3_version}"
+
+
+class ThumbnailJob(models.Model):
+    """A queued thumbnail render for a MusicSheet, run by thumbnail_worker."""
+
+    job_status = [
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ]
+
+    sheet = models.ForeignKey(MusicSheet, on_delete=models.CASCADE, related_name='thumbnail_jobs')
+    status = models.CharField(choices=job_status, default='pending')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    max_attempts = models.PositiveSmallIntegerField(default=3)
+    last_error = models.TextField(blank=True, default='')
+    run_after = models.DateTimeField(default=timezone.now)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    retry_delay = timedelta(seconds=30)
+
+    class Meta:
+        ordering = ['run_after']
+        indexes = [models.Index(fields=['status', 'run_after'])]
+
+    @classmethod
+    def claim_batch(cls, limit):
+        """Mark up to ``limit`` due jobs as running and return them."""
+        claimed = []
+        due = cls.objects.filter(status='pending', run_after__lte=timezone.now()).values_list('pk', flat=True)[:limit]
+        for pk in due:
+            # Conditional update so two workers never take the same job
+            if cls.objects.filter(pk=pk, status='pending').update(
+                status='running', attempts=models.F('attempts') + 1, started_at=timezone.now()
+            ):
+                claimed.append(pk)
+        return list(cls.objects.filter(pk__in=claimed).select_related('sheet'))
+
+    @classmethod
+    def requeue_stale(cls, older_than):
+        """Put back jobs left running by a worker that died mid-render."""
+        return cls.objects.filter(status='running', started_at__lt=timezone.now() - older_than).update(status='pending')
+
+    def mark_done(self):
+        ThumbnailJob.objects.filter(pk=self.pk).update(status='done', last_error='', finished_at=timezone.now())
+
+    def mark_failed(self, error):
+        if self.attempts < self.max_attempts:
+            # Back off 30s, 60s, 120s, ... before the next attempt
+            changes = {'status': 'pending', 'run_after': timezone.now() + self.retry_delay * 2 ** (self.attempts - 1)}
+        else:
+            changes = {'status': 'failed', 'finished_at': timezone.now()}
+        ThumbnailJob.objects.filter(pk=self.pk).update(last_error=f'{type(error).__name__}: {error}', **changes)
+
+    def __str__(self) -> str:  # pragma: no cover
+        return f"Thumbnail job for {self.sheet} - {self.status}"
+
+
+class StoredBlob(models.Model):
+    """A file kept once by ContentAddressedStorage and the number of fields using it."""
+    name = models.CharField(max_length=255, unique=True)
+    sha256 = models.CharField(max_length=64, db_index=True)
+    size = models.BigIntegerField()
+    ref_count = models.PositiveIntegerField(default=0)
+
+    def __str__(self) -> str:  # pragma: no cover
+        return f"{self.name} ({self.ref_count} references)"
+
+
+class FileDeletion(models.Model):
+    """A stored file name queued for release by a bulk delete (see moderation.py)."""
+    name = models.CharField(max_length=255)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self) -> str:  # pragma: no cover
+        return f"Queued deletion of {self.name}"
+
+
+class ChunkedUpload(models.Model):
+    """A file sent in resumable chunks (see uploads.py) before it becomes an asset."""
+
+    upload_kinds = [
+        ('sheet', 'Music Sheet'),
+        ('audio', 'Audio'),
+        ('midi', 'MIDI'),
+    ]
+
+    upload_status = [
+        ('uploading', 'Uploading'),
+        ('complete', 'Complete'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)
+    kind = models.CharField(choices=upload_kinds)
+    filename = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    offset = models.BigIntegerField(default=0)
+    status = models.CharField(choices=upload_status, default='uploading')
+    # Stored file name once complete; the upload holds its blob reference until claimed
+    file = models.CharField(max_length=255, blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['updated_at'])]
+
+    def __str__(self) -> str:  # pragma: no cover
+        return f"{self.filename} ({self.offset}/{self.size} bytes, {self.status})"
@@ -0,0 +1,136 @@
+"""
+Bulk moderation of songs from the arrivals queue.
+
+Every action is one UPDATE, or one DELETE per table, inside a
+transaction. The tables to delete from follow the models' CASCADE
+relations to Song, so a new child model is removed too. Queryset updates
+and SQL deletes send no signals, so the search index and the page cache
+are brought up to date here, once per action instead of once per row.
+Files of deleted songs are not removed inline: each stored name is
+queued as a FileDeletion and released later by purge_queued_files (the
+purge_files command).
+"""
+from django.core.files.storage import default_storage
+from django.db import connection, models, transaction
+from django.utils import timezone
+
+from .caching import invalidate_songs
+from .models import Song, MusicSheet, MidiFile, Mp3File, ThumbnailRendition, FileDeletion
+from .search import index_songs, remove_songs
+
+PURGE_BATCH_SIZE = 500
+
+
+def update_songs(song_ids, **changes):
+    """Apply ``changes`` to the given songs in one UPDATE; return how many changed."""
+    with transaction.atomic():
+        songs = Song.objects.filter(pk__in=song_ids)
+        slugs = list(songs.values_list('slug', flat=True))
+        updated = songs.update(updated_at=timezone.now(), **changes)
+        if 'season' in changes:
+            index_songs(songs)
+    invalidate_songs(slugs)
+    return updated
+
+
+def publish_songs(song_ids):
+    return update_songs(song_ids, status='published')
+
+
+def unpublish_songs(song_ids):
+    return update_songs(song_ids, status='pending_approval')
+
+
+def move_songs_to_season(song_ids, season):
+    return update_songs(song_ids, season=season)
+
+
+def queued_file_names(song_ids):
+    """Every stored file name the given songs' assets hold a reference to."""
+    sheets = MusicSheet.objects.filter(song__in=song_ids)
+    names = list(sheets.values_list('music_sheet', flat=True))
+    renditions = ThumbnailRendition.objects.filter(sheet__song__in=song_ids)
+    names += renditions.values_list('image', flat=True)
+    # A thumbnail from before renditions existed is its own file; otherwise
+    # it borrows the fallback rendition's reference (see save_renditions)
+    names += sheets.filter(renditions__isnull=True).values_list('thumbnail', flat=True)
+    names += Mp3File.objects.filter(song__in=song_ids).values_list('mp3_file', flat=True)
+    names += MidiFile.objects.filter(song__in=song_ids).values_list('midi_file', flat=True)
+    return [name for name in names if name]
+
+
+def delete_songs(song_ids):
+    """Delete the given songs and their assets; return how many songs went."""
+    with transaction.atomic():
+        songs = Song.objects.filter(pk__in=song_ids)
+        song_ids, slugs = [], []
+        for pk, slug in songs.values_list('pk', 'slug'):
+            song_ids.append(pk)
+            slugs.append(slug)
+        if not song_ids:
+            return 0
+
+        FileDeletion.objects.bulk_create(
+            FileDeletion(name=name) for name in queued_file_names(song_ids)
+        )
+        # Children first, each in a single statement without the collector's
+        # per-row fetches and delete signals
+        placeholders = ', '.join(['%s'] * len(song_ids))
+        with connection.cursor() as cursor:
+            for model, chain in [*cascade_chains(Song), (Song, ())]:
+                cursor.execute(
+                    f'DELETE FROM {connection.ops.quote_name(model._meta.db_table)} '
+                    f'WHERE {song_filter(model, chain, placeholders)}',
+                    song_ids,
+                )
+            deleted = cursor.rowcount
+        remove_songs(song_ids)
+    invalidate_songs(slugs)
+    return deleted
+
+
+def cascade_chains(model, chain=()):
+    """
+    Every model whose rows go when ``model``'s rows are deleted, children
+    first, as ``(model, chain)``; ``chain`` is the foreign keys leading
+    from that model up to Song. DO_NOTHING relations are skipped: their
+    owners clean up (the search index tables, through remove_songs).
+    """
+    chains = []
+    for relation in model._meta.related_objects:
+        if relation.on_delete is models.DO_NOTHING:
+            continue
+        if relation.on_delete is not models.CASCADE:
+            raise ValueError(
+                f'{relation.related_model.__name__}.{relation.field.name} neither cascades nor '
+                'does nothing on delete, so delete_songs cannot remove it in bulk.'
+            )
+        child_chain = (relation.field, *chain)
+        chains += cascade_chains(relation.related_model, child_chain)
+        chains.append((relation.related_model, child_chain))
+    return chains
+
+
+def song_filter(model, chain, placeholders):
+    """SQL condition selecting the rows of ``model`` of the songs in ``placeholders``."""
+    quote = connection.ops.quote_name
+    if not chain:
+        return f'{quote(model._meta.pk.column)} IN ({placeholders})'
+    field, parent = chain[0], chain[0].related_model
+    if parent is Song:
+        return f'{quote(field.column)} IN ({placeholders})'
+    return (
+        f'{quote(field.column)} IN (SELECT {quote(field.target_field.column)} '
+        f'FROM {quote(parent._meta.db_table)} WHERE {song_filter(parent, chain[1:], placeholders)})'
+    )
+
+
+def purge_queued_files(limit=PURGE_BATCH_SIZE):
+    """Release up to ``limit`` queued files from storage; return how many."""
+    purged = 0
+    for deletion in FileDeletion.objects.order_by('pk')[:limit]:
+        # Claim the row first, so two purgers never release a reference twice
+        if FileDeletion.objects.filter(pk=deletion.pk).delete()[0]:
+            default_storage.delete(deletion.name)
+            purged += 1
+    return purged
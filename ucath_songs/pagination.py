@@ -0,0 +1,72 @@
+"""
+Keyset (cursor) pagination.
+
+Each page is fetched with ``WHERE (sort key) after (last row's key) LIMIT
+n + 1`` instead of ``OFFSET``. That costs the same at any depth and needs
+no COUNT query. Cursors are signed so clients cannot forge filter values.
+"""
+from datetime import datetime
+
+from django.core import signing
+from django.db.models import Q
+from django.http import Http404
+
+CURSOR_SALT = 'ucath_songs.pagination.cursor'
+
+
+class KeysetPage:
+
+    def __init__(self, object_list, next_cursor):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+
+class KeysetPaginator:
+    """
+    Paginate ``queryset`` by ``ordering`` (e.g. ``['-created_at', '-id']``),
+    which must end in a unique field so every row has a distinct key.
+    """
+
+    def __init__(self, queryset, per_page, ordering):
+        self.queryset = queryset.order_by(*ordering)
+        self.per_page = per_page
+        self.ordering = [(field.lstrip('-'), field.startswith('-')) for field in ordering]
+
+    def page(self, cursor=None):
+        queryset = self.queryset
+        if cursor:
+            queryset = queryset.filter(self.after(self.decode(cursor)))
+        rows = list(queryset[:self.per_page + 1])
+        if len(rows) <= self.per_page:
+            return KeysetPage(rows, None)
+        rows = rows[:self.per_page]
+        return KeysetPage(rows, self.encode(rows[-1]))
+
+    def after(self, values):
+        # (a, b, c) after (x, y, z) == a > x OR (a = x AND b > y) OR ...
+        condition = Q()
+        for index, (field, descending) in enumerate(self.ordering):
+            equal = {name: values[position] for position, (name, _) in enumerate(self.ordering[:index])}
+            lookup = f'{field}__lt' if descending else f'{field}__gt'
+            condition |= Q(**equal, **{lookup: values[index]})
+        return condition
+
+    def encode(self, row):
+        values = []
+        for field, _ in self.ordering:
+            value = getattr(row, field)
+            values.append(value.isoformat() if isinstance(value, datetime) else value)
+        return signing.dumps(values, salt=CURSOR_SALT, compress=True)
+
+    def decode(self, cursor):
+        try:
+            values = signing.loads(cursor, salt=CURSOR_SALT)
+        except signing.BadSignature:
+            raise Http404('Invalid page cursor.')
+        if not isinstance(values, list) or len(values) != len(self.ordering):
+            raise Http404('Invalid page cursor.')
+        return values
@@ -0,0 +1,234 @@
+"""
+Full-text and fuzzy search for the song catalog.
+
+Songs are mirrored into an SQLite FTS5 table (created in migration 0011,
+with the lyrics column since 0018) whose rowid is the song id. The lyrics
+column holds the text layers of the song's sheets. Queries join the table
+through the unmanaged SongSearchIndex model so MATCH and rank are
+evaluated once per query.
+
+For misspellings, the trigrams of each song's case- and diacritic-folded
+title and composer are kept in the SongTrigram table (since 0019). A query
+that matches nothing as typed falls back to the songs sharing the most
+trigrams with it.
+
+Song.save, the sheet text extraction and the post_delete signals keep both
+in sync; anything that bypasses them (bulk_create, queryset.update) must
+call index_songs itself.
+"""
+import math
+import re
+import unicodedata
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db import connection
+from django.db.models import Count, F, FloatField, Lookup, OuterRef, Q, Subquery, TextField
+from django.db.models.functions import Cast
+
+FTS_TABLE = 'ucath_songs_song_fts'
+FTS_COLUMNS = ('title', 'composer', 'arranged_by', 'part_of_mass', 'season', 'lyrics')
+# bm25 weights, in FTS_COLUMNS order: a title hit outranks a season hit.
+FTS_RANK = 'bm25(10.0, 5.0, 3.0, 1.0, 1.0, 2.0)'
+
+TRIGRAM_TABLE = 'ucath_songs_songtrigram'
+# Share of a query's trigrams a title or composer needs for a fuzzy match
+FUZZY_THRESHOLD = 0.5
+# Most similar songs considered per fuzzy query; the rest are noise anyway
+FUZZY_LIMIT = 200
+
+INDEX_CHUNK_SIZE = 2000
+TOKEN_RE = re.compile(r'\w+')
+
+
+class SearchDocumentField(TextField):
+    """The FTS5 hidden column named after the table; only used with __match."""
+
+
+@SearchDocumentField.register_lookup
+class Match(Lookup):
+    lookup_name = 'match'
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return f'{lhs} MATCH {rhs}', (*lhs_params, *rhs_params)
+
+
+def fts_enabled():
+    return connection.vendor == 'sqlite'
+
+
+def build_match_query(q):
+    # Every word must match, and the last letters typed may be incomplete,
+    # so each token becomes a quoted prefix query: "ky"* AND "gl"*.
+    return ' '.join(f'"{token}"*' for token in TOKEN_RE.findall(q or ''))
+
+
+def normalize(text):
+    """Case- and diacritic-folded words of ``text``: 'Kízito, J.' -> 'kizito j'."""
+    decomposed = unicodedata.normalize('NFKD', text or '')
+    folded = ''.join(char for char in decomposed if not unicodedata.combining(char)).casefold()
+    return ' '.join(TOKEN_RE.findall(folded))
+
+
+def trigrams(text):
+    """The distinct trigrams of the normalized words of ``text``: 'ave' -> ' av', 'ave', 've '."""
+    grams = set()
+    for word in normalize(text).split():
+        # One space of padding marks word edges. pg_trgm's second leading
+        # space would add a trigram per initial letter, which is in so many
+        # songs that it costs far more to look up than it helps to rank.
+        padded = f' {word} '
+        grams.update(padded[index:index + 3] for index in range(len(padded) - 2))
+    return grams
+
+
+def trigram_model(song_model):
+    try:
+        return song_model._meta.get_field('trigrams').related_model
+    except FieldDoesNotExist:
+        # Historical models from before migration 0019
+        return None
+
+
+def song_document(song, lyrics=''):
+    return (
+        song.pk,
+        song.title,
+        song.composer,
+        song.arranged_by,
+        f'{song.part_of_mass} {song.get_part_of_mass_display()}',
+        f'{song.season} {song.get_season_display()}',
+        lyrics,
+    )
+
+
+def song_lyrics(songs):
+    """The sheets' text layers of the given songs, joined per song id, in one query."""
+    # Through the songs' own model, so migrations index with historical models
+    sheet_model = songs[0]._meta.get_field('musicsheet').related_model
+    texts = {}
+    for song_id, text in sheet_model.objects.filter(
+        song__in=[song.pk for song in songs]
+    ).exclude(text_content='').order_by('pk').values_list('song', 'text_content'):
+        song_texts = texts.setdefault(song_id, [])
+        # Versions of one arrangement often share their words
+        if text not in song_texts:
+            song_texts.append(text)
+    return {song_id: ' '.join(song_texts) for song_id, song_texts in texts.items()}
+
+
+def index_trigrams(songs):
+    if trigram_model(type(songs[0])) is None:
+        return
+    rows = [(song.pk, gram) for song in songs for gram in trigrams(f'{song.title} {song.composer}')]
+    with connection.cursor() as cursor:
+        cursor.executemany(f'DELETE FROM {TRIGRAM_TABLE} WHERE song_id = %s', [(song.pk,) for song in songs])
+        cursor.executemany(f'INSERT INTO {TRIGRAM_TABLE} (song_id, trigram) VALUES (%s, %s)', rows)
+
+
+def index_songs(songs):
+    """Insert or refresh the index rows for the given songs."""
+    songs = list(songs)
+    if not songs:
+        return
+    index_trigrams(songs)
+    if not fts_enabled():
+        return
+    lyrics = song_lyrics(songs)
+    rows = [song_document(song, lyrics.get(song.pk, '')) for song in songs]
+    with connection.cursor() as cursor:
+        cursor.executemany(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [(row[0],) for row in rows])
+        cursor.executemany(
+            f'INSERT INTO {FTS_TABLE} (rowid, {", ".join(FTS_COLUMNS)}) '
+            f'VALUES ({", ".join(["%s"] * (len(FTS_COLUMNS) + 1))})',
+            rows,
+        )
+
+
+def remove_songs(song_ids):
+    rows = [(pk,) for pk in song_ids]
+    with connection.cursor() as cursor:
+        # SongTrigram has no database constraint, so deleting songs leaves its rows to us
+        cursor.executemany(f'DELETE FROM {TRIGRAM_TABLE} WHERE song_id = %s', rows)
+        if fts_enabled():
+            cursor.executemany(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', rows)
+
+
+def rebuild_index(song_model=None):
+    """Drop every index row and re-index the whole catalog in chunks."""
+    if song_model is None:
+        from .models import Song as song_model
+
+    with connection.cursor() as cursor:
+        if trigram_model(song_model) is not None:
+            cursor.execute(f'DELETE FROM {TRIGRAM_TABLE}')
+        if fts_enabled():
+            cursor.execute(f'DELETE FROM {FTS_TABLE}')
+
+    fields = [column for column in FTS_COLUMNS if column != 'lyrics']
+    songs = song_model.objects.only('pk', *fields).order_by('pk').iterator(chunk_size=INDEX_CHUNK_SIZE)
+    chunk = []
+    for song in songs:
+        chunk.append(song)
+        if len(chunk) == INDEX_CHUNK_SIZE:
+            index_songs(chunk)
+            chunk = []
+    index_songs(chunk)
+
+
+def fuzzy_search_songs(queryset, q, threshold=FUZZY_THRESHOLD, limited=True):
+    """
+    Filter a Song queryset down to the songs whose title and composer hold
+    at least ``threshold`` of the trigrams of ``q``, most shared first
+    (pg_trgm's word similarity). Candidates come from the trigram index,
+    limited to the queryset's songs, and only the FUZZY_LIMIT most similar
+    of them are ranked (all of them when not ``limited``, e.g. for
+    counts). Apply filters before searching, so songs the filters drop
+    never take a candidate's place.
+    """
+    grams = sorted(trigrams(q))
+    model = trigram_model(queryset.model)
+    if not grams or model is None:
+        return queryset.none()
+
+    shared = model.objects.filter(trigram__in=grams).values('song').annotate(shared=Count('pk'))
+    candidates = shared.filter(
+        song__in=queryset.order_by().values('pk'), shared__gte=math.ceil(threshold * len(grams))
+    ).order_by('-shared').values('song')
+    if limited:
+        candidates = candidates[:FUZZY_LIMIT]
+    similarity = Cast(Subquery(shared.filter(song=OuterRef('pk')).values('shared')), FloatField()) / len(grams)
+    return queryset.filter(pk__in=candidates).annotate(
+        search_rank=-similarity
+    ).order_by('search_rank', *queryset.query.order_by)
+
+
+def search_songs(queryset, q):
+    """
+    Filter a Song queryset down to the songs matching ``q``, best match
+    first. The queryset's own ordering is kept as the tie-breaker. When
+    nothing matches as typed, similarly spelled songs are returned.
+    """
+    songs = match_songs(queryset, q)
+    if q and not songs.exists():
+        return fuzzy_search_songs(queryset, q)
+    return songs
+
+
+def match_songs(queryset, q):
+    if not fts_enabled():
+        sheet_model = queryset.model._meta.get_field('musicsheet').related_model
+        return queryset.filter(
+            Q(title__icontains=q) | Q(composer__icontains=q) | Q(arranged_by__icontains=q) |
+            Q(part_of_mass__icontains=q) | Q(season__icontains=q) |
+            Q(pk__in=sheet_model.objects.filter(text_content__icontains=q).values('song'))
+        )
+
+    match = build_match_query(q)
+    if not match:
+        return queryset.none()
+
+    return queryset.filter(search_index__document__match=match).annotate(
+        search_rank=F('search_index__rank')
+    ).order_by('search_rank', *queryset.query.order_by)
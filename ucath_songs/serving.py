@@ -0,0 +1,251 @@
+"""
+Serving of stored media files with HTTP caching and byte ranges.
+
+Asset URLs carry the stored file name, and an upload never overwrites an
+existing name, so a URL always points at the same bytes. Responses can
+therefore be cached for a year. The ETag is a hash of the file content,
+computed once per file version and remembered in the cache. Data kept
+gzip-compressed in the database, such as MIDI note events, is served by
+serve_gzipped under the same kind of URL. Async views use aserve_file,
+which under ASGI streams files without tying up a thread per download.
+"""
+import asyncio
+import gzip
+import hashlib
+import io
+import os
+import re
+import zipfile
+
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.core.handlers.asgi import ASGIRequest
+from django.http import FileResponse, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils.http import content_disposition_header, http_date, parse_etags, parse_http_date_safe, quote_etag
+
+from .metrics import timed
+
+CHUNK_SIZE = 64 * 1024
+CACHE_CONTROL = 'public, max-age=31536000, immutable'
+# For URLs that keep pointing at the same asset even if its file changes
+REVALIDATE_CACHE_CONTROL = 'public, no-cache'
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+ACCEPTS_GZIP_RE = re.compile(r'\bgzip\b')
+
+
+def file_etag(path, stat):
+    key = f'ucath:etag:{path}:{stat.st_size}:{stat.st_mtime_ns}'
+    etag = cache.get(key)
+    if etag is None:
+        with timed('file'), open(path, 'rb') as handle:
+            etag = quote_etag(hashlib.file_digest(handle, 'sha256').hexdigest()[:32])
+        cache.set(key, etag, None)
+    return etag
+
+
+def parse_range(header, size):
+    """
+    Return the inclusive ``(start, end)`` of a single byte range, or None
+    when the whole file should be sent (no header, a malformed header or a
+    multi-range request). Raise ValueError when the range cannot be
+    satisfied.
+    """
+    match = RANGE_RE.match(header.strip())
+    if not match or match.group(1) == match.group(2) == '':
+        return None
+    first, last = match.groups()
+    if not first:
+        suffix = int(last)
+        if suffix == 0 or size == 0:
+            raise ValueError(header)
+        return max(size - suffix, 0), size - 1
+    start = int(first)
+    if last and int(last) < start:
+        return None
+    if start >= size:
+        raise ValueError(header)
+    return start, min(int(last), size - 1) if last else size - 1
+
+
+def is_not_modified(request, etag, mtime):
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        # Weak comparison, as RFC 9110 requires for If-None-Match
+        etags = [tag.removeprefix('W/') for tag in parse_etags(if_none_match)]
+        return '*' in etags or etag in etags
+    modified_since = parse_http_date_safe(request.headers.get('If-Modified-Since'))
+    return modified_since is not None and mtime is not None and int(mtime) <= modified_since
+
+
+def range_applies(request, etag, mtime):
+    # If-Range: only honour Range when the client's copy is still current
+    if_range = request.headers.get('If-Range')
+    if if_range is None:
+        return True
+    if if_range.startswith('"'):
+        return if_range == etag
+    return parse_http_date_safe(if_range) == int(mtime)
+
+
+def iter_file_range(path, start, length):
+    with open(path, 'rb') as handle:
+        handle.seek(start)
+        while length > 0:
+            chunk = handle.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+async def aiter_file_range(path, start, length):
+    """iter_file_range for ASGI: reads run in worker threads, so a slow client only holds a coroutine."""
+    handle = await asyncio.to_thread(open, path, 'rb')
+    try:
+        handle.seek(start)
+        while length > 0:
+            chunk = await asyncio.to_thread(handle.read, min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        handle.close()
+
+
+def serve_file(request, path, content_type, filename=None, as_attachment=False, cache_control=CACHE_CONTROL):
+    """Build a 200, 206, 304 or 416 response for the file at ``path``."""
+    stat = os.stat(path)
+    return file_response(
+        request, path, stat, file_etag(path, stat), content_type, filename, as_attachment, cache_control
+    )
+
+
+async def aserve_file(request, path, content_type, filename=None, as_attachment=False, cache_control=CACHE_CONTROL):
+    """
+    serve_file for async views. The stat and the ETag hash run in worker
+    threads. Under ASGI the body is an async iterator: Django would read a
+    synchronous one (a FileResponse) into memory before sending it. An
+    async view can also run under WSGI, where a FileResponse still goes out
+    through the server's file wrapper.
+    """
+    stat = await asyncio.to_thread(os.stat, path)
+    etag = await sync_to_async(file_etag, thread_sensitive=False)(path, stat)
+    return file_response(
+        request, path, stat, etag, content_type, filename, as_attachment, cache_control,
+        asynchronous=isinstance(request, ASGIRequest),
+    )
+
+
+def file_response(request, path, stat, etag, content_type, filename, as_attachment, cache_control, asynchronous=False):
+    headers = {
+        'ETag': etag,
+        'Last-Modified': http_date(stat.st_mtime),
+        'Cache-Control': cache_control,
+        'Accept-Ranges': 'bytes',
+    }
+
+    if is_not_modified(request, etag, stat.st_mtime):
+        response = HttpResponseNotModified()
+    else:
+        byte_range = None
+        range_header = request.headers.get('Range')
+        if range_header and range_applies(request, etag, stat.st_mtime):
+            try:
+                byte_range = parse_range(range_header, stat.st_size)
+            except ValueError:
+                response = HttpResponse(status=416)
+                response['Content-Range'] = f'bytes */{stat.st_size}'
+                return response
+
+        if byte_range is None and not asynchronous:
+            response = FileResponse(
+                open(path, 'rb'), content_type=content_type, as_attachment=as_attachment, filename=filename or ''
+            )
+        elif byte_range is None:
+            response = StreamingHttpResponse(aiter_file_range(path, 0, stat.st_size), content_type=content_type)
+            response['Content-Length'] = str(stat.st_size)
+            # Named like FileResponse names its files
+            response['Content-Disposition'] = content_disposition_header(
+                as_attachment, filename or os.path.basename(path)
+            )
+        else:
+            start, end = byte_range
+            chunks = (aiter_file_range if asynchronous else iter_file_range)(path, start, end - start + 1)
+            response = StreamingHttpResponse(chunks, status=206, content_type=content_type)
+            response['Content-Length'] = str(end - start + 1)
+            response['Content-Range'] = f'bytes {start}-{end}/{stat.st_size}'
+            disposition = content_disposition_header(as_attachment, filename)
+            if disposition:
+                response['Content-Disposition'] = disposition
+
+    for header, value in headers.items():
+        response[header] = value
+    return response
+
+
+def serve_gzipped(request, data, content_type, cache_control=CACHE_CONTROL):
+    """
+    Build a 200 or 304 response for ``data``, which is stored gzip-
+    compressed. Clients that accept gzip get the stored bytes as they are;
+    the rare one that does not gets them inflated.
+    """
+    digest = hashlib.sha256(data).hexdigest()[:32]
+    accepts_gzip = ACCEPTS_GZIP_RE.search(request.headers.get('Accept-Encoding', ''))
+    # Each encoding is its own representation, so each has its own ETag
+    etag = quote_etag(f'{digest}-gzip' if accepts_gzip else digest)
+    if is_not_modified(request, etag, None):
+        response = HttpResponseNotModified()
+    elif accepts_gzip:
+        response = HttpResponse(data, content_type=content_type)
+        response['Content-Encoding'] = 'gzip'
+    else:
+        response = HttpResponse(gzip.decompress(data), content_type=content_type)
+    response['ETag'] = etag
+    response['Cache-Control'] = cache_control
+    response['Vary'] = 'Accept-Encoding'
+    return response
+
+
+class ZipStreamBuffer(io.RawIOBase):
+    """Write-only, unseekable sink for ZipFile whose bytes are taken with drain()."""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def stream_zip(files):
+    """
+    Yield a ZIP archive of ``files`` ((archive name, path) pairs) as it is
+    built. Entries are stored uncompressed (PDF and MP3 barely shrink) with
+    their CRC and sizes in trailing data descriptors, so at most one read
+    chunk is held in memory and nothing is written to disk.
+    """
+    buffer = ZipStreamBuffer()
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_STORED) as archive:
+        for name, path in files:
+            info = zipfile.ZipInfo.from_file(path, name)
+            info.compress_type = zipfile.ZIP_STORED
+            with open(path, 'rb') as source, archive.open(info, 'w') as entry:
+                while chunk := source.read(CHUNK_SIZE):
+                    entry.write(chunk)
+                    yield buffer.drain()
+            yield buffer.drain()
+    yield buffer.drain()
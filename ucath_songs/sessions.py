@@ -0,0 +1,87 @@
+"""
+Sessions that are only written back when they change.
+
+With SESSION_SAVE_EVERY_REQUEST, Django saves the session at the end of
+every request that has one, to push its expiry forward. With the plain
+database engine that is an UPDATE per page view. This store keeps each
+session in the cache along with the data and expiry last written to the
+database, and skips the save when the data is the same. An unchanged
+session's expiry is written at most once per SESSION_REFRESH_INTERVAL
+seconds, as a single-column UPDATE. Sessions therefore expire at most one
+interval early.
+
+The cache is the shared one (SESSION_CACHE_ALIAS), not per-process
+memory, so a logout in one worker is seen by every other worker at once.
+"""
+import logging
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.sessions.backends.cached_db import SessionStore as CachedDBStore
+
+REFRESH_INTERVAL = 300
+
+logger = logging.getLogger('django.contrib.sessions')
+
+
+class SessionStore(CachedDBStore):
+
+    # Cache entries hold (data, expiry written), unlike cached_db's plain data
+    cache_key_prefix = 'ucath.sessions.'
+
+    def __init__(self, session_key=None):
+        super().__init__(session_key)
+        # (serialized data, expire_date) as last written to the database
+        self._stored = None
+
+    @property
+    def refresh_interval(self):
+        return getattr(settings, 'SESSION_REFRESH_INTERVAL', REFRESH_INTERVAL)
+
+    def load(self):
+        try:
+            cached = self._cache.get(self.cache_key)
+        except Exception:
+            # As in cached_db: some backends reject odd keys; reset the session
+            cached = None
+        if cached is None:
+            session = self._get_session_from_db()
+            if session is None:
+                self._stored = None
+                return {}
+            cached = (self.decode(session.session_data), session.expire_date)
+            self._cache.set(self.cache_key, cached, self.get_expiry_age(expiry=session.expire_date))
+        data, expire_date = cached
+        self._stored = (self.serializer().dumps(data), expire_date)
+        return data
+
+    def save(self, must_create=False):
+        if self.session_key is None:
+            return self.create()
+        data = self._get_session(no_load=must_create)
+        state = self.serializer().dumps(data)
+        expire_date = self.get_expiry_date()
+        if not must_create and self._stored is not None and self._stored[0] == state:
+            stored_expiry = self._stored[1]
+            if (expire_date - stored_expiry).total_seconds() < self.refresh_interval:
+                return
+            if self.model.objects.filter(session_key=self.session_key).update(expire_date=expire_date):
+                self.remember(data, state, expire_date)
+                return
+            # The row is gone (e.g. cleared); write it out in full below
+
+        super(CachedDBStore, self).save(must_create=must_create)
+        self.remember(data, state, expire_date)
+
+    def remember(self, data, state, expire_date):
+        self._stored = (state, expire_date)
+        try:
+            self._cache.set(self.cache_key, (data, expire_date), self.get_expiry_age(expiry=expire_date))
+        except Exception:
+            logger.exception('Error saving to cache (%s)', self._cache)
+
+    async def aload(self):
+        return await sync_to_async(self.load)()
+
+    async def asave(self, must_create=False):
+        return await sync_to_async(self.save)(must_create)
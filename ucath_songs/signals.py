@@ -0,0 +1,71 @@
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from .caching import invalidate_songs
+from .metrics import record_query
+from .models import Song, MusicSheet, MidiFile, Mp3File, ThumbnailRendition
+from .search import index_songs, remove_songs
+
+
+@receiver(post_delete, sender=Song)
+def remove_song_from_search_index(sender, instance, **kwargs):
+    remove_songs([instance.pk])
+
+
+@receiver([post_save, post_delete], sender=Song)
+def invalidate_song_cache(sender, instance, **kwargs):
+    invalidate_songs([instance.slug])
+
+
+@receiver([post_save, post_delete], sender=MusicSheet)
+@receiver([post_save, post_delete], sender=Mp3File)
+@receiver([post_save, post_delete], sender=MidiFile)
+def invalidate_asset_cache(sender, instance, **kwargs):
+    try:
+        slug = instance.song.slug
+    except Song.DoesNotExist:
+        slug = None
+    invalidate_songs([slug] if slug else [])
+
+
+@receiver(post_delete, sender=MusicSheet)
+def remove_sheet_text_from_search_index(sender, instance, **kwargs):
+    try:
+        index_songs([instance.song])
+    except Song.DoesNotExist:
+        pass
+
+
+def release_file(field_file):
+    # Once the delete is committed, so a rollback keeps the file
+    if field_file:
+        name, storage = field_file.name, field_file.storage
+        transaction.on_commit(lambda: storage.delete(name))
+
+
+@receiver(post_delete, sender=MusicSheet)
+@receiver(post_delete, sender=Mp3File)
+@receiver(post_delete, sender=MidiFile)
+def release_asset_file(sender, instance, **kwargs):
+    release_file(instance.asset_file)
+
+
+@receiver(post_delete, sender=ThumbnailRendition)
+def release_rendition_file(sender, instance, **kwargs):
+    release_file(instance.image)
+
+
+@receiver(pre_delete, sender=MusicSheet)
+def release_legacy_thumbnail(sender, instance, **kwargs):
+    # A thumbnail from before renditions existed is its own file; otherwise
+    # it borrows the fallback rendition's reference (see save_renditions)
+    if instance.thumbnail and not instance.renditions.filter(image=instance.thumbnail.name).exists():
+        release_file(instance.thumbnail)
+
+
+@receiver(connection_created)
+def install_query_timer(sender, connection, **kwargs):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
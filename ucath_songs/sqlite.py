@@ -0,0 +1,72 @@
+"""
+SQLite connection profiles and read/write routing.
+
+Every page view saves its session, so under SQLite's defaults (rollback
+journal, deferred transactions) one writer blocks every reader, and a
+second writer that has already read fails at once with "database is
+locked". The 'concurrent' profile turns on WAL, so readers never wait for
+the writer, and busy_timeout with immediate transactions, so writers take
+the lock up front and queue for it instead of failing. synchronous=NORMAL
+is safe under WAL; the page cache and memory-mapped reads are enlarged.
+
+settings.py builds DATABASES from a profile (UCATH_SQLITE_PROFILE), with
+a second, read-only connection to the same file. ReadConnectionRouter
+sends reads there so they never queue behind a write transaction. The
+benchmark_sqlite command compares the profiles under concurrent readers
+and writers. settings.py imports this module, so it must not touch models.
+"""
+from django.db import connections
+
+WRITE_DB = 'default'
+READ_DB = 'read'
+
+PROFILES = {
+    # SQLite's own settings, as Django opens it out of the box
+    'stock': {'pragmas': {}, 'transaction_mode': None},
+    'concurrent': {
+        'pragmas': {
+            'journal_mode': 'WAL',
+            'synchronous': 'NORMAL',
+            'busy_timeout': 5000,  # milliseconds
+            'cache_size': -20000,  # negative: KiB, i.e. about 20 MB per connection
+            'mmap_size': 256 * 1024 * 1024,
+            'temp_store': 'MEMORY',
+        },
+        'transaction_mode': 'IMMEDIATE',
+    },
+}
+
+
+def sqlite_options(profile, read_only=False):
+    """DATABASES OPTIONS that apply ``profile`` to every new connection."""
+    pragmas = dict(PROFILES[profile]['pragmas'])
+    if read_only:
+        pragmas['query_only'] = 'ON'
+    options = {'init_command': '; '.join(f'PRAGMA {name} = {value}' for name, value in pragmas.items())}
+    # The read connection never writes, so never needs the write lock
+    if PROFILES[profile]['transaction_mode'] and not read_only:
+        options['transaction_mode'] = PROFILES[profile]['transaction_mode']
+    return options
+
+
+class ReadConnectionRouter:
+    """
+    Send reads to the read-only connection and everything else to the
+    default one. Inside a transaction on the default connection reads stay
+    there, so they see that transaction's own uncommitted writes.
+    """
+
+    def db_for_read(self, model, **hints):
+        if READ_DB not in connections.settings or connections[WRITE_DB].in_atomic_block:
+            return WRITE_DB
+        return READ_DB
+
+    def db_for_write(self, model, **hints):
+        return WRITE_DB
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Both connections open the same database
+        return True
+
+    def allow_migrate(self, db, app_label, **hints):
+        return db == WRITE_DB
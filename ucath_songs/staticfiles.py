@@ -0,0 +1,155 @@
+"""
+Fingerprinted, pre-compressed static files.
+
+collectstatic, through CompressedManifestStaticFilesStorage, copies each
+file under its own name and under a content-hashed one (css/main.3f2a.css),
+as ManifestStaticFilesStorage does. It also writes gzip and, when the
+Brotli package is installed, brotli variants next to every text file
+that shrinks. {% static %} links to the hashed names (outside DEBUG).
+
+StaticFilesMiddleware serves STATIC_ROOT ahead of the session and auth
+middleware. It picks the smallest variant the client accepts, and
+serve_file adds ETags, 304s and ranges. A hashed name never changes
+content, so those responses are cached for a year as immutable; plain
+names must be revalidated. Files are indexed when the process starts,
+so restart after collectstatic.
+"""
+import gzip
+import mimetypes
+import os
+import re
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage, staticfiles_storage
+from django.utils.cache import patch_vary_headers
+
+from .serving import CACHE_CONTROL, REVALIDATE_CACHE_CONTROL, aserve_file, serve_file
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+COMPRESSIBLE_EXTENSIONS = {'.css', '.js', '.mjs', '.map', '.svg', '.json', '.txt', '.html', '.xml', '.ico'}
+# A variant must save at least this share of the bytes to be worth keeping
+MIN_SAVING = 0.05
+# (encoding, file suffix, Accept-Encoding pattern), in order of preference
+ENCODINGS = [
+    ('br', '.br', re.compile(r'\bbr\b')),
+    ('gzip', '.gz', re.compile(r'\bgzip\b')),
+]
+
+
+def compress(data, encoding):
+    if encoding == 'gzip':
+        return gzip.compress(data, compresslevel=9, mtime=0)
+    return brotli.compress(data, quality=11)
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+
+    def post_process(self, paths, dry_run=False, **options):
+        yield from super().post_process(paths, dry_run, **options)
+        if dry_run:
+            return
+        # The plain names are served too, so they get variants as well
+        for name in sorted({*paths, *self.hashed_files.values()}):
+            if os.path.splitext(name)[1].lower() not in COMPRESSIBLE_EXTENSIONS:
+                continue
+            with self.open(name) as original:
+                data = original.read()
+            for encoding, suffix, _ in ENCODINGS:
+                if encoding == 'br' and brotli is None:
+                    continue
+                compressed = compress(data, encoding)
+                if len(compressed) <= len(data) * (1 - MIN_SAVING):
+                    with open(self.path(name + suffix), 'wb') as variant:
+                        variant.write(compressed)
+                    yield name, name + suffix, True
+
+
+class StaticFile:
+
+    def __init__(self, path, immutable):
+        self.path = path
+        self.immutable = immutable
+        self.content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        self.variants = {
+            encoding: path + suffix for encoding, suffix, _ in ENCODINGS if os.path.isfile(path + suffix)
+        }
+
+
+def index_static_files(root):
+    """Map each collected file's name (relative to ``root``) to a StaticFile."""
+    if not root or not os.path.isdir(root):
+        return {}
+    hashed = set(getattr(staticfiles_storage, 'hashed_files', {}).values())
+    suffixes = tuple(suffix for _, suffix, _ in ENCODINGS)
+    files = {}
+    for directory, _, filenames in os.walk(root):
+        for filename in filenames:
+            if filename.endswith(suffixes):
+                continue
+            path = os.path.join(directory, filename)
+            name = os.path.relpath(path, root).replace(os.sep, '/')
+            files[name] = StaticFile(path, name in hashed)
+    return files
+
+
+class StaticFilesMiddleware:
+    """Keep above SessionMiddleware so static requests skip the rest of the stack."""
+
+    sync_capable = async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.prefix = settings.STATIC_URL
+        self.files = index_static_files(settings.STATIC_ROOT)
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        static_file = self.find(request)
+        if static_file is not None:
+            encoding, path = self.choose(request, static_file)
+            response = serve_file(request, path, static_file.content_type, **self.options(static_file))
+            return self.finish(response, static_file, encoding)
+        return self.get_response(request)
+
+    async def __acall__(self, request):
+        static_file = self.find(request)
+        if static_file is not None:
+            encoding, path = self.choose(request, static_file)
+            response = await aserve_file(request, path, static_file.content_type, **self.options(static_file))
+            return self.finish(response, static_file, encoding)
+        return await self.get_response(request)
+
+    def find(self, request):
+        if request.method in ('GET', 'HEAD') and request.path.startswith(self.prefix):
+            return self.files.get(request.path[len(self.prefix):])
+        return None
+
+    def choose(self, request, static_file):
+        """The smallest variant the client accepts, as ``(encoding, path)``."""
+        accept_encoding = request.headers.get('Accept-Encoding', '')
+        for name, _, accepts in ENCODINGS:
+            if name in static_file.variants and accepts.search(accept_encoding):
+                return name, static_file.variants[name]
+        return None, static_file.path
+
+    def options(self, static_file):
+        return {
+            # Named after the file itself, not the .br/.gz variant sent
+            'filename': os.path.basename(static_file.path),
+            'cache_control': CACHE_CONTROL if static_file.immutable else REVALIDATE_CACHE_CONTROL,
+        }
+
+    def finish(self, response, static_file, encoding):
+        if encoding:
+            response['Content-Encoding'] = encoding
+        if static_file.variants:
+            patch_vary_headers(response, ['Accept-Encoding'])
+        return response
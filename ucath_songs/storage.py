@@ -0,0 +1,88 @@
+"""
+Content-addressed media storage.
+
+Every saved file is hashed (SHA-256) while it is copied into MEDIA_ROOT and
+stored as ``<upload_to>/<h[:2]>/<sha256><ext>``, so identical uploads
+share one file on disk. A StoredBlob row counts the references to each
+file, and delete() only removes the file once the last one is gone.
+"""
+import hashlib
+import os
+import posixpath
+import tempfile
+
+from django.apps import apps
+from django.core.files.storage import FileSystemStorage
+from django.db.models import F
+
+
+class ContentAddressedStorage(FileSystemStorage):
+
+    def get_available_name(self, name, max_length=None):
+        # The final name comes from the content hash in _save
+        return name
+
+    def _save(self, name, content):
+        directory, basename = posixpath.split(name)
+        extension = os.path.splitext(basename)[1].lower()
+        full_directory = self.path(directory)
+        os.makedirs(full_directory, exist_ok=True)
+
+        digest = hashlib.sha256()
+        size = 0
+        fd, temp_path = tempfile.mkstemp(dir=full_directory, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as temp_file:
+                if hasattr(content, 'seek'):
+                    content.seek(0)
+                for chunk in content.chunks():
+                    digest.update(chunk)
+                    temp_file.write(chunk)
+                    size += len(chunk)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        return self.commit(temp_path, directory, extension, digest.hexdigest(), size)
+
+    def commit(self, temp_path, directory, extension, sha256, size):
+        """
+        Move the already hashed file at ``temp_path`` (on the same
+        filesystem) to its blob name under ``directory``, count a reference
+        and return the name. Chunked uploads use this to skip re-reading.
+        """
+        blob_name = posixpath.join(directory, sha256[:2], sha256 + extension)
+        blob_path = self.path(blob_name)
+        try:
+            if os.path.exists(blob_path):
+                os.remove(temp_path)
+            else:
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                os.replace(temp_path, blob_path)
+                if self.file_permissions_mode is not None:
+                    os.chmod(blob_path, self.file_permissions_mode)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        self.add_reference(blob_name, sha256=sha256, size=size)
+        return blob_name
+
+    def add_reference(self, name, sha256=None, size=None):
+        """Record one more model field pointing at the stored file ``name``."""
+        StoredBlob = apps.get_model('ucath_songs', 'StoredBlob')
+        if sha256 is None:
+            sha256 = os.path.splitext(posixpath.basename(name))[0]
+            size = self.size(name)
+        StoredBlob.objects.get_or_create(name=name, defaults={'sha256': sha256, 'size': size})
+        StoredBlob.objects.filter(name=name).update(ref_count=F('ref_count') + 1)
+
+    def delete(self, name):
+        StoredBlob = apps.get_model('ucath_songs', 'StoredBlob')
+        blob = StoredBlob.objects.filter(name=name)
+        if not blob.exists():
+            # A file saved before content addressing, owned by one field
+            return super().delete(name)
+        blob.filter(ref_count__gt=0).update(ref_count=F('ref_count') - 1)
+        if blob.filter(ref_count__lte=0).delete()[0]:
+            super().delete(name)
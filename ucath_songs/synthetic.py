@@ -0,0 +1,184 @@
+"""
+Synthetic catalog data for benchmarks and load tests.
+
+seed_songs() adds songs with sheets, recordings and MIDI files that all
+point at one small placeholder file per kind. With content-addressed
+storage the placeholders are written once and only their reference counts
+grow, so even a 100k-song catalog costs a few kilobytes of media. The
+placeholder PDF is rendered once and every sheet shares its renditions;
+the placeholder MIDI file is parsed once and every sequence shares its
+note events.
+"""
+import random
+import struct
+
+import fitz
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connection, transaction
+from django.db.models import F
+
+from .caching import invalidate_songs
+from .midi import compress_events, parse_midi
+from .models import Song, MusicSheet, MidiFile, Mp3File, StoredBlob, ThumbnailRendition
+from .search import index_songs
+from .thumbnails import FALLBACK_RENDITION, render_renditions, rendition_name
+from .utils import generate_bs64_slug, generate_archive_id
+
+WORDS = [
+    'gloria', 'sanctus', 'agnus', 'kyrie', 'alleluia', 'magnificat', 'ave', 'maria', 'regina', 'caeli',
+    'tantum', 'ergo', 'veni', 'creator', 'spiritus', 'salve', 'mater', 'laudate', 'dominum', 'jubilate',
+    'mwana', 'kondoo', 'bwana', 'yesu', 'mungu', 'baba', 'tumsifu', 'tukuzwe', 'ekitiibwa', 'katonda',
+]
+COMPOSERS = [
+    'J. Kizito', 'A. Ssempeke', 'F. Mugisha', 'P. Ochieng', 'M. Nakato', 'G. P. da Palestrina',
+    'W. A. Mozart', 'C. Kabuye', 'S. Wasswa', 'T. Odongo',
+]
+SHEET_VERSIONS = ['SATB', 'Unison', 'Organ', 'Solo & Piano']
+MP3_VERSIONS = ['Master Recording', 'Rehearsal', 'Soprano Part', 'Alto Part']
+MIDI_VERSIONS = ['Synthesized Logic', 'Piano Reduction']
+
+
+def build_song(rng, status='published'):
+    """An unsaved Song with a random title, composer, season and mass part."""
+    return Song(
+        title=' '.join(rng.sample(WORDS, rng.randint(2, 5))),
+        composer=rng.choice(COMPOSERS),
+        arranged_by=rng.choice(COMPOSERS),
+        part_of_mass=rng.choice(Song.mass_parts)[0],
+        season=rng.choice(Song.season_choices)[0],
+        status=status,
+        slug=generate_bs64_slug(),
+        archive_id=generate_archive_id(),
+    )
+
+
+def placeholder_pdf():
+    doc = fitz.open()
+    page = doc.new_page(width=595, height=842)
+    page.insert_text((72, 72), 'UCath synthetic score', fontsize=18)
+    for line in range(5):
+        # Five-line staves, so the thumbnail looks like a score
+        top = 140 + line * 110
+        for offset in range(0, 40, 8):
+            page.draw_line((72, top + offset), (523, top + offset))
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+def placeholder_mp3():
+    # One silent MPEG-1 Layer III frame (128 kbit/s, 44.1 kHz, 417 bytes)
+    return b'\xff\xfb\x90\x64' + bytes(413)
+
+
+def placeholder_midi():
+    # Format 0, one track, 480 ticks per beat: a C major scale in crotchets
+    events = b'\x00\xff\x51\x03\x07\xa1\x20'  # tempo: 500000 us per beat
+    for note in (60, 62, 64, 65, 67, 69, 71, 72):
+        events += bytes([0x00, 0x90, note, 0x50]) + b'\x83\x60' + bytes([0x80, note, 0x40])
+    events += b'\x00\xff\x2f\x00'
+    return (
+        b'MThd' + struct.pack('>IHHH', 6, 0, 1, 480)
+        + b'MTrk' + struct.pack('>I', len(events)) + events
+    )
+
+
+def store_placeholders():
+    """Save the placeholder files and their renditions; return their names."""
+    names = {}
+    for model, field, data, filename in [
+        (MusicSheet, 'music_sheet', placeholder_pdf(), 'synthetic_score.pdf'),
+        (Mp3File, 'mp3_file', placeholder_mp3(), 'synthetic_recording.mp3'),
+        (MidiFile, 'midi_file', placeholder_midi(), 'synthetic_sequence.mid'),
+    ]:
+        upload_to = model._meta.get_field(field).upload_to
+        names[field] = default_storage.save(upload_to + filename, ContentFile(data))
+
+    renditions = []
+    upload_to = ThumbnailRendition._meta.get_field('image').upload_to
+    for item in render_renditions(default_storage.path(names['music_sheet'])):
+        name = upload_to + rendition_name(names['music_sheet'], item['size'], item['ext'])
+        renditions.append({**item, 'name': default_storage.save(name, ContentFile(item['data']))})
+    names['renditions'] = renditions
+    return names
+
+
+def add_references(counts):
+    if hasattr(default_storage, 'add_reference'):
+        for name, count in counts.items():
+            StoredBlob.objects.filter(name=name).update(ref_count=F('ref_count') + count)
+
+
+def seed_songs(count, seed=None, batch_size=2000, status='published'):
+    """Add ``count`` synthetic songs with assets and return how many were created."""
+    if count <= 0:
+        return 0
+    rng = random.Random(seed)
+    media = store_placeholders()
+    fallback = next(r['name'] for r in media['renditions'] if (r['size'], r['format']) == FALLBACK_RENDITION)
+    # Each placeholder was saved once, which already counted one reference
+    references = {name: -1 for name in [media['music_sheet'], media['mp3_file'], media['midi_file']]}
+    references.update({r['name']: -1 for r in media['renditions']})
+    midi = parse_midi(placeholder_midi())
+    midi_details = {
+        'duration': midi['duration'], 'tempo': midi['tempo'], 'track_names': midi['track_names'],
+        'part_names': midi['part_names'], 'note_events': compress_events(midi['events']),
+    }
+
+    created = 0
+    while created < count:
+        with transaction.atomic():
+            songs = Song.objects.bulk_create(
+                build_song(rng, status) for _ in range(min(batch_size, count - created))
+            )
+            index_songs(songs)
+            sheets, recordings, sequences = [], [], []
+            for song in songs:
+                for version in rng.sample(SHEET_VERSIONS, rng.randint(1, 3)):
+                    sheets.append(MusicSheet(
+                        song=song, music_sheet=media['music_sheet'], thumbnail=fallback,
+                        ms_version=version, slug=generate_bs64_slug(),
+                    ))
+                for version in rng.sample(MP3_VERSIONS, rng.randint(0, 2)):
+                    recordings.append(Mp3File(song=song, mp3_file=media['mp3_file'], mp3_version=version))
+                if rng.random() < 0.5:
+                    sequences.append(MidiFile(
+                        song=song, midi_file=media['midi_file'], midi_version=rng.choice(MIDI_VERSIONS),
+                        **midi_details,
+                    ))
+            MusicSheet.objects.bulk_create(sheets)
+            ThumbnailRendition.objects.bulk_create(
+                ThumbnailRendition(
+                    sheet=sheet, size=r['size'], format=r['format'], image=r['name'],
+                    width=r['width'], height=r['height'],
+                )
+                for sheet in sheets for r in media['renditions']
+            )
+            Mp3File.objects.bulk_create(recordings)
+            MidiFile.objects.bulk_create(sequences)
+
+            # Like save_renditions, thumbnail borrows the fallback rendition's reference
+            for name in [media['music_sheet'], *(r['name'] for r in media['renditions'])]:
+                references[name] += len(sheets)
+            references[media['mp3_file']] += len(recordings)
+            references[media['midi_file']] += len(sequences)
+            add_references(references)
+            references = dict.fromkeys(references, 0)
+        created += len(songs)
+
+    # bulk_create sends no signals, so drop the cached pages by hand
+    invalidate_songs([])
+    analyze()
+    return created
+
+
+def analyze():
+    """
+    Refresh SQLite's planner statistics after a bulk load. Without them it
+    guesses that status = 'published' is selective and probes the FTS
+    table once per song instead of joining from the matches.
+    """
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
@@ -0,0 +1,15 @@
+from django import template
+
+register = template.Library()
+
+
+@register.filter
+def duration(seconds):
+    """Format a length in seconds as m:ss (or h:mm:ss); empty when unknown."""
+    if seconds is None or seconds == '':
+        return ''
+    minutes, seconds = divmod(round(float(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f'{hours}:{minutes:02d}:{seconds:02d}'
+    return f'{minutes}:{seconds:02d}'
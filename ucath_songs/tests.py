@@ -1,3 +1,1418 @@
-from django.test import TestCase
+import asyncio
+import csv
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+import struct
+import tempfile
+import threading
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+from io import BytesIO, StringIO
+from unittest import mock, skipUnless
+from urllib.parse import unquote
 
-# Create your tests here.
+import fitz
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.sessions.models import Session
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection, connections
+from django.http import QueryDict
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from . import moderation, serving, thumbnails, uploads, views
+from .models import (
+    Song, MusicSheet, MidiFile, Mp3File, StoredBlob, ThumbnailJob, ThumbnailRendition, ChunkedUpload, FileDeletion,
+    SongSearchIndex, SongTrigram,
+)
+from .midi import MidiError, parse_midi
+from .sqlite import ReadConnectionRouter, sqlite_options
+from .storage import ContentAddressedStorage
+from .search import fuzzy_search_songs, normalize, search_songs, trigrams
+from .synthetic import placeholder_midi
+
+
+def make_song(index, status='published', **kwargs):
+    song = Song.objects.create(
+        title=kwargs.pop('title', f'Song {index}'),
+        composer=kwargs.pop('composer', 'Composer'),
+        arranged_by='',
+        part_of_mass=kwargs.pop('part_of_mass', 'entrance'),
+        season=kwargs.pop('season', 'ordinary'),
+        status=status,
+        **kwargs
+    )
+    # Thumbnail is set up front so MusicSheet.save does not try to render one.
+    MusicSheet.objects.create(
+        song=song,
+        music_sheet=f'music_sheets/song_{index}.pdf',
+        thumbnail=f'music_thumbnails/song_{index}_thumb.jpg',
+        ms_version='SATB',
+    )
+    Mp3File.objects.create(song=song, mp3_file=f'mp3_files/song_{index}.mp3', mp3_version='Master')
+    return song
+
+
+def make_pdf(pages=1, text='Kyrie eleison'):
+    doc = fitz.open()
+    for _ in range(pages):
+        doc.new_page(width=595, height=842).insert_text((72, 72), text)
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+ucath_settings = override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    # No manifest outside StaticFilesTests, so templates link the plain names
+    STORAGES={**settings.STORAGES, 'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'}},
+)
+
+
+@ucath_settings
+class UcathTestCase(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+
+class MediaRootMixin:
+
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        media_settings = override_settings(MEDIA_ROOT=media_root)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+
+
+class SongGridQueryCountTests(UcathTestCase):
+
+    def count_queries(self, url, songs, **headers):
+        for index in range(Song.objects.count(), songs):
+            make_song(index)
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url, headers=headers)
+        self.assertEqual(response.status_code, 200)
+        return len(ctx.captured_queries), response
+
+    def test_library_query_count_is_constant(self):
+        url = reverse('song_library')
+        small, _ = self.count_queries(url, 2)
+        large, response = self.count_queries(url, 12)
+        self.assertEqual(small, large)
+        self.assertContains(response, 'music_thumbnails/song_11_thumb.jpg')
+        self.assertContains(response, '/archive/media/audio/')
+
+    def test_library_partial_query_count_is_constant(self):
+        url = reverse('song_library')
+        small, _ = self.count_queries(url, 2, HX_Request='true')
+        large, _ = self.count_queries(url, 12, HX_Request='true')
+        self.assertEqual(small, large)
+
+    def test_admin_arrivals_query_count_is_constant(self):
+        staff = User.objects.create_user('staff', password='secret', is_staff=True)
+        self.client.force_login(staff)
+        url = reverse('admin_arrivals')
+        small, _ = self.count_queries(url, 2)
+        large, response = self.count_queries(url, 20)
+        self.assertEqual(small, large)
+        self.assertContains(response, 'music_thumbnails/song_19_thumb.jpg')
+
+
+class SongSearchTests(UcathTestCase):
+
+    def search(self, q):
+        return list(search_songs(Song.objects.order_by('-created_at'), q))
+
+    def test_prefix_match_on_title_and_composer(self):
+        kyrie = make_song(1, title='Kyrie Eleison', composer='Kizito')
+        gloria = make_song(2, title='Gloria', composer='Palestrina')
+        self.assertEqual(self.search('kyr'), [kyrie])
+        self.assertEqual(self.search('pales'), [gloria])
+
+    def test_mass_part_and_season_labels_are_searchable(self):
+        song = make_song(1, title='Ave Verum', part_of_mass='communion', season='lent')
+        self.assertEqual(self.search('eucharist'), [song])
+        self.assertEqual(self.search('lent'), [song])
+
+    def test_title_hits_rank_above_other_columns(self):
+        by_composer = make_song(1, title='Sanctus', composer='Gloria Nakato')
+        by_title = make_song(2, title='Gloria in Excelsis', composer='Mozart')
+        self.assertEqual(self.search('gloria'), [by_title, by_composer])
+
+    def test_index_follows_save_and_delete(self):
+        song = make_song(1, title='Salve Regina')
+        song.title = 'Regina Caeli'
+        song.save()
+        self.assertEqual(self.search('salve'), [])
+        self.assertEqual(self.search('caeli'), [song])
+        song.delete()
+        self.assertEqual(self.search('caeli'), [])
+
+    def test_library_view_search(self):
+        make_song(1, title='Tantum Ergo')
+        make_song(2, title='Veni Creator')
+        response = self.client.get(reverse('song_library'), {'q': 'tantum'})
+        self.assertEqual([song.title for song in response.context['songs']], ['Tantum Ergo'])
+
+    def test_punctuation_only_query_matches_nothing(self):
+        make_song(1)
+        self.assertEqual(self.search('"*'), [])
+
+
+class FuzzySearchTests(UcathTestCase):
+
+    def search(self, q):
+        return list(search_songs(Song.objects.order_by('-created_at'), q))
+
+    def test_trigrams_fold_case_and_diacritics(self):
+        self.assertEqual(normalize('Kízito, J.'), 'kizito j')
+        self.assertEqual(trigrams('Ave'), trigrams('ÁVE'))
+        self.assertEqual(trigrams('ab'), {' ab', 'ab '})
+
+    def test_misspellings_fall_back_to_similar_titles_and_composers(self):
+        kizito = make_song(1, title='Mwana Kondoo', composer='Joseph Kizito')
+        palestrina = make_song(2, title='Sicut Cervus', composer='G. P. da Palestrina')
+        make_song(3, title='Ekitiibwa kya Katonda', composer='Ssempeke')
+        self.assertEqual(self.search('kizto'), [kizito])
+        self.assertEqual(self.search('palestrna'), [palestrina])
+        self.assertEqual(self.search('ekitibwa')[0].title, 'Ekitiibwa kya Katonda')
+        self.assertEqual(self.search('zzzqqq'), [])
+
+    def test_closest_spelling_ranks_first(self):
+        exact = make_song(1, title='Magnificat')
+        partial = make_song(2, title='Magna Carta')
+        self.assertEqual(self.search('magnifcat')[:1], [exact])
+        self.assertNotIn(partial, fuzzy_search_songs(Song.objects.all(), 'magnifcat', threshold=0.8))
+
+    def test_exact_matches_skip_the_fuzzy_lookup(self):
+        make_song(1, title='Gloria')
+        make_song(2, title='Glorious Mysteries')
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(len(self.search('gloria')), 1)
+        self.assertFalse([q for q in ctx.captured_queries if 'songtrigram' in q['sql']])
+
+    def test_trigrams_follow_save_and_delete(self):
+        song = make_song(1, title='Salve Regina')
+        self.assertEqual(self.search('salev regina'), [song])
+        song.title = 'Regina Caeli'
+        song.save()
+        self.assertEqual(self.search('salev'), [])
+        song.delete()
+        self.assertFalse(SongTrigram.objects.exists())
+
+    def test_library_and_arrivals_use_fuzzy_search(self):
+        make_song(1, title='Tantum Ergo', status='pending_approval')
+        make_song(2, title='Tantum Ergo Sacramentum')
+        response = self.client.get(reverse('song_library'), {'q': 'tantun ergo'})
+        self.assertEqual([song.title for song in response.context['songs']], ['Tantum Ergo Sacramentum'])
+
+        self.client.force_login(User.objects.create_user('moderator', is_staff=True))
+        response = self.client.get(reverse('admin_arrivals'), {'q': 'tantun'})
+        self.assertEqual(len(response.context['songs']), 2)
+
+    @mock.patch('ucath_songs.search.FUZZY_LIMIT', 3)
+    def test_filters_apply_before_the_candidate_limit(self):
+        # Closer spellings the filters drop must not take every candidate slot
+        for index in range(4):
+            make_song(index, title='Kyre Eleison', season='christmas')
+            make_song(10 + index, title='Glorai', status='pending_approval')
+        make_song(20, title='Kyrie Eleison', season='lent')
+        make_song(21, title='Gloria')
+
+        response = self.client.get(reverse('song_library'), {'q': 'kyre eleison', 'season': 'lent'})
+        self.assertEqual([song.title for song in response.context['songs']], ['Kyrie Eleison'])
+        self.assertEqual(dict((value, count) for value, _, count in response.context['facets']['parts'])['entrance'], 1)
+        response = self.client.get(reverse('song_library'), {'q': 'glorai'})
+        self.assertEqual([song.title for song in response.context['songs']], ['Gloria'])
+
+
+class ThumbnailJobTests(MediaRootMixin, UcathTestCase):
+
+    def make_sheet(self, data):
+        song = Song.objects.create(title='Agnus Dei', composer='Kizito', arranged_by='', part_of_mass='communion')
+        return MusicSheet.objects.create(
+            song=song, music_sheet=SimpleUploadedFile('agnus.pdf', data), ms_version='SATB'
+        )
+
+    def run_worker(self):
+        call_command('thumbnail_worker', '--once', '--workers', '1', stdout=StringIO(), stderr=StringIO())
+
+    def test_save_queues_instead_of_rendering(self):
+        sheet = self.make_sheet(make_pdf())
+        self.assertFalse(sheet.thumbnail)
+        self.assertEqual(list(sheet.thumbnail_jobs.values_list('status', flat=True)), ['pending'])
+        sheet.save()
+        self.assertEqual(sheet.thumbnail_jobs.count(), 1)
+
+    def test_worker_renders_thumbnail(self):
+        sheet = self.make_sheet(make_pdf())
+        self.run_worker()
+        sheet.refresh_from_db()
+        self.assertEqual(sheet.thumbnail.name, sheet.renditions.get(size='md', format='jpeg').image.name)
+        job = sheet.thumbnail_jobs.get()
+        self.assertEqual((job.status, job.attempts), ('done', 1))
+
+    def test_renditions_cover_every_size_and_format(self):
+        sheet = self.make_sheet(make_pdf())
+        self.run_worker()
+        sheet.refresh_from_db()
+        renditions = {(r.size, r.format): r for r in sheet.renditions.all()}
+        self.assertEqual(len(renditions), 6)
+        self.assertEqual([renditions[(size, 'webp')].width for size in ('sm', 'md', 'lg')], [240, 480, 960])
+        self.assertEqual(renditions[('md', 'jpeg')].height, 680)
+        self.assertEqual(sheet.thumbnail.name, renditions[('md', 'jpeg')].image.name)
+        with renditions[('sm', 'webp')].image.open() as image_file:
+            self.assertEqual(image_file.read(4), b'RIFF')
+
+        sheet.generate_thumbnail()
+        self.assertEqual(sheet.renditions.count(), 6)
+
+    def test_library_grid_emits_srcset(self):
+        sheet = self.make_sheet(make_pdf())
+        Song.objects.update(status='published')
+        self.run_worker()
+        response = self.client.get(reverse('song_library'))
+        self.assertContains(response, 'type="image/webp"')
+        self.assertContains(response, sheet.renditions.get(size='sm', format='webp').image.url + ' 240w')
+
+    def test_failed_render_is_retried_then_recorded(self):
+        sheet = self.make_sheet(b'not a pdf')
+        job = sheet.thumbnail_jobs.get()
+        self.run_worker()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ('pending', 1))
+        self.assertTrue(job.last_error)
+
+        ThumbnailJob.objects.filter(pk=job.pk).update(run_after=job.created_at, max_attempts=2)
+        self.run_worker()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ('failed', 2))
+        sheet.refresh_from_db()
+        self.assertFalse(sheet.thumbnail)
+
+
+class RebuildThumbnailsTests(MediaRootMixin, UcathTestCase):
+
+    def setUp(self):
+        super().setUp()
+        song = Song.objects.create(title='Agnus Dei', composer='Kizito', arranged_by='', part_of_mass='communion')
+        self.pdf = make_pdf()
+        self.sheet = MusicSheet.objects.create(
+            song=song, music_sheet=SimpleUploadedFile('agnus.pdf', self.pdf), ms_version='SATB'
+        )
+
+    def rebuild(self, *args):
+        out = StringIO()
+        call_command('rebuild_thumbnails', '--workers', '1', *args, stdout=out, stderr=StringIO())
+        return out.getvalue()
+
+    def test_only_outdated_sheets_are_rendered(self):
+        self.assertIn('1 sheet(s) to render (1 missing).', self.rebuild('--dry-run'))
+        self.assertFalse(MusicSheet.objects.get().thumbnail)
+
+        self.assertIn('Rendered 1 sheet(s), 0 failed', self.rebuild())
+        sheet = MusicSheet.objects.get()
+        self.assertEqual(sheet.renditions.count(), 6)
+        self.assertEqual(sheet.thumbnail_settings, thumbnails.render_settings())
+        self.assertEqual(sheet.thumbnail_jobs.get().status, 'done')
+        # Nothing changed: one query, no file touched, nothing rendered
+        with mock.patch.object(ContentAddressedStorage, 'exists') as exists, self.assertNumQueries(1):
+            self.assertIn('0 sheet(s) to render.', self.rebuild())
+        exists.assert_not_called()
+        self.assertIn('0 sheet(s) to render.', self.rebuild('--verify'))
+        self.assertEqual(MusicSheet.objects.get().thumbnail_rendered_at, sheet.thumbnail_rendered_at)
+
+        with mock.patch.object(thumbnails, 'RENDER_VERSION', thumbnails.RENDER_VERSION + 1):
+            self.assertIn('(1 settings)', self.rebuild('--dry-run'))
+
+    def test_verify_finds_changed_and_missing_files(self):
+        self.sheet.generate_thumbnail()
+        sheet = MusicSheet.objects.get()
+        # The PDF was replaced (e.g. restored from backup) after rendering
+        MusicSheet.objects.update(thumbnail_rendered_at=sheet.thumbnail_rendered_at - timedelta(hours=1))
+        self.assertIn('0 sheet(s) to render.', self.rebuild('--dry-run'))
+        self.assertIn('(1 stale)', self.rebuild('--verify'))
+        self.assertIn('0 sheet(s) to render.', self.rebuild('--verify'))
+
+        os.remove(sheet.renditions.first().image.path)
+        self.assertIn('(1 missing)', self.rebuild('--verify', '--dry-run'))
+
+    def test_shared_files_are_rendered_once(self):
+        self.sheet.generate_thumbnail()
+        twin = MusicSheet.objects.create(
+            song=self.sheet.song, music_sheet=SimpleUploadedFile('agnus.pdf', self.pdf), ms_version='Copy'
+        )
+        with mock.patch('concurrent.futures.ProcessPoolExecutor.submit', autospec=True,
+                        side_effect=ProcessPoolExecutor.submit) as submit:
+            out = self.rebuild('--all')
+        self.assertEqual(submit.call_count, 1)
+        self.assertIn('Rendered 2 sheet(s)', out)
+        self.assertEqual(twin.renditions.count(), 6)
+
+
+class SheetTextTests(MediaRootMixin, UcathTestCase):
+
+    def make_sheet(self, data, song=None):
+        if song is None:
+            song = Song.objects.create(
+                title='Missa Brevis', composer='Palestrina', arranged_by='', part_of_mass='gloria', status='published'
+            )
+        return MusicSheet.objects.create(song=song, music_sheet=SimpleUploadedFile('missa.pdf', data), ms_version='SATB')
+
+    def test_details_are_read_in_the_rendering_pass(self):
+        sheet = self.make_sheet(make_pdf(pages=3, text='Glo - ri - a in ex - cel - sis De - o'))
+        with mock.patch.object(thumbnails.fitz, 'open', wraps=fitz.open) as opened:
+            sheet.generate_thumbnail()
+        opened.assert_called_once()
+        sheet.refresh_from_db()
+        self.assertEqual((sheet.page_count, sheet.page_width, sheet.page_height), (3, 595, 842))
+        self.assertIn('Gloria in excelsis Deo', sheet.text_content)
+
+    def test_library_search_matches_lyrics(self):
+        sheet = self.make_sheet(make_pdf(text='Et in terra pax hominibus'))
+        make_song(1, title='Sanctus')
+        call_command('thumbnail_worker', '--once', '--workers', '1', stdout=StringIO(), stderr=StringIO())
+        self.assertEqual(list(search_songs(Song.objects.all(), 'terra pax')), [sheet.song])
+        response = self.client.get(reverse('song_library'), {'q': 'hominibus'}, headers={'HX-Request': 'true'})
+        self.assertContains(response, 'Missa Brevis')
+
+        sheet.delete()
+        self.assertFalse(search_songs(Song.objects.all(), 'hominibus').exists())
+
+    def test_identical_sheet_reuses_extracted_text(self):
+        pdf = make_pdf(text='Dona nobis pacem')
+        self.make_sheet(pdf).generate_thumbnail()
+        other = Song.objects.create(title='Agnus Dei', composer='Palestrina', arranged_by='', part_of_mass='communion')
+        twin = self.make_sheet(pdf, song=other)
+        self.assertEqual(twin.text_content, 'Dona nobis pacem')
+        self.assertIn(other, search_songs(Song.objects.all(), 'nobis'))
+
+    def test_backfill_command(self):
+        sheet = self.make_sheet(make_pdf(text='Kyrie eleison'))
+        sheet.generate_thumbnail()
+        MusicSheet.objects.update(page_count=None, text_content='')
+        call_command('extract_sheet_text', stdout=StringIO())
+        sheet.refresh_from_db()
+        self.assertEqual((sheet.page_count, sheet.text_content), (1, 'Kyrie eleison'))
+
+
+class ImportCatalogTests(MediaRootMixin, UcathTestCase):
+
+    def write_manifest(self, rows):
+        source_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, source_dir, ignore_errors=True)
+        with open(os.path.join(source_dir, 'gloria.pdf'), 'wb') as pdf:
+            pdf.write(make_pdf())
+        with open(os.path.join(source_dir, 'gloria.mp3'), 'wb') as mp3:
+            mp3.write(b'ID3')
+        with open(os.path.join(source_dir, 'gloria.mid'), 'wb') as midi:
+            midi.write(placeholder_midi())
+        path = os.path.join(source_dir, 'catalog.csv')
+        with open(path, 'w', newline='') as manifest:
+            writer = csv.DictWriter(manifest, fieldnames=['archive_id', 'title', 'composer', 'part_of_mass', 'season', 'sheet', 'ms_version', 'mp3', 'midi'])
+            writer.writeheader()
+            writer.writerows(rows)
+        return path
+
+    def run_import(self, path):
+        out, err = StringIO(), StringIO()
+        call_command('import_catalog', path, '--no-render', '--batch-size', '2', stdout=out, stderr=err)
+        return out.getvalue(), err.getvalue()
+
+    def test_import_is_idempotent_on_archive_id(self):
+        path = self.write_manifest([
+            {'archive_id': 'UCM-1', 'title': 'Gloria', 'composer': 'Kizito', 'part_of_mass': 'Gloria',
+             'season': 'Christmas', 'sheet': 'gloria.pdf', 'ms_version': 'SATB', 'mp3': 'gloria.mp3'},
+            {'archive_id': 'UCM-2', 'title': 'Kyrie', 'part_of_mass': 'penitential'},
+            {'archive_id': 'UCM-3', 'title': 'Sanctus', 'part_of_mass': 'nonsense'},
+            {'archive_id': '', 'title': 'No id', 'part_of_mass': 'others'},
+        ])
+        out, err = self.run_import(path)
+        self.assertIn('Imported 2 song(s), skipped 2.', out)
+        self.assertIn('unknown part_of_mass "nonsense"', err)
+
+        gloria = Song.objects.get(archive_id='UCM-1')
+        self.assertEqual((gloria.part_of_mass, gloria.season, gloria.status), ('gloria', 'christmas', 'published'))
+        sheet = gloria.musicsheet_set.get()
+        self.assertTrue(sheet.slug)
+        self.assertTrue(sheet.music_sheet.storage.exists(sheet.music_sheet.name))
+        self.assertEqual(sheet.thumbnail_jobs.get().status, 'pending')
+        self.assertEqual(gloria.mp3file_set.count(), 1)
+        self.assertEqual(list(search_songs(Song.objects.all(), 'glor')), [gloria])
+
+        out, _ = self.run_import(path)
+        self.assertIn('Imported 0 song(s), skipped 4.', out)
+        self.assertEqual(Song.objects.count(), 2)
+        self.assertEqual(MusicSheet.objects.count(), 1)
+
+    def test_imported_midi_files_are_parsed(self):
+        self.run_import(self.write_manifest([
+            {'archive_id': 'UCM-1', 'title': 'Gloria', 'part_of_mass': 'Gloria', 'midi': 'gloria.mid'},
+        ]))
+        midi = MidiFile.objects.get()
+        self.assertEqual((midi.duration, midi.tempo, midi.part_names), (4.0, 120.0, ['Channel 1']))
+        self.assertEqual(self.client.get(midi.events_url).status_code, 200)
+
+    def test_import_refreshes_cached_pages(self):
+        make_song(1, title='Regina Caeli')
+        for url in (reverse('song_library'), reverse('dashboard')):
+            self.assertNotContains(self.client.get(url), 'Adeste Fideles')
+        self.run_import(self.write_manifest([
+            {'archive_id': 'UCM-1', 'title': 'Adeste Fideles', 'part_of_mass': 'entrance'},
+        ]))
+        for url in (reverse('song_library'), reverse('dashboard')):
+            self.assertContains(self.client.get(url), 'Adeste Fideles')
+
+
+class AssetServingTests(MediaRootMixin, UcathTestCase):
+
+    def setUp(self):
+        super().setUp()
+        song = Song.objects.create(title='Magnificat', composer='Kizito', arranged_by='', part_of_mass='others')
+        self.audio = Mp3File.objects.create(
+            song=song, mp3_file=SimpleUploadedFile('magnificat.mp3', bytes(range(256)) * 4), mp3_version='Master'
+        )
+
+    def get(self, **headers):
+        return self.client.get(self.audio.serve_url, headers=headers)
+
+    def test_full_response_is_cacheable(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), bytes(range(256)) * 4)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(response['Content-Type'], 'audio/mpeg')
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertTrue(response['ETag'].startswith('"'))
+
+    def test_byte_ranges(self):
+        response = self.get(Range='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 10-19/1024')
+        self.assertEqual(b''.join(response.streaming_content), bytes(range(10, 20)))
+
+        response = self.get(Range='bytes=-4')
+        self.assertEqual(response['Content-Range'], 'bytes 1020-1023/1024')
+
+        response = self.get(Range='bytes=2000-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */1024')
+
+    def test_conditional_requests(self):
+        first = self.get()
+        self.assertEqual(self.get(If_None_Match=first['ETag']).status_code, 304)
+        self.assertEqual(self.get(If_Modified_Since=first['Last-Modified']).status_code, 304)
+        self.assertEqual(self.get(If_None_Match='"stale"').status_code, 200)
+        # A stale If-Range turns the range request into a full download
+        self.assertEqual(self.get(Range='bytes=0-1', If_Range='"stale"').status_code, 200)
+
+    def test_download_sheet_is_an_attachment(self):
+        sheet = MusicSheet.objects.create(
+            song=self.audio.song, music_sheet=SimpleUploadedFile('magnificat.pdf', make_pdf()), ms_version='SATB'
+        )
+        response = self.client.get(reverse('download_sheet', args=[sheet.slug]))
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="magnificat_satb.pdf"')
+        self.assertEqual(response['Cache-Control'], 'public, no-cache')
+        response = self.client.get(reverse('download_sheet', args=[sheet.slug]), headers={'If-None-Match': response['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+    async def test_asgi_streams_without_threads(self):
+        response = await self.async_client.get(self.audio.serve_url)
+        self.assertTrue(response.is_async)
+        self.assertEqual(b''.join([chunk async for chunk in response.streaming_content]), bytes(range(256)) * 4)
+        self.assertEqual(response['Content-Length'], '1024')
+        # Headers match the FileResponse sent under WSGI
+        wsgi_response = await sync_to_async(self.get)()
+        self.assertEqual(response['Content-Disposition'], wsgi_response['Content-Disposition'])
+        self.assertEqual(response['ETag'], wsgi_response['ETag'])
+
+        response = await self.async_client.get(self.audio.serve_url, headers={'Range': 'bytes=10-19'})
+        self.assertEqual(response.status_code, 206)
+        self.assertTrue(response.is_async)
+        self.assertEqual(b''.join([chunk async for chunk in response.streaming_content]), bytes(range(10, 20)))
+
+    async def test_slow_downloads_do_not_hold_threads(self):
+        # Two hundred clients, each taking a chunk at a time in turn
+        data = os.urandom(serving.CHUNK_SIZE * 3)
+        audio = await sync_to_async(Mp3File.objects.create)(
+            song=self.audio.song, mp3_file=SimpleUploadedFile('long.mp3', data), mp3_version='Long'
+        )
+        responses = await asyncio.gather(*[self.async_client.get(audio.serve_url) for _ in range(200)])
+        streams = [response.streaming_content.__aiter__() for response in responses]
+        received = [b''] * len(streams)
+        threads = threading.active_count()
+        for _ in range(3):
+            for index, stream in enumerate(streams):
+                received[index] += await anext(stream)
+            threads = max(threads, threading.active_count())
+        self.assertTrue(all(body == data for body in received))
+        self.assertLess(threads, 50)
+
+
+def make_midi(*tracks, division=480):
+    """A format 1 MIDI file of ``tracks``, each a bytes string of events without the end marker."""
+    data = b'MThd' + struct.pack('>IHHH', 6, 1, len(tracks), division)
+    for events in tracks:
+        events += b'\x00\xff\x2f\x00'
+        data += b'MTrk' + struct.pack('>I', len(events)) + events
+    return data
+
+
+class MidiEventTests(MediaRootMixin, UcathTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.song = Song.objects.create(title='Tumsifu', composer='Kizito', arranged_by='', part_of_mass='gloria')
+        self.client.force_login(User.objects.create_user('cantor', is_staff=True))
+
+    def upload(self, data, name='tumsifu.mid'):
+        self.client.post(reverse('upload_midi', args=[self.song.slug]), {
+            'file': SimpleUploadedFile(name, data), 'midi_version': 'SATB',
+        })
+        return MidiFile.objects.get(song=self.song)
+
+    def test_parser_follows_the_tempo_map_and_splits_parts(self):
+        # 120 BPM for the first two beats, then 60 BPM
+        conductor = b'\x00\xff\x51\x03\x07\xa1\x20' + b'\x87\x40\xff\x51\x03\x0f\x42\x40'
+        # Two crotchets with running status and a velocity-0 note-off
+        soprano = b'\x00\xff\x03\x07Soprano' + b'\x00\x90\x43\x50\x83\x60\x43\x00' + b'\x83\x60\x45\x50\x83\x60\x80\x45\x40'
+        alto = b'\x00\xff\x03\x04Alto' + b'\x00\x91\x3c\x40\x8f\x00\x81\x3c\x40'
+        details = parse_midi(make_midi(conductor, soprano, alto))
+
+        self.assertEqual(details['tempo'], 120.0)
+        self.assertEqual(details['track_names'], ['Soprano', 'Alto'])
+        self.assertEqual(details['part_names'], ['Soprano', 'Alto'])
+        # Second note starts on beat 3, where the tempo has halved
+        self.assertEqual(details['events']['parts'][0]['notes'], [0, 500, 67, 80, 1000, 1000, 69, 80])
+        self.assertEqual(details['events']['parts'][1]['notes'], [0, 3000, 60, 64])
+        self.assertEqual(details['duration'], 3.0)
+        self.assertEqual(details['events']['duration'], 3000)
+
+        with self.assertRaises(MidiError):
+            parse_midi(b'RIFF not a midi file')
+
+    def test_replacing_the_file_reads_it_again(self):
+        midi = self.upload(placeholder_midi())
+        old_url = midi.events_url
+        # As the admin's change form does it
+        midi = MidiFile.objects.get(pk=midi.pk)
+        midi.midi_file = SimpleUploadedFile('slower.mid', make_midi(
+            b'\x00\xff\x51\x03\x0f\x42\x40' + b'\x00\x90\x3c\x40\x83\x60\x80\x3c\x40'
+        ))
+        midi.save()
+        midi = MidiFile.objects.get(pk=midi.pk)
+        self.assertEqual((midi.duration, midi.tempo), (1.0, 60.0))
+        self.assertNotEqual(midi.events_url, old_url)
+        response = self.client.get(midi.events_url)
+        self.assertEqual(json.loads(b''.join(response)), json.loads(gzip.decompress(midi.note_events)))
+
+        midi.midi_file = SimpleUploadedFile('broken.mid', b'not a midi file')
+        midi.save(update_fields=['midi_file'])
+        midi.refresh_from_db()
+        self.assertEqual((midi.duration, midi.note_events, midi.events_url), (None, None, None))
+
+    def test_upload_is_parsed_once_and_served_compressed(self):
+        midi = self.upload(placeholder_midi())
+        self.assertEqual((midi.duration, midi.tempo, midi.part_names), (4.0, 120.0, ['Channel 1']))
+
+        response = self.client.get(midi.events_url, headers={'Accept-Encoding': 'gzip, br'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertIn('Accept-Encoding', response['Vary'])
+        events = json.loads(gzip.decompress(response.content))
+        self.assertEqual(events['parts'][0]['notes'][:8], [0, 500, 60, 80, 500, 500, 62, 80])
+
+        plain = self.client.get(midi.events_url)
+        self.assertFalse(plain.has_header('Content-Encoding'))
+        self.assertEqual(json.loads(plain.content), events)
+        self.assertNotEqual(plain['ETag'], response['ETag'])
+        revalidated = self.client.get(
+            midi.events_url, headers={'Accept-Encoding': 'gzip', 'If-None-Match': response['ETag']}
+        )
+        self.assertEqual(revalidated.status_code, 304)
+        stale = self.client.get(reverse('serve_note_events', args=[midi.pk, 'old.json']))
+        self.assertRedirects(stale, midi.events_url, fetch_redirect_response=False)
+
+    def test_duration_is_shown_without_reading_the_file(self):
+        self.song.status = 'published'
+        self.song.save()
+        midi = self.upload(placeholder_midi())
+        os.remove(midi.midi_file.path)
+        self.assertContains(self.client.get(reverse('song_library')), '0:04')
+        response = self.client.get(reverse('song_detail', args=[self.song.slug]))
+        self.assertContains(response, f'data-note-events="{midi.events_url}"')
+        self.assertContains(response, '120 BPM')
+
+    def test_unreadable_file_is_kept_for_download(self):
+        midi = self.upload(b'MThd broken', name='broken.mid')
+        self.assertIsNone(midi.duration)
+        self.assertIsNone(midi.events_url)
+        self.assertEqual(self.client.get(reverse('serve_note_events', args=[midi.pk, 'broken.json'])).status_code, 404)
+
+    def test_backfill_command(self):
+        midi = self.upload(placeholder_midi())
+        MidiFile.objects.filter(pk=midi.pk).update(duration=None, note_events=None)
+        call_command('extract_midi_events', stdout=StringIO())
+        midi.refresh_from_db()
+        self.assertEqual(midi.duration, 4.0)
+        self.assertIsNotNone(midi.note_events)
+
+
+class ContentAddressedStorageTests(MediaRootMixin, UcathTestCase):
+
+    def test_identical_uploads_share_one_blob(self):
+        song = Song.objects.create(title='Pange Lingua', composer='Aquinas', arranged_by='', part_of_mass='others')
+        first = Mp3File.objects.create(song=song, mp3_file=SimpleUploadedFile('a.mp3', b'same bytes'))
+        second = Mp3File.objects.create(song=song, mp3_file=SimpleUploadedFile('b.mp3', b'same bytes'))
+        other = Mp3File.objects.create(song=song, mp3_file=SimpleUploadedFile('c.mp3', b'other bytes'))
+
+        self.assertEqual(first.mp3_file.name, second.mp3_file.name)
+        self.assertNotEqual(first.mp3_file.name, other.mp3_file.name)
+        self.assertRegex(first.mp3_file.name, r'^mp3_files/[0-9a-f]{2}/[0-9a-f]{64}\.mp3$')
+        self.assertEqual(StoredBlob.objects.get(name=first.mp3_file.name).ref_count, 2)
+
+        name, storage = first.mp3_file.name, first.mp3_file.storage
+        first.mp3_file.delete(save=False)
+        self.assertTrue(storage.exists(name))
+        second.mp3_file.delete(save=False)
+        self.assertFalse(storage.exists(name))
+        self.assertFalse(StoredBlob.objects.filter(name=name).exists())
+
+    def test_deleting_assets_releases_their_files(self):
+        song = Song.objects.create(title='Pange Lingua', composer='Aquinas', arranged_by='', part_of_mass='others')
+        first = Mp3File.objects.create(song=song, mp3_file=SimpleUploadedFile('a.mp3', b'same bytes'))
+        Mp3File.objects.create(song=song, mp3_file=SimpleUploadedFile('b.mp3', b'same bytes'))
+        sheet = MusicSheet.objects.create(song=song, music_sheet=SimpleUploadedFile('a.pdf', make_pdf()))
+        sheet.generate_thumbnail()
+        names = [first.mp3_file.name, sheet.music_sheet.name, *sheet.renditions.values_list('image', flat=True)]
+        storage = first.mp3_file.storage
+
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertEqual(StoredBlob.objects.get(name=first.mp3_file.name).ref_count, 1)
+        self.assertTrue(storage.exists(first.mp3_file.name))
+
+        # The other recording, the sheet and its renditions go with the song
+        with self.captureOnCommitCallbacks(execute=True):
+            song.delete()
+        self.assertFalse(StoredBlob.objects.filter(name__in=names).exists())
+        self.assertFalse([name for name in names if storage.exists(name)])
+
+    def test_duplicate_sheet_reuses_renditions(self):
+        song = Song.objects.create(title='Adoro Te', composer='Aquinas', arranged_by='', part_of_mass='communion')
+        pdf = make_pdf()
+        first = MusicSheet.objects.create(song=song, music_sheet=SimpleUploadedFile('a.pdf', pdf), ms_version='SATB')
+        call_command('thumbnail_worker', '--once', '--workers', '1', stdout=StringIO())
+
+        second = MusicSheet.objects.create(song=song, music_sheet=SimpleUploadedFile('b.pdf', pdf), ms_version='Unison')
+        first.refresh_from_db()
+        self.assertFalse(second.thumbnail_jobs.exists())
+        self.assertEqual(second.thumbnail.name, first.thumbnail.name)
+        self.assertEqual(second.renditions.count(), 6)
+        self.assertEqual(StoredBlob.objects.get(name=first.thumbnail.name).ref_count, 2)
+
+
+class PageCacheTests(UcathTestCase):
+
+    def count_queries(self, url, **headers):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url, headers=headers)
+        self.assertEqual(response.status_code, 200)
+        return len(ctx.captured_queries), response
+
+    def test_landing_is_served_from_cache_until_a_song_changes(self):
+        song = make_song(1, title='Regina Caeli')
+        url = reverse('dashboard')
+        cold, _ = self.count_queries(url)
+        warm, _ = self.count_queries(url)
+        self.assertLess(warm, cold)
+
+        song.title = 'Regina Coeli'
+        song.save()
+        _, response = self.count_queries(url)
+        self.assertContains(response, 'Regina Coeli')
+
+    def test_song_detail_is_invalidated_by_asset_changes(self):
+        song = make_song(1)
+        url = reverse('song_detail', args=[song.slug])
+        cold, _ = self.count_queries(url)
+        warm, _ = self.count_queries(url)
+        self.assertLess(warm, cold)
+
+        Mp3File.objects.create(song=song, mp3_file='mp3_files/extra.mp3', mp3_version='Alto line')
+        _, response = self.count_queries(url)
+        self.assertEqual(len(response.context['audios']), 2)
+
+    def test_library_grid_fragment_is_keyed_by_filters(self):
+        make_song(1, title='Attende Domine', season='lent')
+        make_song(2, title='Adeste Fideles', season='christmas')
+        url = reverse('song_library')
+        cold, _ = self.count_queries(url + '?season=lent', HX_Request='true')
+        warm, response = self.count_queries(url + '?season=lent', HX_Request='true')
+        self.assertLess(warm, cold)
+        self.assertContains(response, 'Attende Domine')
+        self.assertNotContains(response, 'Adeste Fideles')
+
+        _, response = self.count_queries(url + '?season=christmas', HX_Request='true')
+        self.assertContains(response, 'Adeste Fideles')
+
+        make_song(3, title='Parce Domine', season='lent')
+        _, response = self.count_queries(url + '?season=lent', HX_Request='true')
+        self.assertContains(response, 'Parce Domine')
+
+    def test_cached_search_skips_the_search_index(self):
+        make_song(1, title='Tantum Ergo')
+        make_song(2, title='Veni Creator')
+        for q, index_queries in (('tantum', 2), ('tantun', 4)):
+            url = f"{reverse('song_library')}?q={q}"
+            with CaptureQueriesContext(connection) as cold:
+                self.client.get(url)
+            with CaptureQueriesContext(connection) as warm:
+                response = self.client.get(url)
+            searches = lambda ctx: [query for query in ctx.captured_queries if re.search(r' MATCH |songtrigram', query['sql'])]
+            # Page and facets: one MATCH each, plus the fuzzy lookups after a miss
+            self.assertEqual(len(searches(cold)), index_queries)
+            self.assertEqual(searches(warm), [])
+            self.assertEqual([song.title for song in response.context['songs']], ['Tantum Ergo'])
+
+
+class LibraryFacetTests(UcathTestCase):
+
+    def setUp(self):
+        super().setUp()
+        make_song(1, title='Attende Domine', season='lent', part_of_mass='entrance')
+        make_song(2, title='Parce Domine', season='lent', part_of_mass='communion')
+        make_song(3, title='Adeste Fideles', season='christmas', part_of_mass='entrance')
+        make_song(4, title='Hidden Domine', season='lent', status='pending_approval')
+
+    def facets(self, query=''):
+        with CaptureQueriesContext(connection) as ctx:
+            facets = views.library_facets(QueryDict(query))
+        return {name: {value: count for value, _, count in choices} for name, choices in facets.items()}, ctx
+
+    def test_counts_come_from_one_grouped_query(self):
+        facets, ctx = self.facets()
+        self.assertEqual(len(ctx.captured_queries), 1)
+        self.assertIn('GROUP BY', ctx.captured_queries[0]['sql'])
+        self.assertEqual(facets['seasons']['lent'], 2)
+        self.assertEqual(facets['seasons']['christmas'], 1)
+        self.assertEqual(facets['seasons']['easter'], 0)
+        self.assertEqual(facets['parts']['entrance'], 2)
+
+        _, ctx = self.facets()
+        self.assertEqual(len(ctx.captured_queries), 0)
+
+    def test_each_facet_ignores_its_own_filter(self):
+        facets, _ = self.facets('season=lent&part=entrance')
+        # Seasons are counted within the entrance songs, parts within Lent
+        self.assertEqual(facets['seasons']['lent'], 1)
+        self.assertEqual(facets['seasons']['christmas'], 1)
+        self.assertEqual(facets['parts']['entrance'], 1)
+        self.assertEqual(facets['parts']['communion'], 1)
+
+        facets, _ = self.facets('q=domine')
+        self.assertEqual(facets['seasons']['lent'], 2)
+        self.assertEqual(facets['seasons']['christmas'], 0)
+
+    def test_counts_follow_catalog_changes(self):
+        self.facets()
+        make_song(5, title='Puer Natus', season='christmas')
+        facets, _ = self.facets()
+        self.assertEqual(facets['seasons']['christmas'], 2)
+
+    def test_htmx_grid_updates_the_counts_out_of_band(self):
+        response = self.client.get(reverse('song_library'), {'q': 'domine'}, headers={'HX-Request': 'true'})
+        self.assertContains(response, 'id="facet-season-lent" hx-swap-oob="true"')
+        self.assertContains(response, 'id="facet-part-communion" hx-swap-oob="true"')
+        response = self.client.get(reverse('song_library'))
+        self.assertContains(response, 'id="facet-season-lent"')
+        self.assertNotContains(response, 'hx-swap-oob')
+
+
+@skipUnless(connection.vendor == 'sqlite', 'EXPLAIN QUERY PLAN output is SQLite specific')
+class SongQueryPlanTests(UcathTestCase):
+
+    def song_query_plans(self, url, **params):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        plans = []
+        for query in ctx.captured_queries:
+            sql = query['sql']
+            if 'FROM "ucath_songs_song"' in sql and 'ORDER BY' in sql:
+                with connection.cursor() as cursor:
+                    cursor.execute(f'EXPLAIN QUERY PLAN {sql}')
+                    plans.append([row[-1] for row in cursor.fetchall()])
+        self.assertTrue(plans, f'no song listing query ran for {url}')
+        return plans
+
+    def assertIndexedPlans(self, plans):
+        for plan in plans:
+            for step in plan:
+                self.assertNotIn('TEMP B-TREE', step, plan)
+                if step.startswith('SCAN ucath_songs_song'):
+                    self.assertIn('USING', step, plan)
+
+    def setUp(self):
+        super().setUp()
+        for index in range(30):
+            make_song(index, status='published' if index % 4 else 'pending_approval',
+                      season='lent' if index % 3 else 'easter')
+
+    def test_landing_uses_status_index(self):
+        self.assertIndexedPlans(self.song_query_plans(reverse('dashboard')))
+
+    def test_library_filters_and_pages_use_status_index(self):
+        url = reverse('song_library')
+        self.assertIndexedPlans(self.song_query_plans(url))
+        self.assertIndexedPlans(self.song_query_plans(url, season=['lent', 'easter'], part=['entrance']))
+        cursor = self.client.get(url).context['next_page_url'].split('cursor=')[1]
+        self.assertIndexedPlans(self.song_query_plans(url, season='lent', cursor=unquote(cursor)))
+
+    def test_admin_arrivals_use_status_index(self):
+        staff = User.objects.create_user('staff', password='secret', is_staff=True)
+        self.client.force_login(staff)
+        self.assertIndexedPlans(self.song_query_plans(reverse('admin_arrivals')))
+
+
+class KeysetPaginationTests(UcathTestCase):
+
+    def walk(self, **params):
+        titles, url = [], reverse('song_library')
+        response = self.client.get(url, params, headers={'HX-Request': 'true'})
+        while True:
+            titles += [song.title for song in response.context['songs']]
+            next_url = response.context.get('next_page_url')
+            if not next_url:
+                return titles
+            self.assertContains(response, f'hx-get="{next_url.replace("&", "&amp;")}"')
+            response = self.client.get(next_url, headers={'HX-Request': 'true'})
+            self.assertTemplateUsed(response, 'partials/song_cards.html')
+            self.assertNotContains(response, 'id="songGrid"')
+
+    def test_pages_cover_catalog_newest_first(self):
+        for index in range(30):
+            make_song(index, season='lent' if index % 3 else 'easter')
+        self.assertEqual(self.walk(), [f'Song {index}' for index in reversed(range(30))])
+        self.assertEqual(self.walk(season='easter'), [f'Song {index}' for index in reversed(range(0, 30, 3))])
+
+    def test_search_results_page_in_rank_order(self):
+        for index in range(15):
+            make_song(index, title=f'Gloria {index}', composer='Kizito')
+        for index in range(15, 30):
+            make_song(index, title=f'Song {index}', composer='Gloria Nakato')
+        titles = self.walk(q='gloria')
+        self.assertEqual(len(titles), 30)
+        self.assertEqual(len(set(titles)), 30)
+        self.assertTrue(all(title.startswith('Gloria') for title in titles[:15]))
+
+    def test_no_count_query(self):
+        for index in range(20):
+            make_song(index)
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get(reverse('song_library'), headers={'HX-Request': 'true'})
+        # The facet counts' GROUP BY is the only aggregate; pages never count
+        self.assertFalse([q for q in ctx.captured_queries if 'COUNT(' in q['sql'] and 'GROUP BY' not in q['sql']])
+
+    def test_tampered_cursor_is_rejected(self):
+        response = self.client.get(reverse('song_library'), {'cursor': 'forged'}, headers={'HX-Request': 'true'})
+        self.assertEqual(response.status_code, 404)
+
+
+class SongIndexStreamingTests(UcathTestCase):
+
+    def fetch(self):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse('song_links'))
+            body = b''.join(response.streaming_content).decode()
+        return len(ctx.captured_queries), response, body
+
+    def test_index_streams_all_sheets_in_title_order(self):
+        make_song(1, title='sanctus')
+        make_song(2, title='agnus dei')
+        small, response, body = self.fetch()
+        self.assertTrue(response.streaming)
+        self.assertLess(body.index('Agnus Dei — SATB'), body.index('Sanctus — SATB'))
+        self.assertIn(reverse('download_sheet', args=[MusicSheet.objects.first().slug]), body)
+        self.assertTrue(body.rstrip().endswith('</html>'))
+
+        for index in range(3, 40):
+            make_song(index)
+        large, _, body = self.fetch()
+        self.assertEqual(small, large)
+        self.assertEqual(body.count('class="song-item'), 39)
+
+
+class SyntheticCatalogTests(MediaRootMixin, UcathTestCase):
+
+    def test_seed_catalog_shares_placeholder_media(self):
+        call_command('seed_catalog', songs=25, seed=1, batch_size=10, stdout=StringIO())
+        self.assertEqual(Song.objects.filter(status='published').count(), 25)
+        sheets = MusicSheet.objects.count()
+        self.assertGreaterEqual(sheets, 25)
+        self.assertEqual(MusicSheet.objects.values('music_sheet').distinct().count(), 1)
+        sheet_blob = StoredBlob.objects.get(name=MusicSheet.objects.first().music_sheet.name)
+        self.assertEqual(sheet_blob.ref_count, sheets)
+        self.assertEqual(MusicSheet.objects.first().renditions.count(), 6)
+        song = Song.objects.first()
+        self.assertIn(song, search_songs(Song.objects.all(), song.title))
+
+    def test_benchmark_views_writes_json_report(self):
+        output = os.path.join(tempfile.mkdtemp(), 'report.json')
+        self.addCleanup(shutil.rmtree, os.path.dirname(output), ignore_errors=True)
+        call_command('benchmark_views', sizes=[5], runs=2, output=output, stdout=StringIO(), stderr=StringIO())
+        with open(output) as handle:
+            report = json.load(handle)
+        views = report['sizes']['5']
+        for name in ['dashboard', 'song_library', 'song_detail', 'song_links', 'serve_asset', 'admin_arrivals']:
+            self.assertEqual(views[name]['status'], 200, name)
+            self.assertLessEqual(views[name]['p50_ms'], views[name]['p95_ms'])
+            self.assertGreater(views[name]['bytes'], 0)
+        self.assertEqual(views['admin_arrivals']['user'], 'staff')
+        self.assertEqual(views['about']['queries'], 0)
+        # The synthetic catalog is rolled back
+        self.assertFalse(Song.objects.exists())
+
+
+class SessionWriteTests(UcathTestCase):
+
+    def setUp(self):
+        super().setUp()
+        User.objects.create_user('cantor', password='secret')
+
+    def login(self):
+        response = self.client.post(reverse('login'), {'username': 'cantor', 'password': 'secret'})
+        self.assertRedirects(response, reverse('dashboard'), fetch_redirect_response=False)
+
+    def session_writes(self, url):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        writes = [q['sql'] for q in ctx.captured_queries if 'django_session' in q['sql'] and not q['sql'].startswith('SELECT')]
+        return response, writes
+
+    @override_settings(MESSAGE_STORAGE='django.contrib.messages.storage.session.SessionStorage')
+    def test_login_message_and_logout_go_through_the_session(self):
+        self.login()
+        response, writes = self.session_writes(reverse('dashboard'))
+        self.assertTrue(response.wsgi_request.user.is_authenticated)
+        self.assertContains(response, 'Welcome back, CANTOR')
+        # Showing the message took it out of the session
+        self.assertEqual(len(writes), 1)
+
+        session_key = self.client.session.session_key
+        self.client.post(reverse('logout'))
+        self.assertFalse(Session.objects.filter(session_key=session_key).exists())
+        response, _ = self.session_writes(reverse('dashboard'))
+        self.assertFalse(response.wsgi_request.user.is_authenticated)
+        self.assertContains(response, 'You have been logged out successfully.')
+
+    def test_read_only_views_do_not_write_the_session(self):
+        self.login()
+        self.client.get(reverse('dashboard'))
+        for url in [reverse('song_library'), reverse('dashboard'), reverse('song_library')]:
+            _, writes = self.session_writes(url)
+            self.assertEqual(writes, [])
+        # A cold cache reads the session back from the database, still without writing
+        cache.clear()
+        response, writes = self.session_writes(reverse('song_library'))
+        self.assertTrue(response.wsgi_request.user.is_authenticated)
+        self.assertEqual(writes, [])
+
+    def test_unchanged_session_only_refreshes_its_expiry(self):
+        self.login()
+        self.client.get(reverse('dashboard'))
+        expiry = Session.objects.get().expire_date
+        with override_settings(SESSION_REFRESH_INTERVAL=0):
+            _, writes = self.session_writes(reverse('song_library'))
+        self.assertEqual(len(writes), 1)
+        self.assertTrue(writes[0].startswith('UPDATE "django_session" SET "expire_date"'))
+        self.assertGreater(Session.objects.get().expire_date, expiry)
+
+
+class SqliteProfileTests(UcathTestCase):
+
+    def test_profile_options(self):
+        options = sqlite_options('concurrent')
+        self.assertIn('PRAGMA journal_mode = WAL', options['init_command'])
+        self.assertIn('PRAGMA busy_timeout = 5000', options['init_command'])
+        self.assertEqual(options['transaction_mode'], 'IMMEDIATE')
+        read_options = sqlite_options('concurrent', read_only=True)
+        self.assertIn('PRAGMA query_only = ON', read_options['init_command'])
+        self.assertNotIn('transaction_mode', read_options)
+        self.assertEqual(sqlite_options('stock'), {'init_command': ''})
+
+    def test_reads_leave_the_write_connection_outside_transactions(self):
+        router = ReadConnectionRouter()
+        # Every TestCase runs inside a transaction on default
+        self.assertEqual(router.db_for_read(Song), 'default')
+        with mock.patch.object(connections['default'], 'in_atomic_block', False):
+            self.assertEqual(router.db_for_read(Song), 'read')
+        self.assertEqual(router.db_for_write(Song), 'default')
+        self.assertFalse(router.allow_migrate('read', 'ucath_songs'))
+
+    def test_concurrent_profile_never_reports_locked(self):
+        output = os.path.join(tempfile.mkdtemp(), 'sqlite.json')
+        self.addCleanup(shutil.rmtree, os.path.dirname(output), ignore_errors=True)
+        # The worker threads open their own connections to scratch files
+        call_command('benchmark_sqlite', seconds=0.3, readers=2, writers=2, output=output, stdout=StringIO())
+        with open(output) as report:
+            results = json.load(report)
+        self.assertEqual(results['stock']['journal_mode'], 'delete')
+        self.assertEqual(results['concurrent']['journal_mode'], 'wal')
+        self.assertEqual(results['concurrent']['locked'], 0)
+        self.assertGreater(results['concurrent']['reads'], 0)
+        self.assertGreater(results['concurrent']['writes'], 0)
+
+
+@ucath_settings
+class ReadConnectionTests(TransactionTestCase):
+    # Outside a TestCase transaction, so the router really sends reads to 'read'
+    databases = {'default', 'read'}
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+    def test_page_reads_use_the_read_connection(self):
+        make_song(1, title='Ubi Caritas')
+        User.objects.create_user('cantor', password='secret')
+        with CaptureQueriesContext(connections['default']) as writes, \
+                CaptureQueriesContext(connections['read']) as reads:
+            self.assertTrue(self.client.login(username='cantor', password='secret'))
+            response = self.client.get(reverse('song_library'))
+        self.assertContains(response, 'Ubi Caritas')
+
+        self.assertTrue(any('ucath_songs_song' in query['sql'] for query in reads.captured_queries))
+        self.assertTrue(all(query['sql'].startswith('SELECT') for query in reads.captured_queries))
+        self.assertFalse([query for query in writes.captured_queries if query['sql'].startswith('SELECT')])
+        # The login's last_login and session rows
+        self.assertTrue(any(query['sql'].startswith('UPDATE "auth_user"') for query in writes.captured_queries))
+
+
+class StaticFilesTests(UcathTestCase):
+
+    def setUp(self):
+        super().setUp()
+        static_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, static_root, ignore_errors=True)
+        static_settings = override_settings(STATIC_ROOT=static_root, STORAGES={
+            **settings.STORAGES,
+            'staticfiles': {'BACKEND': 'ucath_songs.staticfiles.CompressedManifestStaticFilesStorage'},
+        })
+        static_settings.enable()
+        self.addCleanup(static_settings.disable)
+        call_command('collectstatic', interactive=False, ignore_patterns=['admin'], stdout=StringIO())
+        with open(os.path.join(static_root, 'staticfiles.json')) as manifest:
+            self.main_css = json.load(manifest)['paths']['css/main.css']
+        self.static_root = static_root
+
+    def get(self, name, **headers):
+        return self.client.get(settings.STATIC_URL + name, headers=headers)
+
+    def test_collectstatic_writes_hashed_and_compressed_copies(self):
+        self.assertRegex(self.main_css, r'^css/main\.[0-9a-f]{12}\.css$')
+        for name in ['css/main.css', self.main_css]:
+            for suffix in ['.gz', '.br']:
+                self.assertTrue(os.path.exists(os.path.join(self.static_root, name + suffix)))
+        # Already compressed formats are left alone
+        self.assertFalse(os.path.exists(os.path.join(self.static_root, 'images/cantus.png.gz')))
+        self.assertContains(self.client.get(reverse('dashboard')), f'{settings.STATIC_URL}{self.main_css}')
+
+    def test_middleware_serves_the_accepted_variant_as_immutable(self):
+        with open(os.path.join(self.static_root, 'css/main.css'), 'rb') as original:
+            css = original.read()
+        response = self.get(self.main_css, Accept_Encoding='gzip, deflate, br')
+        self.assertEqual(response['Content-Encoding'], 'br')
+        self.assertEqual(response['Cache-Control'], 'public, max-age=31536000, immutable')
+        self.assertEqual(response['Content-Type'], 'text/css')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        # Served ahead of the session middleware
+        self.assertNotIn('Cookie', response['Vary'])
+
+        response = self.get(self.main_css, Accept_Encoding='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(b''.join(response.streaming_content)), css)
+
+        response = self.get(self.main_css)
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(b''.join(response.streaming_content), css)
+        self.assertEqual(self.get(self.main_css, If_None_Match=response['ETag']).status_code, 304)
+
+    def test_plain_names_are_revalidated(self):
+        response = self.get('css/main.css', Accept_Encoding='gzip')
+        self.assertEqual(response['Cache-Control'], 'public, no-cache')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        response = self.get('images/cantus.png', Accept_Encoding='gzip, br')
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertFalse(response.has_header('Vary'))
+        self.assertEqual(self.get('css/missing.css').status_code, 404)
+
+
+class ServerTimingTests(UcathTestCase):
+
+    def timings(self, response):
+        entries = {}
+        for entry in response['Server-Timing'].split(', '):
+            name, *params = entry.split(';')
+            entries[name] = dict(param.split('=', 1) for param in params)
+        return entries
+
+    def test_header_reports_queries_and_template_time(self):
+        make_song(1)
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse('song_library'))
+        timings = self.timings(response)
+        self.assertEqual(timings['db']['desc'], f'"{len(ctx.captured_queries)} queries"')
+        self.assertGreater(float(timings['template']['dur']), 0)
+        self.assertGreaterEqual(float(timings['total']['dur']), float(timings['template']['dur']))
+
+    def test_metrics_endpoint_is_staff_only_prometheus_text(self):
+        make_song(1)
+        self.client.get(reverse('song_library'))
+        b''.join(self.client.get(reverse('song_links')).streaming_content)
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+
+        staff = User.objects.create_user('staff', password='secret', is_staff=True)
+        self.client.force_login(staff)
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        body = response.content.decode()
+        self.assertIn('# TYPE ucath_request_duration_seconds histogram', body)
+        self.assertIn('ucath_request_duration_seconds_bucket{view="song_library",method="GET",le="+Inf"}', body)
+        # Streamed responses are observed once their body has been sent
+        self.assertIn('ucath_request_db_queries_count{view="song_links",method="GET"}', body)
+        self.assertIn('ucath_requests_total{view="metrics",method="GET",status="403"}', body)
+
+
+class LibraryExportTests(MediaRootMixin, UcathTestCase):
+
+    def make_song_with_files(self, index, **kwargs):
+        song = make_song(index, **kwargs)
+        for name in [f'music_sheets/song_{index}.pdf', f'mp3_files/song_{index}.mp3']:
+            path = os.path.join(settings.MEDIA_ROOT, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as handle:
+                handle.write(f'{name} '.encode() * 20000)
+        return song
+
+    def export(self, **params):
+        response = self.client.get(reverse('export_library'), params)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        chunks = list(response.streaming_content)
+        archive = zipfile.ZipFile(BytesIO(b''.join(chunks)))
+        self.assertIsNone(archive.testzip())
+        return response, chunks, archive
+
+    def test_export_follows_library_filters(self):
+        self.make_song_with_files(1, title='Sanctus', season='lent')
+        self.make_song_with_files(2, title='Gloria', season='christmas')
+        self.make_song_with_files(3, title='Sanctus', season='lent', part_of_mass='communion')
+        response, chunks, archive = self.export(season='lent')
+        self.assertIn('ucath_lent.zip', response['Content-Disposition'])
+        self.assertGreater(len(chunks), 2)
+        self.assertEqual(archive.namelist(), ['sanctus_satb.pdf', 'sanctus_satb-2.pdf'])
+        self.assertEqual(archive.read('sanctus_satb.pdf'), b'music_sheets/song_1.pdf ' * 20000)
+
+        _, _, archive = self.export(season='lent', part='communion', include='audio')
+        self.assertEqual(archive.namelist(), ['sanctus_satb.pdf', 'sanctus_master.mp3'])
+
+        _, _, archive = self.export(q='gloria')
+        self.assertEqual(archive.namelist(), ['gloria_satb.pdf'])
+
+    def test_unpublished_and_missing_files_are_left_out(self):
+        self.make_song_with_files(1, title='Kyrie', status='pending_approval')
+        make_song(2, title='Agnus Dei')
+        _, _, archive = self.export()
+        self.assertEqual(archive.namelist(), [])
+
+
+class ChunkedUploadTests(MediaRootMixin, UcathTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.staff = User.objects.create_user('staff', password='secret', is_staff=True)
+        self.client.force_login(self.staff)
+        self.song = Song.objects.create(title='Salve Regina', composer='Hermann', arranged_by='', part_of_mass='others')
+
+    def start(self, data, kind='sheet', filename='score.pdf'):
+        response = self.client.post(reverse('upload_start'), {'kind': kind, 'filename': filename, 'size': len(data)})
+        self.assertEqual(response.status_code, 201)
+        return response.json()['id']
+
+    def put(self, upload_id, data, start, total):
+        return self.client.put(
+            reverse('upload_chunk', args=[upload_id]), data,
+            content_type='application/octet-stream',
+            headers={'Content-Range': f'bytes {start}-{start + len(data) - 1}/{total}'},
+        )
+
+    def send(self, data, kind='sheet', filename='score.pdf', chunk=4096, forget_hashes=False):
+        upload_id = self.start(data, kind, filename)
+        for start in range(0, len(data), chunk):
+            if forget_hashes:
+                uploads._hashes.clear()
+            response = self.put(upload_id, data[start:start + chunk], start, len(data))
+            self.assertEqual(response.json()['offset'], min(start + chunk, len(data)))
+        response = self.client.post(reverse('upload_complete', args=[upload_id]))
+        self.assertEqual(response.json()['status'], 'complete')
+        return upload_id
+
+    def test_resumed_upload_becomes_a_sheet(self):
+        pdf = make_pdf(pages=3)
+        upload_id = self.start(pdf)
+        self.assertEqual(self.put(upload_id, pdf[:512], 0, len(pdf)).json()['offset'], 512)
+        # A retried or out-of-order chunk is refused with the offset to resume from
+        response = self.put(upload_id, pdf[1024:1536], 1024, len(pdf))
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['offset'], 512)
+        self.assertEqual(self.client.get(reverse('upload_chunk', args=[upload_id])).json()['offset'], 512)
+        self.put(upload_id, pdf[512:], 512, len(pdf))
+        complete = self.client.post(reverse('upload_complete', args=[upload_id])).json()
+        self.assertEqual(complete['status'], 'complete')
+
+        self.client.post(reverse('upload_sheet', args=[self.song.slug]), {'upload_id': upload_id, 'ms_version': 'SATB'})
+        sheet = MusicSheet.objects.get(song=self.song)
+        self.assertRegex(sheet.music_sheet.name, r'^music_sheets/[0-9a-f]{2}/[0-9a-f]{64}\.pdf$')
+        with sheet.music_sheet.open('rb') as handle:
+            self.assertEqual(handle.read(), pdf)
+        self.assertEqual(StoredBlob.objects.get(name=sheet.music_sheet.name).ref_count, 1)
+        self.assertFalse(ChunkedUpload.objects.exists())
+
+    def test_hash_is_rebuilt_when_another_process_took_the_chunks(self):
+        data = os.urandom(20000)
+        upload_id = self.send(data, kind='audio', filename='take.mp3', forget_hashes=True)
+        self.client.post(reverse('upload_audio', args=[self.song.slug]), {'upload_id': upload_id, 'mp3_version': 'Master'})
+        name = Mp3File.objects.get(song=self.song).mp3_file.name
+        self.assertEqual(StoredBlob.objects.get(name=name).sha256, hashlib.sha256(data).hexdigest())
+
+    def test_incomplete_or_foreign_uploads_cannot_be_claimed(self):
+        data = b'MThd' + bytes(100)
+        upload_id = self.start(data, kind='midi', filename='organ.mid')
+        self.assertEqual(self.client.post(reverse('upload_complete', args=[upload_id])).status_code, 409)
+        self.assertIsNone(uploads.claim_upload(upload_id, 'midi', self.staff))
+
+        finished = self.send(data, kind='midi', filename='organ.mid')
+        other = User.objects.create_user('other', password='secret', is_staff=True)
+        self.assertIsNone(uploads.claim_upload(finished, 'midi', other))
+        self.assertIsNone(uploads.claim_upload(finished, 'sheet', self.staff))
+        self.assertTrue(uploads.claim_upload(finished, 'midi', self.staff).startswith('midi_files/'))
+
+    def test_song_upload_form_accepts_upload_ids(self):
+        sheet_id = self.send(make_pdf())
+        audio_id = self.send(b'ID3' + bytes(5000), kind='audio', filename='take.mp3')
+        response = self.client.post(reverse('upload_song'), {
+            'title': 'Ubi Caritas', 'composer': 'Durufle', 'part_of_mass': 'offertory', 'season': 'lent',
+            'music_sheet_upload': sheet_id, 'ms_version': 'SATB',
+            'mp3_file_upload': audio_id, 'mp3_version': 'Master',
+        })
+        self.assertEqual(response.status_code, 302)
+        song = Song.objects.get(title='Ubi Caritas')
+        self.assertEqual(song.musicsheet_set.count(), 1)
+        self.assertEqual(song.mp3file_set.count(), 1)
+        self.assertFalse(ChunkedUpload.objects.exists())
+
+    def test_wrong_extension_is_rejected(self):
+        response = self.client.post(reverse('upload_start'), {'kind': 'sheet', 'filename': 'x.exe', 'size': 10})
+        self.assertEqual(response.status_code, 400)
+
+
+class BulkModerationTests(MediaRootMixin, UcathTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.staff = User.objects.create_user('moderator', password='secret', is_staff=True)
+        self.client.force_login(self.staff)
+
+    def bulk(self, action, songs, **data):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.post(reverse('admin_bulk_action'), {
+                'action': action, 'songs': [song.pk for song in songs], **data,
+            })
+        self.assertRedirects(response, reverse('admin_arrivals'), fetch_redirect_response=False)
+        return [query['sql'] for query in ctx.captured_queries]
+
+    def test_publish_is_a_single_update(self):
+        songs = [make_song(index, status='pending_approval', title=f'Pending {index}') for index in range(3)]
+        make_song(9, status='pending_approval', title='Left Alone')
+        self.client.get(reverse('dashboard'))
+
+        queries = self.bulk('publish', songs)
+        updates = [sql for sql in queries if sql.startswith('UPDATE "ucath_songs_song"')]
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(Song.objects.filter(status='published').count(), 3)
+        self.assertContains(self.client.get(reverse('dashboard')), 'Pending 2')
+
+        self.bulk('unpublish', songs[:1])
+        self.assertEqual(Song.objects.get(pk=songs[0].pk).status, 'pending_approval')
+
+    def test_season_change_is_searchable(self):
+        songs = [make_song(1, title='Vexilla Regis'), make_song(2, title='Stabat Mater')]
+        self.bulk('season', songs, season='passion')
+        self.assertEqual(Song.objects.filter(season='passion').count(), 2)
+        self.assertEqual(set(search_songs(Song.objects.all(), 'passion')), set(songs))
+
+    def test_season_change_needs_a_season(self):
+        song = make_song(1)
+        self.bulk('season', [song])
+        self.assertEqual(Song.objects.get(pk=song.pk).season, 'ordinary')
+
+    def test_delete_runs_one_statement_per_table_and_queues_files(self):
+        audio = b'ID3' + bytes(2000)
+        doomed = [make_song(index, title=f'Doomed {index}') for index in range(3)]
+        kept = make_song(9, title='Kept')
+        for song in [doomed[0], kept]:
+            Mp3File.objects.create(song=song, mp3_file=SimpleUploadedFile('take.mp3', audio), mp3_version='Alto')
+        shared = Mp3File.objects.get(song=kept, mp3_version='Alto').mp3_file.name
+
+        queries = self.bulk('delete', doomed)
+        for table in ['song', 'musicsheet', 'mp3file', 'midifile', 'thumbnailrendition', 'thumbnailjob']:
+            deletes = [sql for sql in queries if sql.startswith(f'DELETE FROM "ucath_songs_{table}"')]
+            self.assertEqual(len(deletes), 1, table)
+        self.assertEqual(list(Song.objects.all()), [kept])
+        self.assertEqual(MusicSheet.objects.count(), 1)
+        self.assertEqual(list(search_songs(Song.objects.all(), 'doomed')), [])
+
+        # Sheets, thumbnails and recordings of the three songs, nothing removed yet
+        self.assertEqual(FileDeletion.objects.count(), 10)
+        self.assertEqual(StoredBlob.objects.get(name=shared).ref_count, 2)
+        call_command('purge_files', stdout=StringIO())
+        self.assertFalse(FileDeletion.objects.exists())
+        self.assertEqual(StoredBlob.objects.get(name=shared).ref_count, 1)
+        self.assertTrue(os.path.exists(os.path.join(settings.MEDIA_ROOT, shared)))
+
+    def test_delete_covers_every_relation(self):
+        deleted = {model for model, _ in moderation.cascade_chains(Song)}
+        for model in (Song, MusicSheet):
+            for relation in model._meta.related_objects:
+                # The index tables have no constraint and are cleared by remove_songs
+                self.assertTrue(
+                    relation.related_model in deleted or relation.related_model in (SongSearchIndex, SongTrigram),
+                    f'{model.__name__}.{relation.name}',
+                )
+        self.assertTrue({ThumbnailJob, ThumbnailRendition, MusicSheet, Mp3File, MidiFile} <= deleted)
+
+    def test_staff_only(self):
+        song = make_song(1, status='pending_approval')
+        self.client.logout()
+        self.client.post(reverse('admin_bulk_action'), {'action': 'publish', 'songs': [song.pk]})
+        self.assertEqual(Song.objects.get(pk=song.pk).status, 'pending_approval')
@@ -0,0 +1,113 @@
+"""
+PDF thumbnail rendering and text extraction.
+
+Nothing here touches the ORM, so process_pdf can run inside the worker
+processes of the thumbnail_worker command. It renders the renditions and
+reads the page geometry and text layer from one open of the file.
+
+Every sheet records the render_settings() its renditions were made with,
+so rebuild_thumbnails can find the ones left behind by a settings change.
+"""
+import hashlib
+import json
+import os
+import re
+from io import BytesIO
+
+import fitz
+from PIL import Image
+
+# Rendition widths in px. The page is rasterised once at the largest width
+# and every smaller size is downscaled from that one pixmap.
+RENDITION_WIDTHS = {'sm': 240, 'md': 480, 'lg': 960}
+# PIL format, file extension and encoder options per stored format.
+RENDITION_FORMATS = {
+    'webp': ('WEBP', 'webp', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', 'jpg', {'quality': 85, 'optimize': True, 'progressive': True}),
+}
+# The rendition MusicSheet.thumbnail points at, for plain <img> fallbacks.
+FALLBACK_RENDITION = ('md', 'jpeg')
+# Bump when rendering changes in a way the settings above do not show
+RENDER_VERSION = 1
+# Longest text layer kept per sheet; lyrics are far shorter than this.
+MAX_TEXT_LENGTH = 20000
+# Lyrics under a stave are split into syllables ("Glo - ri - a"); a dash
+# with a space on either side is a syllable break, "well-known" is not.
+SYLLABLE_BREAK_RE = re.compile(r'(?<=\w)(?:\s+[-\u2010\u2013]\s*|[-\u2010\u2013]\s+)(?=\w)')
+WHITESPACE_RE = re.compile(r'\s+')
+
+
+def render_settings():
+    """A short fingerprint of everything that decides how renditions look."""
+    settings = [RENDER_VERSION, RENDITION_WIDTHS, RENDITION_FORMATS, FALLBACK_RENDITION]
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def render_page(page):
+    """Rasterise a PyMuPDF page at the largest rendition width as a PIL image."""
+    zoom = max(RENDITION_WIDTHS.values()) / page.rect.width
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+    return Image.frombytes('RGB', (pix.width, pix.height), pix.samples)
+
+
+def encode_renditions(page_image):
+    """Downscale and encode ``page_image`` into every size and format."""
+    renditions = []
+    image = page_image
+    for size, width in sorted(RENDITION_WIDTHS.items(), key=lambda item: item[1], reverse=True):
+        if image.width > width:
+            image = image.resize((width, round(image.height * width / image.width)), Image.LANCZOS)
+        for fmt, (pil_format, ext, options) in RENDITION_FORMATS.items():
+            buffer = BytesIO()
+            image.save(buffer, format=pil_format, **options)
+            renditions.append({
+                'size': size,
+                'format': fmt,
+                'ext': ext,
+                'width': image.width,
+                'height': image.height,
+                'data': buffer.getvalue(),
+            })
+    return renditions
+
+
+def clean_text(text):
+    """Rejoin syllabified lyrics and collapse whitespace, for the search index."""
+    text = WHITESPACE_RE.sub(' ', SYLLABLE_BREAK_RE.sub('', text)).strip()
+    return text[:MAX_TEXT_LENGTH]
+
+
+def document_details(doc, first_page):
+    """MusicSheet field values read from an open PDF: page count, size (pt) and text."""
+    return {
+        'page_count': doc.page_count,
+        'page_width': round(first_page.rect.width, 2),
+        'page_height': round(first_page.rect.height, 2),
+        'text_content': clean_text(' '.join(page.get_text() for page in doc)),
+    }
+
+
+def process_pdf(pdf_path):
+    """Render the renditions of the PDF at ``pdf_path`` and read its details in one pass."""
+    with fitz.open(pdf_path) as doc:
+        first_page = doc.load_page(0)
+        page_image = render_page(first_page)
+        details = document_details(doc, first_page)
+    return encode_renditions(page_image), details
+
+
+def extract_details(pdf_path):
+    """Only the details, for sheets rendered before they were extracted."""
+    with fitz.open(pdf_path) as doc:
+        return document_details(doc, doc.load_page(0))
+
+
+def render_renditions(pdf_path):
+    """Render the first page of the PDF at ``pdf_path`` into all renditions."""
+    with fitz.open(pdf_path) as doc:
+        page_image = render_page(doc.load_page(0))
+    return encode_renditions(page_image)
+
+
+def rendition_name(sheet_name, size, ext):
+    return os.path.basename(sheet_name).rsplit('.', 1)[0] + f'_thumb_{size}.{ext}'
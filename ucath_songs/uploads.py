@@ -0,0 +1,197 @@
+"""
+Resumable chunked uploads.
+
+The protocol has three steps:
+
+1. ``POST /uploads/`` with ``kind`` (sheet, audio or midi), ``filename``
+   and ``size`` creates a ChunkedUpload and returns its id.
+2. ``PUT /uploads/<id>/`` with ``Content-Range: bytes start-end/size``
+   sends one chunk. ``start`` must equal the bytes received so far; after
+   a dropped connection, ``GET /uploads/<id>/`` tells the client where to
+   resume.
+3. ``POST /uploads/<id>/complete/`` moves the file into storage. The id
+   can then be sent instead of a file to the asset upload views.
+
+Chunks are appended to a part file in the asset's upload directory and
+hashed as they arrive. Completing renames that file to its content-
+addressed name, so the data is never copied or read again. The running
+hash lives in process memory. If a chunk reaches a process that does not
+hold it (a restart or another worker), the bytes received so far are
+hashed once to rebuild it.
+"""
+import hashlib
+import os
+import posixpath
+import threading
+from datetime import timedelta
+
+from django.core.exceptions import ValidationError
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.utils import timezone
+
+from .models import ChunkedUpload, MusicSheet, MidiFile, Mp3File
+
+# kind -> (model, file field, accepted extensions)
+UPLOAD_KINDS = {
+    'sheet': (MusicSheet, 'music_sheet', ('.pdf',)),
+    'audio': (Mp3File, 'mp3_file', ('.mp3',)),
+    'midi': (MidiFile, 'midi_file', ('.mid', '.midi')),
+}
+MAX_UPLOAD_SIZE = 512 * 1024 * 1024
+MAX_CHUNK_SIZE = 16 * 1024 * 1024
+# Chunk size suggested to clients; small enough to retry cheaply on slow links
+CHUNK_SIZE = 1024 * 1024
+READ_SIZE = 64 * 1024
+STALE_AFTER = timedelta(days=1)
+
+_hashes = {}
+_hashes_lock = threading.Lock()
+
+
+class UploadError(Exception):
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def upload_directory(kind):
+    model, file_field, _ = UPLOAD_KINDS[kind]
+    return model._meta.get_field(file_field).upload_to.rstrip('/')
+
+
+def part_path(upload):
+    return default_storage.path(posixpath.join(upload_directory(upload.kind), '.uploads', f'{upload.pk}.part'))
+
+
+def user_uploads(user):
+    """Uploads ``user`` may continue or use; anonymous ones are shared by their unguessable id."""
+    if user.is_authenticated:
+        return ChunkedUpload.objects.filter(user=user)
+    return ChunkedUpload.objects.filter(user__isnull=True)
+
+
+def start_upload(kind, filename, size, user=None):
+    if kind not in UPLOAD_KINDS:
+        raise UploadError(f'Unknown upload kind "{kind}".')
+    filename = os.path.basename(filename or '')
+    if not filename.lower().endswith(UPLOAD_KINDS[kind][2]):
+        raise UploadError(f'A {kind} upload must be one of: {", ".join(UPLOAD_KINDS[kind][2])}.')
+    if not 0 < size <= MAX_UPLOAD_SIZE:
+        raise UploadError(f'Uploads must be between 1 byte and {MAX_UPLOAD_SIZE} bytes.', status=413)
+
+    upload = ChunkedUpload.objects.create(
+        kind=kind, filename=filename, size=size, user=user if user and user.is_authenticated else None
+    )
+    path = part_path(upload)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, 'wb').close()
+    return upload
+
+
+def running_hash(upload, path):
+    """The sha256 of the first ``upload.offset`` bytes received."""
+    with _hashes_lock:
+        offset, digest = _hashes.get(upload.pk, (None, None))
+    if offset == upload.offset:
+        return digest.copy()
+    digest = hashlib.sha256()
+    with open(path, 'rb') as part:
+        remaining = upload.offset
+        while remaining > 0:
+            data = part.read(min(READ_SIZE, remaining))
+            if not data:
+                raise UploadError('Received data is missing; restart the upload.', status=410)
+            digest.update(data)
+            remaining -= len(data)
+    return digest
+
+
+def write_chunk(upload, start, length, stream):
+    """Append ``length`` bytes read from ``stream`` at ``start``; return the new offset."""
+    if upload.status != 'uploading':
+        raise UploadError('Upload is already complete.', status=409)
+    if start != upload.offset:
+        raise UploadError(f'Expected a chunk starting at byte {upload.offset}.', status=409)
+    if not 0 < length <= MAX_CHUNK_SIZE or start + length > upload.size:
+        raise UploadError('Chunk is empty, too large or past the end of the file.', status=413)
+
+    path = part_path(upload)
+    digest = running_hash(upload, path)
+    with open(path, 'r+b') as part:
+        # Drop anything a broken earlier attempt left after the offset
+        part.truncate(start)
+        part.seek(start)
+        remaining = length
+        while remaining > 0:
+            data = stream.read(min(READ_SIZE, remaining))
+            if not data:
+                raise UploadError('Chunk ended early; resend it.')
+            part.write(data)
+            digest.update(data)
+            remaining -= len(data)
+
+    # Conditional, so a concurrent duplicate of this chunk cannot advance twice
+    if not ChunkedUpload.objects.filter(pk=upload.pk, offset=start, status='uploading').update(
+        offset=start + length, updated_at=timezone.now()
+    ):
+        raise UploadError('Upload changed while this chunk was written; check the offset.', status=409)
+    upload.offset = start + length
+    with _hashes_lock:
+        _hashes[upload.pk] = (upload.offset, digest)
+    return upload.offset
+
+
+def complete_upload(upload):
+    """Move the received file into storage and return its stored name."""
+    if upload.status == 'complete':
+        return upload.file
+    if upload.offset != upload.size:
+        raise UploadError(f'Only {upload.offset} of {upload.size} bytes were received.', status=409)
+
+    path = part_path(upload)
+    directory = upload_directory(upload.kind)
+    if hasattr(default_storage, 'commit'):
+        digest = running_hash(upload, path)
+        extension = os.path.splitext(upload.filename)[1].lower()
+        name = default_storage.commit(path, directory, extension, digest.hexdigest(), upload.size)
+    else:
+        with open(path, 'rb') as part:
+            name = default_storage.save(posixpath.join(directory, upload.filename), File(part))
+        os.remove(path)
+    with _hashes_lock:
+        _hashes.pop(upload.pk, None)
+
+    upload.status, upload.file = 'complete', name
+    upload.save(update_fields=['status', 'file', 'updated_at'])
+    return name
+
+
+def claim_upload(upload_id, kind, user):
+    """
+    Hand a completed upload's stored file name to the asset about to use
+    it, or return None if ``upload_id`` is not a completed ``kind`` upload
+    of ``user``. The upload's blob reference passes to the asset.
+    """
+    if not upload_id:
+        return None
+    try:
+        upload = user_uploads(user).get(pk=upload_id, kind=kind, status='complete')
+    except (ChunkedUpload.DoesNotExist, ValidationError):
+        return None
+    if not ChunkedUpload.objects.filter(pk=upload.pk).delete()[0]:
+        return None
+    return upload.file
+
+
+def purge_stale_uploads(older_than=STALE_AFTER):
+    """Delete uploads untouched for ``older_than``, with their files."""
+    for upload in ChunkedUpload.objects.filter(updated_at__lt=timezone.now() - older_than):
+        if upload.status == 'complete':
+            default_storage.delete(upload.file)
+        elif os.path.exists(part_path(upload)):
+            os.remove(part_path(upload))
+        with _hashes_lock:
+            _hashes.pop(upload.pk, None)
+        upload.delete()
@@ -7,6 +7,7 @@ urlpatterns = [
     path('', LandingView.as_view(), name='dashboard'),
     path('about-cantus-ucm/', AboutUsView.as_view(), name='about'),
     path('music-scores/library/', SongLibraryListView.as_view(), name='song_library'),
+    path('music-scores/library/export.zip', export_library, name='export_library'),
     path('music-scores/<slug:slug>/details/', SongDetailView.as_view(), name='song_detail'),
     path('music-scores/upload/', SongCreateView.as_view(), name='upload_song'),
     path('music-scores/<slug:slug>/edit/', SongUpdateView.as_view(), name='song_edit'),\
@@ -15,8 +16,15 @@ urlpatterns = [
     path('logout/', UserLogoutView.as_view(), name='logout'),
     path('archive/links/', SongIndexListView.as_view(), name='song_links'),
     path('archive/download/<str:slug>/', download_sheet, name='download_sheet'),
+    path('archive/media/<str:asset_type>/<int:asset_id>/<str:filename>', serve_asset, name='serve_asset'),
+    path('archive/notes/<int:asset_id>/<str:filename>', serve_note_events, name='serve_note_events'),
+    path('metrics/', export_metrics, name='metrics'),
+    path('uploads/', upload_start, name='upload_start'),
+    path('uploads/<uuid:upload_id>/', upload_chunk, name='upload_chunk'),
+    path('uploads/<uuid:upload_id>/complete/', upload_complete, name='upload_complete'),
     # admin 
     path('scores-catalog/vlists/', AdminArrivalsView.as_view(), name='admin_arrivals'),
+    path('scores-catalog/vlists/bulk/', AdminBulkActionView.as_view(), name='admin_bulk_action'),
     path('music-scores/<slug:slug>/update/', AdminSongUpdateView.as_view(), name='admin_song_detail'),
     path('music-scores/delete-asset/<str:asset_type>/<int:asset_id>/', delete_asset, name='delete_asset'),
     path('music-scores/song/<slug:slug>/upload-sheet/', UploadSheetView.as_view(), name='upload_sheet'),
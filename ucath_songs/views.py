@@ -4,14 +4,31 @@ from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
 from django.contrib.auth.forms import UserCreationForm
 from django.urls import reverse_lazy
 from django.shortcuts import redirect, reverse
-from django.db.models import Q
+from django.db.models import Count
 from django.contrib import messages
-from django.shortcuts import redirect, get_object_or_404
-from django.http import FileResponse, Http404
+from django.shortcuts import redirect, get_object_or_404, aget_object_or_404
+from django.core.exceptions import PermissionDenied
+from django.core.files.storage import default_storage
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.template.loader import get_template, render_to_string
+from django.utils.safestring import mark_safe
+from django.utils.http import content_disposition_header
 from django.utils.text import slugify
+from django.views.decorators.http import require_http_methods, require_POST
+import asyncio
+import mimetypes
 import os
+import re
 from .models import *
 from .forms import *
+from django.core.cache import cache
+from .caching import CACHE_TIMEOUT, LANDING_KEY, facets_key, library_key, song_detail_key
+from .metrics import registry
+from . import moderation
+from .pagination import KeysetPaginator
+from .search import fuzzy_search_songs, match_songs, search_songs
+from .serving import REVALIDATE_CACHE_CONTROL, aserve_file, serve_gzipped, stream_zip
+from . import uploads
 
 
 class LandingView(TemplateView):
@@ -19,7 +36,11 @@ class LandingView(TemplateView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context['mass_parts'] = Song.mass_parts
-        context['recent_songs'] = Song.objects.filter(status='published').order_by('-created_at')[:5]
+        recent_songs = cache.get(LANDING_KEY)
+        if recent_songs is None:
+            recent_songs = list(Song.objects.filter(status='published').order_by('-created_at')[:5])
+            cache.set(LANDING_KEY, recent_songs, CACHE_TIMEOUT)
+        context['recent_songs'] = recent_songs
         return context
 
 
@@ -29,40 +50,132 @@ class AboutUsView(TemplateView):
         context = super().get_context_data(**kwargs)
         return context
 
+def filter_library(queryset, params):
+    """Apply the library's season and mass part filters, then its search, in ``params``."""
+    queryset = filter_choices(queryset, params)
+
+    # Search last, so a fuzzy search only considers the filtered songs
+    q = params.get('q')
+    if q:
+        queryset = search_songs(queryset, q)
+
+    return queryset
+
+
+def filter_choices(queryset, params):
+    """Apply only the library's season and mass part filters in ``params``."""
+    seasons = params.getlist('season')
+    if seasons:
+        queryset = queryset.filter(season__in=seasons)
+
+    parts = params.getlist('part')
+    if parts:
+        queryset = queryset.filter(part_of_mass__in=parts)
+
+    return queryset
+
+
+def library_facets(params):
+    """
+    Published song counts per season and per mass part for the library's
+    search and filters in ``params``, as ``{'seasons': [(value, label,
+    count)], 'parts': [...]}``. Both come from one GROUP BY over (season,
+    part). Each facet leaves out its own filter, so a count says how many
+    songs ticking that choice would show.
+    """
+    key = facets_key(params)
+    facets = cache.get(key)
+    if facets is None:
+        queryset = Song.objects.filter(status='published')
+        seasons, parts = set(params.getlist('season')), set(params.getlist('part'))
+        q = params.get('q')
+        if q:
+            # Decided here, behind the cache, as the grid decides it: when no
+            # song passing the filters matches, count similar spellings (all
+            # of them, since each facet drops its own filter)
+            rows = facet_rows(match_songs(queryset, q))
+            if not any((not seasons or row['season'] in seasons) and
+                       (not parts or row['part_of_mass'] in parts) for row in rows):
+                rows = facet_rows(fuzzy_search_songs(queryset, q, limited=False))
+        else:
+            rows = facet_rows(queryset)
+
+        season_counts, part_counts = {}, {}
+        for row in rows:
+            if not parts or row['part_of_mass'] in parts:
+                season_counts[row['season']] = season_counts.get(row['season'], 0) + row['songs']
+            if not seasons or row['season'] in seasons:
+                part_counts[row['part_of_mass']] = part_counts.get(row['part_of_mass'], 0) + row['songs']
+
+        facets = {
+            'seasons': [(value, label, season_counts.get(value, 0)) for value, label in Song.season_choices],
+            'parts': [(value, label, part_counts.get(value, 0)) for value, label in Song.mass_parts],
+        }
+        cache.set(key, facets, CACHE_TIMEOUT)
+    return facets
+
+
+def facet_rows(queryset):
+    return list(queryset.order_by().values('season', 'part_of_mass').annotate(songs=Count('pk')))
+
+
 class SongLibraryListView(ListView):
     model = Song
     context_object_name = 'songs'
-    paginate_by = 12
+    page_size = 12
 
     def get_template_names(self):
         if self.request.headers.get('HX-Request'):
+            # Infinite scroll asks for the cards after a cursor, not a new grid
+            if self.request.GET.get('cursor'):
+                return ['partials/song_cards.html']
             return ['partials/song_grid.html']
         return ['songs_listing.html']
 
     def get_queryset(self):
-        queryset = Song.objects.filter(status='published').order_by("-created_at")
-        
-        # Search
-        q = self.request.GET.get('q')
-        print(q)
-        if q:
-            queryset = queryset.filter(Q(title__icontains=q) | Q(composer__icontains=q) | Q(part_of_mass__icontains=q) | Q(season__icontains=q))
-            
-        # Filters
-        seasons = self.request.GET.getlist('season')
-        if seasons:
-            queryset = queryset.filter(season__in=seasons)
-            
-        parts = self.request.GET.getlist('part')
-        if parts:
-            queryset = queryset.filter(part_of_mass__in=parts)
-            
-        return queryset
+        # The search is applied in get_page, behind the page cache
+        queryset = Song.objects.filter(status='published').order_by("-created_at").with_card_assets()
+        return filter_choices(queryset, self.request.GET)
+
+    def get_page(self, cache_key):
+        page = cache.get(f'ucath:library:{cache_key}')
+        if page is None:
+            q = self.request.GET.get('q')
+            if q:
+                # A search that matches runs MATCH once; a miss falls back
+                # to similar spellings (on every page, as the first did)
+                page = self.paginate(match_songs(self.object_list, q))
+                if not page.object_list:
+                    page = self.paginate(fuzzy_search_songs(self.object_list, q))
+            else:
+                page = self.paginate(self.object_list)
+            cache.set(f'ucath:library:{cache_key}', page, CACHE_TIMEOUT)
+        return page
+
+    def paginate(self, queryset):
+        ordering = ['-created_at', '-id']
+        if 'search_rank' in queryset.query.annotations:
+            ordering.insert(0, 'search_rank')
+        paginator = KeysetPaginator(queryset, self.page_size, ordering)
+        return paginator.page(self.request.GET.get('cursor'))
 
     def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
+        cache_key = library_key(self.request.GET)
+        page = self.get_page(cache_key)
+        context = super().get_context_data(object_list=page.object_list, **kwargs)
         context['season_choices'] = Song.season_choices
         context['mass_parts'] = Song.mass_parts
+        if not self.request.GET.get('cursor'):
+            # The sidebar counts; HTMX grid responses carry them out of band
+            context['facets'] = library_facets(self.request.GET)
+            context['facets_oob'] = bool(self.request.headers.get('HX-Request'))
+        if page.has_next:
+            params = self.request.GET.copy()
+            params['cursor'] = page.next_cursor
+            context['next_page_url'] = f'{self.request.path}?{params.urlencode()}'
+        # The grid partial caches its rendered cards under this key
+        context['grid_cache_key'] = cache_key
+        context['grid_cache_timeout'] = CACHE_TIMEOUT
         return context
 
 
@@ -74,6 +187,9 @@ class SongCreateView(CreateView):
     success_url = reverse_lazy('song_library')
     login_url = reverse_lazy('login')
     
+    def get_form_kwargs(self):
+        return {**super().get_form_kwargs(), 'user': self.request.user}
+
     def form_valid(self, form):
         # Set song status based on whether user is admin/staff
         if self.request.user.is_staff or self.request.user.is_superuser:
@@ -86,7 +202,7 @@ class SongCreateView(CreateView):
         song = form.instance
         
         # Handle Music Sheet upload
-        music_sheet = form.cleaned_data.get('music_sheet')
+        music_sheet = form.cleaned_data.get('music_sheet') or self.claim_upload(form, 'music_sheet', 'sheet')
         ms_version = form.cleaned_data.get('ms_version')
         if music_sheet and ms_version:
             MusicSheet.objects.create(
@@ -96,7 +212,7 @@ class SongCreateView(CreateView):
             )
         
         # Handle MIDI File upload
-        midi_file = form.cleaned_data.get('midi_file')
+        midi_file = form.cleaned_data.get('midi_file') or self.claim_upload(form, 'midi_file', 'midi')
         midi_version = form.cleaned_data.get('midi_version')
         midi_link = form.cleaned_data.get('midi_link')
         if midi_file or midi_version or midi_link:
@@ -108,7 +224,7 @@ class SongCreateView(CreateView):
             )
         
         # Handle MP3 File upload
-        mp3_file = form.cleaned_data.get('mp3_file')
+        mp3_file = form.cleaned_data.get('mp3_file') or self.claim_upload(form, 'mp3_file', 'audio')
         mp3_version = form.cleaned_data.get('mp3_version')
         if mp3_file and mp3_version:
             Mp3File.objects.create(
@@ -125,6 +241,9 @@ class SongCreateView(CreateView):
         
         return response
     
+    def claim_upload(self, form, field, kind):
+        return uploads.claim_upload(form.cleaned_data.get(f'{field}_upload'), kind, self.request.user)
+
     def form_invalid(self, form):
         return super().form_invalid(form)
     
@@ -140,12 +259,29 @@ class SongDetailView(DetailView):
     template_name = 'song_detail.html'
     context_object_name = 'song'
 
+    def get_object(self, queryset=None):
+        # The song and its assets are cached together until one of them changes
+        key = song_detail_key(self.kwargs['slug'])
+        cached = cache.get(key)
+        if cached is None:
+            song = super().get_object(queryset)
+            cached = {
+                'song': song,
+                'sheets': list(song.musicsheet_set.all()),
+                # Note events are fetched by the player from serve_note_events
+                'midis': list(song.midifile_set.defer('note_events')),
+                'audios': list(song.mp3file_set.all()),
+            }
+            cache.set(key, cached, CACHE_TIMEOUT)
+        self.assets = cached
+        return cached['song']
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         # Fetching all related instances
-        context['sheets'] = self.object.musicsheet_set.all()
-        context['midis'] = self.object.midifile_set.all()
-        context['audios'] = self.object.mp3file_set.all()
+        context['sheets'] = self.assets['sheets']
+        context['midis'] = self.assets['midis']
+        context['audios'] = self.assets['audios']
         return context
 
 
@@ -256,15 +392,17 @@ class AdminArrivalsView(LoginRequiredMixin, UserPassesTestMixin, ListView):
     def get_queryset(self):
         query = self.request.GET.get('q')
         # Admins see all, but filtered by search if present
-        queryset = Song.objects.all().order_by('status', '-created_at')
+        queryset = Song.objects.all().order_by('status', '-created_at', '-id').with_card_assets()
         
         if query:
-            queryset = queryset.filter(
-                Q(title__icontains=query) | 
-                Q(composer__icontains=query)
-            )
+            queryset = search_songs(queryset, query)
         return queryset
 
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['season_choices'] = Song.season_choices
+        return context
+
     def render_to_response(self, context, **response_kwargs):
         # If HTMX request, only render the grid part
         if self.request.headers.get('HX-Request'):
@@ -279,6 +417,37 @@ class AdminArrivalsView(LoginRequiredMixin, UserPassesTestMixin, ListView):
         self.template_name = 'admin/partials/song_grid.html' 
         return super().render_to_response(context)
 
+class AdminBulkActionView(LoginRequiredMixin, UserPassesTestMixin, View):
+    """Publish, unpublish, re-season or delete the songs ticked in the arrivals queue"""
+
+    def test_func(self):
+        return self.request.user.is_staff
+
+    def post(self, request, *args, **kwargs):
+        form = BulkActionForm(request.POST)
+        if not form.is_valid():
+            for errors in form.errors.values():
+                messages.error(request, errors[0])
+            return redirect('admin_arrivals')
+
+        action = form.cleaned_data['action']
+        song_ids = list(form.cleaned_data['songs'].values_list('pk', flat=True))
+        if action == 'publish':
+            count = moderation.publish_songs(song_ids)
+            messages.success(request, f"{count} manuscript(s) published.")
+        elif action == 'unpublish':
+            count = moderation.unpublish_songs(song_ids)
+            messages.success(request, f"{count} manuscript(s) returned to pending approval.")
+        elif action == 'season':
+            count = moderation.move_songs_to_season(song_ids, form.cleaned_data['season'])
+            season = dict(Song.season_choices)[form.cleaned_data['season']]
+            messages.success(request, f"{count} manuscript(s) moved to {season}.")
+        else:
+            count = moderation.delete_songs(song_ids)
+            messages.success(request, f"{count} manuscript(s) permanently purged from the registry.")
+        return redirect('admin_arrivals')
+
+
 class AdminSongUpdateView(LoginRequiredMixin, UserPassesTestMixin, UpdateView):
     model = Song
     form_class = SongForm
@@ -330,7 +499,8 @@ class AssetUploadBaseView(LoginRequiredMixin, UserPassesTestMixin, View):
 class UploadSheetView(AssetUploadBaseView):
     def post(self, request, slug):
         song = get_object_or_404(Song, slug=slug)
-        file = request.FILES.get('file')
+        # A finished chunked upload (see uploads.py) stands in for the file
+        file = request.FILES.get('file') or uploads.claim_upload(request.POST.get('upload_id'), 'sheet', request.user)
         version = request.POST.get('ms_version', 'Standard Folio')
         
         if file:
@@ -342,7 +512,7 @@ class UploadSheetView(AssetUploadBaseView):
 class UploadAudioView(AssetUploadBaseView):
     def post(self, request, slug):
         song = get_object_or_404(Song, slug=slug)
-        file = request.FILES.get('file')
+        file = request.FILES.get('file') or uploads.claim_upload(request.POST.get('upload_id'), 'audio', request.user)
         version = request.POST.get('mp3_version', 'Master Recording')
         
         if file:
@@ -353,7 +523,7 @@ class UploadAudioView(AssetUploadBaseView):
 class UploadMidiView(AssetUploadBaseView):
     def post(self, request, slug):
         song = get_object_or_404(Song, slug=slug)
-        file = request.FILES.get('file')
+        file = request.FILES.get('file') or uploads.claim_upload(request.POST.get('upload_id'), 'midi', request.user)
         cloud_link = request.POST.get('cloud_link')
         version = request.POST.get('midi_version', 'Synthesized Logic')
         
@@ -378,33 +548,197 @@ class UploadMidiView(AssetUploadBaseView):
         return redirect(self.get_success_url(slug))
 
 
-class SongIndexListView(ListView):
-    model = Song
+class SongIndexListView(View):
+    """
+    Every sheet in the archive, streamed: the page shell goes out at once and
+    the links follow in chunks from one sheet+song query.
+    """
     template_name = 'song_links.html'
-    context_object_name = 'songs'
-    ordering = ['title']
-
-
-def download_sheet(request, slug):
+    rows_template_name = 'partials/song_link_rows.html'
+    rows_placeholder = '<!-- song-link-rows -->'
+    chunk_size = 500
+
+    def get(self, request, *args, **kwargs):
+        page = render_to_string(self.template_name, {'rows_placeholder': mark_safe(self.rows_placeholder)}, request=request)
+        head, tail = page.split(self.rows_placeholder, 1)
+        return StreamingHttpResponse(self.stream(head, tail), content_type='text/html; charset=utf-8')
+
+    def stream(self, head, tail):
+        yield head
+        rows_template = get_template(self.rows_template_name)
+        sheets = (
+            MusicSheet.objects.filter(slug__isnull=False)
+            .order_by('song__title', 'song_id', 'id')
+            .values('slug', 'ms_version', 'song__title')
+            .iterator(chunk_size=self.chunk_size)
+        )
+        chunk = []
+        for sheet in sheets:
+            sheet['song_title'] = sheet['song__title'].title()
+            chunk.append(sheet)
+            if len(chunk) == self.chunk_size:
+                yield rows_template.render({'sheets': chunk})
+                chunk = []
+        if chunk:
+            yield rows_template.render({'sheets': chunk})
+        yield tail
+
+
+async def download_sheet(request, slug):
     # Fetch the sheet object
-    sheet = get_object_or_404(MusicSheet, slug=slug)
+    sheet = await aget_object_or_404(MusicSheet.objects.select_related('song'), slug=slug)
     
     # Ensure the file actually exists on the server
-    if not sheet.music_sheet or not os.path.exists(sheet.music_sheet.path):
+    if not sheet.music_sheet or not await asyncio.to_thread(os.path.exists, sheet.music_sheet.path):
         raise Http404("The requested manuscript file is missing from the archive.")
 
-    file_handle = open(sheet.music_sheet.path, 'rb')
-
     safe_song_title = slugify(sheet.song.title)
     safe_version = slugify(sheet.ms_version)
     filename = f"{safe_song_title}_{safe_version}.pdf"
 
-    response = FileResponse(file_handle, content_type='application/pdf')
-    
-    response['Content-Disposition'] = f'attachment; filename="{filename}"'
-    
-    return response
-
-
-
-
+    # This URL outlives file changes, so clients revalidate (cheap 304s)
+    return await aserve_file(
+        request, sheet.music_sheet.path, 'application/pdf',
+        filename=filename, as_attachment=True, cache_control=REVALIDATE_CACHE_CONTROL
+    )
+
+
+# ?include= value -> (model, file field, version field)
+EXPORT_ASSETS = {
+    'sheets': (MusicSheet, 'music_sheet', 'ms_version'),
+    'audio': (Mp3File, 'mp3_file', 'mp3_version'),
+    'midi': (MidiFile, 'midi_file', 'midi_version'),
+}
+
+
+def export_library(request):
+    """
+    Stream a ZIP of the sheets (and with ?include=audio/midi, the
+    recordings and MIDI files) of every published song matching the
+    library's search, season and part filters.
+    """
+    songs = filter_library(Song.objects.filter(status='published'), request.GET)
+    kinds = ['sheets', *(kind for kind in ('audio', 'midi') if kind in request.GET.getlist('include'))]
+    labels = [*request.GET.getlist('season'), *request.GET.getlist('part')]
+    filename = '_'.join(['ucath', *map(slugify, labels)]) + '.zip'
+    return StreamingHttpResponse(
+        stream_zip(export_files(songs, kinds)),
+        content_type='application/zip',
+        headers={'Content-Disposition': content_disposition_header(True, filename)},
+    )
+
+
+def export_files(songs, kinds):
+    """Yield (archive name, path) for each stored file of ``songs``, named like download_sheet names them."""
+    used = set()
+    for kind in kinds:
+        model, file_field, version_field = EXPORT_ASSETS[kind]
+        rows = (
+            model.objects.filter(song__in=songs.values('pk')).exclude(**{file_field: ''})
+            .order_by('song__title', 'song_id', 'id')
+            .values_list(file_field, version_field, 'song__title')
+            .iterator(chunk_size=500)
+        )
+        for name, version, title in rows:
+            path = default_storage.path(name)
+            if not os.path.exists(path):
+                continue
+            stem = f"{slugify(title)}_{slugify(version)}"
+            extension = os.path.splitext(name)[1].lower()
+            arcname, copy = stem + extension, 1
+            while arcname in used:
+                copy += 1
+                arcname = f'{stem}-{copy}{extension}'
+            used.add(arcname)
+            yield arcname, path
+
+
+ASSET_MODELS = {
+    'sheet': MusicSheet,
+    'audio': Mp3File,
+    'midi': MidiFile,
+}
+
+
+async def serve_asset(request, asset_type, asset_id, filename):
+    # Async, so under ASGI a slow download holds a coroutine, not a worker
+    model = ASSET_MODELS.get(asset_type)
+    if model is None:
+        raise Http404("Unknown asset type.")
+    asset = await aget_object_or_404(model, id=asset_id)
+    asset_file = asset.asset_file
+
+    if not asset_file or not await asyncio.to_thread(os.path.exists, asset_file.path):
+        raise Http404("The requested file is missing from the archive.")
+    # The file was replaced since this URL was handed out
+    if os.path.basename(asset_file.name) != filename:
+        return redirect(asset.serve_url)
+
+    content_type = mimetypes.guess_type(asset_file.name)[0] or 'application/octet-stream'
+    return await aserve_file(request, asset_file.path, content_type)
+
+
+def serve_note_events(request, asset_id, filename):
+    midi = get_object_or_404(MidiFile.objects.exclude(note_events=None), id=asset_id)
+    # The file was replaced since this URL was handed out
+    if midi.events_url.rsplit('/', 1)[1] != filename:
+        return redirect(midi.events_url)
+    return serve_gzipped(request, bytes(midi.note_events), 'application/json')
+
+
+def export_metrics(request):
+    # Request histograms of this process, in Prometheus text format
+    if not request.user.is_staff:
+        raise PermissionDenied
+    return HttpResponse(registry.exposition(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+CONTENT_RANGE_RE = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+
+
+def upload_state(upload):
+    return {'id': str(upload.pk), 'offset': upload.offset, 'size': upload.size, 'status': upload.status}
+
+
+@require_POST
+def upload_start(request):
+    try:
+        upload = uploads.start_upload(
+            request.POST.get('kind'), request.POST.get('filename'), int(request.POST.get('size', 0)), request.user
+        )
+    except ValueError:
+        return JsonResponse({'error': 'size must be a whole number of bytes.'}, status=400)
+    except uploads.UploadError as error:
+        return JsonResponse({'error': str(error)}, status=error.status)
+    uploads.purge_stale_uploads()
+    return JsonResponse({**upload_state(upload), 'chunk_size': uploads.CHUNK_SIZE}, status=201)
+
+
+@require_http_methods(['GET', 'PUT'])
+def upload_chunk(request, upload_id):
+    upload = get_object_or_404(uploads.user_uploads(request.user), pk=upload_id)
+    if request.method == 'PUT':
+        match = CONTENT_RANGE_RE.match(request.headers.get('Content-Range', ''))
+        if not match:
+            return JsonResponse({'error': 'Send Content-Range: bytes start-end/size.', **upload_state(upload)}, status=400)
+        start, end, size = map(int, match.groups())
+        length = int(request.headers.get('Content-Length') or 0)
+        if size != upload.size or end - start + 1 != length:
+            return JsonResponse({'error': 'Content-Range does not match the upload or the body.', **upload_state(upload)}, status=400)
+        try:
+            # Read the body straight off the socket; Django never spools it
+            uploads.write_chunk(upload, start, length, request)
+        except uploads.UploadError as error:
+            upload.refresh_from_db()
+            return JsonResponse({'error': str(error), **upload_state(upload)}, status=error.status)
+    return JsonResponse(upload_state(upload))
+
+
+@require_POST
+def upload_complete(request, upload_id):
+    upload = get_object_or_404(uploads.user_uploads(request.user), pk=upload_id)
+    try:
+        uploads.complete_upload(upload)
+    except uploads.UploadError as error:
+        return JsonResponse({'error': str(error), **upload_state(upload)}, status=error.status)
+    return JsonResponse(upload_state(upload))